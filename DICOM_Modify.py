@@ -1,11 +1,29 @@
 import os
+import shutil
+import subprocess
+import sys
+import tarfile
 import unittest
+import unittest.mock
 import logging
+import collections
+import contextlib
+import csv
+import json
+import threading
+import time
+import zipfile
 import vtk, qt, ctk, slicer
 from slicer.ScriptedLoadableModule import *
 from slicer.util import VTKObservationMixin
 import pydicom
 
+from DICOM_ModifyLib import (PROFILES, BatchReport, ModifyLogic, ModifyResult, Profile, ShardManifest, UIDMap,
+  formatChanges, generateCorpus, mergeShardManifests)
+from DICOM_ModifyLib.SafeWrite import atomicOutputFile, logSegmentPaths
+from DICOM_ModifyLib.__main__ import main as runCommandLine
+from DICOM_ModifyLib.UIDMap import DEFAULT_REMAP_KEYWORDS
+
 #
 # DICOM_Modify
 #
@@ -30,8 +48,38 @@ by enclosing the list elements, separated by commas, in square brackets.  For ex
 will be converted to a python list before being passed to pydicom. Otherwise, pydicom handles any needed
 conversion between strings and numbers. 
 
-Please note, this module does absolutely no checking that you are providing valid values or that
-your modified DICOM files will be valid. The DICOM standard is extremely complex, and you should
+The modification logic does not depend on Slicer, so large batches can also be run from the command line,
+for example: python -m DICOM_ModifyLib INPUT_DIR --recursive --overwrite --tag PatientID=NEWID --workers 16
+(run "python -m DICOM_ModifyLib --help" in this module's folder for all options). The command line also
+modifies the files in ZIP and TAR archives directly, without extracting them, and can keep an undo log of the
+original values of the changed elements (--undo-log), to undo an in place run later with --rollback.
+A batch can be split across machines with --shard INDEX/COUNT, each writing a result manifest (--manifest)
+which --merge-manifests then combines into one report.
+
+Check "Dry run" to only see what would change: the headers are read and edited in memory, in parallel, and
+the old and new value of every changed tag is shown (for Modify All, written to a diff report in the cache
+folder; on the command line, add --dry-run).
+
+When modifying files in place which are in Slicer's DICOM database, check "Update Slicer's DICOM database" to
+re-index just the series of the modified files after the batch, instead of re-importing the whole folder.
+
+Modify All can be limited to the files whose tags match a filter, e.g. "Modality == CT and SeriesNumber > 2".
+The tags are looked up in an index of the file headers, which is kept and only updated for new or changed files.
+
+Remap UIDs replaces the study, series, instance and frame of reference UIDs (and references to them) with new
+ones. The mapping from old to new UIDs is kept, so files of a series modified in separate runs still match.
+
+De-identify applies a profile of rules to every element of the files, including those in sequences. The basic
+profile (a subset of the DICOM PS3.15 basic application level confidentiality profile) empties or removes
+identifying elements, overlays, curves and private elements, and replaces UIDs as Remap UIDs does. Other profiles
+can be given as a text file of rules, one "SELECTOR ACTION" per line: selectors are a keyword or tag, a tag mask
+such as (50xx,xxxx), a value representation such as VR=PN, or "private"; actions are X (remove), Z (empty),
+D (dummy value), K (keep) and U (new UID). Tag values set above override the profile.
+
+Before any file is modified, tag names are checked against the DICOM dictionary and values are
+converted to the tag's value representation (e.g. numbers for US tags); values which cannot be
+encoded stop the modification. Beyond that, this module does no checking that you are providing
+sensible values or that your modified DICOM files will be valid. The DICOM standard is extremely complex, and you should
 only be modifying files using this tool if you know what you are doing!
 """
     # TODO: replace with organization, grant and thanks
@@ -109,6 +157,21 @@ class DICOM_ModifyWidget(ScriptedLoadableModuleWidget, VTKObservationMixin):
     self.logic = None
     self._parameterNode = None
     self._updatingGUIFromParameterNode = False
+    # State of the Modify All batch running in the background (see startModifyAllBatch)
+    self._batchThread = None
+    self._batchCancelEvent = None
+    self._batchTimer = None
+    self._batchProgress = None
+    self._batchResultCounts = collections.Counter()
+    self._batchFailedResults = collections.deque()
+    self._batchError = None
+    self._batchModifiedFilePaths = None # collected for updating the DICOM database, if enabled
+    # BatchReport of the last Modify All batch (phase timings, bytes, failures), e.g. for writeJson
+    self.lastModifyAllReport = None
+    # DiffReport of the last dry run of Modify All (see DICOM_ModifyLib/DiffReport.py)
+    self.lastDiffReportPath = None
+    self._batchDryRun = False
+    self._uidMap = None # see getUIDMap
 
   def setup(self):
     """
@@ -132,6 +195,11 @@ class DICOM_ModifyWidget(ScriptedLoadableModuleWidget, VTKObservationMixin):
     self.ui.OutputDICOMSinglePathLineEdit.filters = ctk.ctkPathLineEdit.Dirs
     self.ui.OutputDICOMFolderPathLineEdit.filters = ctk.ctkPathLineEdit.Dirs    
 
+    # De-identification profiles: none, the built in ones, or a rules file
+    self.ui.ProfileComboBox.addItems(['None'] + list(PROFILES) + ['Rules file'])
+    self.ui.ProfileRulesPathLineEdit.filters = ctk.ctkPathLineEdit.Readable + ctk.ctkPathLineEdit.Files
+    self.ui.ProfileRulesPathLineEdit.enabled = False
+
     # Set scene in MRML widgets. Make sure that in Qt designer the top-level qMRMLWidget's
     # "mrmlSceneChanged(vtkMRMLScene*)" signal in is connected to each MRML widget's.
     # "setMRMLScene(vtkMRMLScene*)" slot.
@@ -150,8 +218,10 @@ class DICOM_ModifyWidget(ScriptedLoadableModuleWidget, VTKObservationMixin):
 
     self.ui.ModifyAllPushButton.clicked.connect(self.onModifyAllPushButtonClick)
     self.ui.ModifySinglePushButton.clicked.connect(self.onModifySinglePushButtonClick)
+    self.ui.CancelModifyAllPushButton.clicked.connect(self.onCancelModifyAllPushButtonClick)
     self.ui.OverwriteRadioButton.toggled.connect(self.onOverwriteRadioButtonClick)
     self.ui.OutputDirRadioButton.toggled.connect(self.onOutputDirRadioButtonClick)
+    self.ui.ProfileComboBox.currentTextChanged.connect(self.onProfileComboBoxChanged)
     
     ''' I have removed any dependence on a parameter node for this module, because it is 
     so simple and I don't see a need for making it reloadable, it's really just for 
@@ -171,40 +241,153 @@ class DICOM_ModifyWidget(ScriptedLoadableModuleWidget, VTKObservationMixin):
     # Get selected file path
     selectedDirectory = self.ui.InputDICOMFolderPathLineEdit.currentPath
     logging.debug('Selected folder: %s' % (selectedDirectory))
-    # Gather all file paths to modify
-    filePathsToModify = []
     includeSubDirs = self.ui.includeSubDirsCheckBox.checked
-    for currentDir, curSubDirs, curFiles in os.walk(selectedDirectory):
-      for fileName in curFiles:
-        filePathsToModify.append(os.path.join(currentDir, fileName))
-      if not includeSubDirs:
-        # Don't continue the walk into subdirectories, stop here
-        break
-    logging.debug('Gathered %i files to modify.' % (len(filePathsToModify)))
     # Deterimine the output directory (i.e. same for overwrite, or specified other directory)
     outputDirectory = self.getOutputDirectoryForModifyAll()
     if outputDirectory=='':
       slicer.util.warningDisplay('No selected output directory! Canceling...')
       return
-    # Assemble output paths
-    # I want the output paths to have the same relative structure as the input paths
-    outputFilePaths = []
-    for filePath in filePathsToModify: 
-      fileDir, fileName = os.path.split(filePath)
-      relativePath = os.path.relpath(fileDir, selectedDirectory)
-      outputFilePath = os.path.join(outputDirectory, relativePath, fileName)
-      outputFilePaths.append(outputFilePath) 
-
-    # Gather Tags to modify
-    tagNumDict = self.gatherTagNumDict()
-    tagNameDict = self.gatherTagNameDict()
-    # TODO: Validate these tags before actually running any modification?
-    # Run the modification
-    for inputFilePath, outputFilePath in zip(filePathsToModify, outputFilePaths):
-      successFlag, err = self.logic.modifyDicomFile(inputFilePath, outputFilePath, tagNameDict, tagNumDict)
-      if not successFlag:
-        logging.warning('DICOM file modification failed for %s'%inputFilePath)
-        #logging.warning('Error message: %s' % (str(err)))
+    # Input and output paths are discovered lazily while the files are being modified.
+    # Output paths have the same relative structure as the input paths.
+    filterExpression = self.ui.FilterLineEdit.text.strip()
+    if filterExpression:
+      # Headers are looked up in an index kept in the cache, so repeated runs only read new and changed files
+      indexPath = os.path.join(slicer.app.cachePath, 'DICOM_Modify', 'TagIndex.sqlite')
+      os.makedirs(os.path.dirname(indexPath), exist_ok=True)
+      try:
+        filePathPairs = self.logic.iterFilteredFilePathPairs(selectedDirectory, outputDirectory, filterExpression,
+          includeSubDirs, indexPath=indexPath)
+      except ValueError as err:
+        slicer.util.warningDisplay('Invalid filter: %s  Canceling...' % str(err))
+        return
+    else:
+      filePathPairs = self.logic.iterFilePathPairs(selectedDirectory, outputDirectory, includeSubDirs)
+
+    # Gather Tags to modify, and validate them before actually running any modification
+    editPlan = self.compileEditPlan()
+    if editPlan is None:
+      return
+    # Run the modification (spread across a pool of worker processes) in the background
+    headerOnly = self.ui.HeaderOnlyCheckBox.checked
+    self.startModifyAllBatch(filePathPairs, editPlan, headerOnly, self.ui.UpdateDatabaseCheckBox.checked,
+      self.ui.DryRunCheckBox.checked)
+
+  def startModifyAllBatch(self, filePathPairs, editPlan, headerOnly, updateDatabase=False, dryRun=False):
+    '''Run the batch in a background thread, so that the GUI stays responsive. The thread must
+    not touch any Qt objects, it only updates the _batch* attributes, which a timer on the main
+    thread polls to update the progress display (see updateModifyAllProgress).  If updateDatabase,
+    the modified files are re-indexed in Slicer's DICOM database once the batch is finished.  If dryRun,
+    nothing is written, and the changes each file would have are written to the DiffReport at
+    lastDiffReportPath.
+    '''
+    if self._batchThread is not None:
+      slicer.util.warningDisplay('A Modify All batch is already running!')
+      return
+    self._batchCancelEvent = threading.Event()
+    self._batchProgress = None
+    self._batchResultCounts = collections.Counter()
+    self._batchFailedResults = collections.deque()
+    self._batchError = None
+    self._batchModifiedFilePaths = [] if updateDatabase and not dryRun else None
+    self._batchDryRun = dryRun
+    self.lastModifyAllReport = BatchReport()
+    diffReportPath = None
+    if dryRun:
+      diffReportPath = os.path.join(slicer.app.cachePath, 'DICOM_Modify', 'DryRun.jsonl')
+      os.makedirs(os.path.dirname(diffReportPath), exist_ok=True)
+    self.lastDiffReportPath = diffReportPath
+    self._batchThread = threading.Thread(target=self._runModifyAllBatch, name='DICOM_ModifyBatch',
+      args=(filePathPairs, editPlan, headerOnly, self._batchCancelEvent, self.lastModifyAllReport, diffReportPath),
+      daemon=True)
+    self.ui.ModifyAllPushButton.enabled = False
+    self.ui.ModifySinglePushButton.enabled = False
+    self.ui.CancelModifyAllPushButton.enabled = True
+    self.ui.ModifyAllProgressBar.setRange(0, 0) # busy indicator until the number of files is known
+    self.ui.ModifyAllStatusLabel.text = 'Starting...'
+    self._batchTimer = qt.QTimer()
+    self._batchTimer.setInterval(200)
+    self._batchTimer.timeout.connect(self.updateModifyAllProgress)
+    self._batchTimer.start()
+    self._batchThread.start()
+
+  def _runModifyAllBatch(self, filePathPairs, editPlan, headerOnly, cancelEvent, report, diffReportPath=None):
+    '''Body of the background batch thread, a dry run if diffReportPath is given'''
+    try:
+      for result in self.logic.iterModifyDicomFiles(filePathPairs, headerOnly=headerOnly, editPlan=editPlan,
+          progressCallback=self._onModifyAllProgress, cancelEvent=cancelEvent, report=report,
+          fsyncPolicy='directory', # synced in groups by folder, so overwritten files survive a crash
+          dryRun=diffReportPath is not None, diffReportPath=diffReportPath):
+        self._batchResultCounts[result.status] += 1
+        if result.status == 'failed':
+          self._batchFailedResults.append(result)
+        elif result.status == 'modified' and self._batchModifiedFilePaths is not None:
+          self._batchModifiedFilePaths.append(result.outputFilePath)
+    except Exception as err:
+      self._batchError = err
+
+  def _onModifyAllProgress(self, progress):
+    '''Progress callback, called in the background batch thread'''
+    self._batchProgress = progress
+
+  def updateModifyAllProgress(self):
+    '''Show the progress of the background batch (called by a timer on the main thread)'''
+    while self._batchFailedResults:
+      result = self._batchFailedResults.popleft()
+      logging.warning('DICOM file modification failed for %s' % result.inputFilePath)
+      logging.warning('Error message: %s' % (str(result.error)))
+    progress = self._batchProgress
+    if progress is not None:
+      if progress.discoveryComplete:
+        self.ui.ModifyAllProgressBar.setRange(0, max(progress.filesDiscovered, 1))
+        self.ui.ModifyAllProgressBar.value = progress.filesDone
+      statusText = '%i files done (%.1f files/s), %i failed' % (progress.filesDone, progress.filesPerSecond, progress.filesFailed)
+      if progress.etaSeconds is not None:
+        statusText += ', %s remaining' % _formatDuration(progress.etaSeconds)
+      if self._batchCancelEvent.is_set():
+        statusText += ' - canceling...'
+      self.ui.ModifyAllStatusLabel.text = statusText
+    if self._batchThread.is_alive():
+      return
+    # Batch finished
+    self._batchTimer.stop()
+    self._batchTimer = None
+    self._batchThread = None
+    self.ui.ModifyAllPushButton.enabled = True
+    self.ui.ModifySinglePushButton.enabled = True
+    self.ui.CancelModifyAllPushButton.enabled = False
+    self.ui.ModifyAllProgressBar.setRange(0, 1)
+    self.ui.ModifyAllProgressBar.value = 1
+    resultCounts = self._batchResultCounts
+    summary = '%s %i files, %i unchanged, skipped %i non-DICOM files, %i failed.' % (
+      'Would modify' if self._batchDryRun else 'Modified', resultCounts['modified'] + resultCounts['wouldModify'],
+      resultCounts['unchanged'], resultCounts['skipped'], resultCounts['failed'])
+    if self._batchCancelEvent.is_set():
+      summary = 'Canceled. ' + summary
+    self.ui.ModifyAllStatusLabel.text = summary
+    logging.info(summary)
+    if self.lastModifyAllReport.elapsedSeconds is not None:
+      logging.info('\n'.join(self.lastModifyAllReport.formatSummary()))
+    if self._batchDryRun:
+      logging.info('Dry run, nothing was written.  The changes of every file are in %s' % self.lastDiffReportPath)
+    if self._batchModifiedFilePaths:
+      # Also after an error or canceling, for the files which were modified
+      self.ui.ModifyAllStatusLabel.text = summary + ' Updating the DICOM database...'
+      slicer.app.processEvents()
+      try:
+        reindexedCount = self.logic.updateDicomDatabase(self._batchModifiedFilePaths)
+        logging.info('Re-indexed %i files in the DICOM database' % reindexedCount)
+      except Exception as err:
+        logging.error('Updating the DICOM database failed: %s' % str(err))
+      self.ui.ModifyAllStatusLabel.text = summary
+      self._batchModifiedFilePaths = None
+    if self._batchError is not None:
+      slicer.util.errorDisplay('DICOM modification stopped because of an error: %s' % str(self._batchError))
+
+  def onCancelModifyAllPushButtonClick(self):
+    '''Stop dispatching files, the files already being modified are finished'''
+    if self._batchCancelEvent is not None:
+      self._batchCancelEvent.set()
+      self.ui.CancelModifyAllPushButton.enabled = False
 
 
   def onModifySinglePushButtonClick(self):
@@ -219,18 +402,30 @@ class DICOM_ModifyWidget(ScriptedLoadableModuleWidget, VTKObservationMixin):
       logging.debug('Canceled modify all because selected file was not a valid DICOM file.')
       return
     # Deterimine the output directory (i.e. same for overwrite, or specified other directory)
-    outputDirectory = self.getOutputDirectory()
+    outputDirectory = self.getOutputDirectoryForModifySingle()
     if outputDirectory=='':
       slicer.util.warningDisplay('The selected output directory is empty! Canceling...')
       return
     _, selectedFileName = os.path.split(selectedFile)
     outputFilePath = os.path.join(outputDirectory, selectedFileName)
-    # Gather Tags to modify
-    tagNumDict = self.gatherTagNumDict()
-    tagNameDict = self.gatherTagNameDict()
-    # TODO: Validate these tags before actually running any modification?
+    # Gather Tags to modify, and validate them before actually running any modification
+    editPlan = self.compileEditPlan()
+    if editPlan is None:
+      return
+    if self.ui.DryRunCheckBox.checked:
+      changes, err = self.logic.previewDicomFile(selectedFile, editPlan=editPlan)
+      if changes is None:
+        slicer.util.errorDisplay('Dry run failed for %s: %s' % (selectedFile, str(err)))
+        return
+      result = ModifyResult(selectedFile, outputFilePath, True, None, 'wouldModify' if changes else 'unchanged',
+        changes=changes)
+      slicer.util.infoDisplay('\n'.join(formatChanges(result)), windowTitle='Dry run')
+      return
     # Run the modification
-    successFlag, err = self.logic.modifyDicomFile(selectedFile, outputFilePath, tagNameDict, tagNumDict)
+    headerOnly = self.ui.HeaderOnlyCheckBox.checked
+    successFlag, err = self.logic.modifyDicomFile(selectedFile, outputFilePath, headerOnly=headerOnly, editPlan=editPlan)
+    if editPlan.uidMap is not None:
+      editPlan.uidMap.flush()
     if not successFlag:
       logging.warning('DICOM file modification failed for %s'%selectedFile)
       logging.warning('Error message: %s' % (str(err)))
@@ -240,8 +435,7 @@ class DICOM_ModifyWidget(ScriptedLoadableModuleWidget, VTKObservationMixin):
     '''Determine output directory based on radio button selections'''
     if self.ui.OverwriteRadioButton.checked:
       # Overwrite in place, return the input directory as the output directory
-      selectedFile = self.ui.InputDICOMFolderPathLineEdit.currentPath
-      outputDirectory = os.path.dirname(selectedFile)
+      outputDirectory = self.ui.InputDICOMFolderPathLineEdit.currentPath
     else:
       # Write modified files to a new directory, as specified
       outputDirectory = self.ui.OutputDICOMFolderPathLineEdit.currentPath # is '' if not selected
@@ -257,6 +451,42 @@ class DICOM_ModifyWidget(ScriptedLoadableModuleWidget, VTKObservationMixin):
       outputDirectory = self.ui.OutputDICOMSinglePathLineEdit.currentPath # is '' if not selected
     return outputDirectory
     
+  def compileEditPlan(self):
+    '''Gather the tag edits from the GUI and compile them into an edit plan.  Returns None (after
+    telling the user why) if any of them is invalid.
+    '''
+    remapUIDKeywords = DEFAULT_REMAP_KEYWORDS if self.ui.RemapUIDsCheckBox.checked else ()
+    try:
+      profile = self.getProfile()
+      return self.logic.compileEditPlan(self.gatherTagNameDict(), self.gatherTagNumDict(), remapUIDKeywords,
+        self.getUIDMap() if remapUIDKeywords or profile is not None else None, profile)
+    except ValueError as err:
+      slicer.util.warningDisplay('Invalid tag modification: %s  Canceling...' % str(err))
+      return None
+    except OSError as err:
+      slicer.util.warningDisplay('Can\'t read the profile rules file: %s  Canceling...' % str(err))
+      return None
+
+  def getProfile(self):
+    '''The de-identification Profile selected in the GUI, or None'''
+    profileName = self.ui.ProfileComboBox.currentText
+    if profileName == 'None':
+      return None
+    if profileName == 'Rules file':
+      return Profile.fromName(self.ui.ProfileRulesPathLineEdit.currentPath)
+    return Profile.fromName(profileName)
+
+  def onProfileComboBoxChanged(self, profileName):
+    self.ui.ProfileRulesPathLineEdit.enabled = profileName == 'Rules file'
+
+  def getUIDMap(self):
+    '''The UID map kept in the cache, so that files modified in separate runs get consistent new UIDs'''
+    if self._uidMap is None:
+      mapPath = os.path.join(slicer.app.cachePath, 'DICOM_Modify', 'UIDMap.jsonl')
+      os.makedirs(os.path.dirname(mapPath), exist_ok=True)
+      self._uidMap = UIDMap(mapPath)
+    return self._uidMap
+
   def gatherTagNameDict(self):
     '''Gather tag names and new values from GUI into a dictionary'''
     tagNames = [getattr(self.ui,'TagName%i'%idx).text for idx in range(5)]
@@ -306,6 +536,10 @@ class DICOM_ModifyWidget(ScriptedLoadableModuleWidget, VTKObservationMixin):
     Called when the application closes and the module widget is destroyed.
     """
     self.removeObservers()
+    if self._batchCancelEvent is not None:
+      self._batchCancelEvent.set()
+    if self._uidMap is not None:
+      self._uidMap.close()
 
   def enter(self):
     """
@@ -431,16 +665,22 @@ class DICOM_ModifyWidget(ScriptedLoadableModuleWidget, VTKObservationMixin):
 
   '''
 
+def _formatDuration(seconds):
+  '''Format a number of seconds as h:mm:ss'''
+  return time.strftime('%H:%M:%S', time.gmtime(seconds)) if seconds < 86400 else '%.1f days' % (seconds / 86400)
+
 #
 # DICOM_ModifyLogic
 #
 
-class DICOM_ModifyLogic(ScriptedLoadableModuleLogic):
+class DICOM_ModifyLogic(ScriptedLoadableModuleLogic, ModifyLogic):
   """This class should implement all the actual
   computation done by your module.  The interface
   should be such that other python code can import
   this class and make use of the functionality without
   requiring an instance of the Widget.
+  All the DICOM modification is implemented in DICOM_ModifyLib.ModifyLogic, which does not
+  depend on Slicer (see DICOM_ModifyLib/__main__.py for running it from the command line).
   Uses ScriptedLoadableModuleLogic base class, available at:
   https://github.com/Slicer/Slicer/blob/master/Base/Python/slicer/ScriptedLoadableModule.py
   """
@@ -450,6 +690,40 @@ class DICOM_ModifyLogic(ScriptedLoadableModuleLogic):
     Called when the logic class is instantiated. Can be used for initializing member variables.
     """
     ScriptedLoadableModuleLogic.__init__(self)
+    ModifyLogic.__init__(self)
+    # Batch worker processes are spawned (see ModifyLogic), and must run Slicer's Python interpreter,
+    # not the Slicer application (sys.executable).  PythonSlicer is on the PATH in Slicer.
+    self.workerExecutable = shutil.which('PythonSlicer')
+
+  def updateDicomDatabase(self, filePaths, database=None, batchSize=500):
+    '''Re-index files modified in place in Slicer's DICOM database (by default slicer.dicomDatabase),
+    so that its tables and tag cache have the new tag values, without re-importing whole folders.
+    Files which are not in the database are ignored.  As the modification may have changed their
+    UIDs, each series with modified files is removed from the database with its cached tags (not
+    its files), and all its files are indexed again, for batchSize modified files at a time.
+    Returns the number of files re-indexed.
+    '''
+    if database is None:
+      database = slicer.dicomDatabase
+    if database is None or not database.isOpen:
+      logging.warning('No DICOM database is open, it is not updated')
+      return 0
+    indexer = ctk.ctkDICOMIndexer()
+    indexedFilePaths = set()
+    filePaths = [os.path.abspath(filePath).replace(os.sep, '/') for filePath in filePaths] # as stored by Qt
+    for batchStart in range(0, len(filePaths), batchSize):
+      batch = [filePath for filePath in filePaths[batchStart:batchStart + batchSize] if filePath not in indexedFilePaths]
+      seriesUIDs = set(database.seriesForFile(filePath) for filePath in batch)
+      seriesUIDs.discard('')
+      filesToIndex = []
+      for seriesUID in sorted(seriesUIDs):
+        filesToIndex.extend(filePath for filePath in database.filesForSeries(seriesUID) if filePath not in indexedFilePaths)
+        database.removeSeries(seriesUID, True, False)
+      if filesToIndex:
+        indexer.addListOfFiles(database, filesToIndex)
+        indexer.waitForImportFinished()
+        indexedFilePaths.update(filesToIndex)
+    return len(indexedFilePaths)
 
   '''PARAMNODE
   def setDefaultParameters(self, parameterNode):
@@ -461,65 +735,7 @@ class DICOM_ModifyLogic(ScriptedLoadableModuleLogic):
     if not parameterNode.GetParameter("Invert"):
       parameterNode.SetParameter("Invert", "false")
   '''
-  def convertTagValueString(self, tagValueString):
-    """ Convert to list if in brackets, otherwise return unchanged
-    """
-    import re
-    patt = re.compile("^\w*\[(.*)]\w*")
-    m = patt.fullmatch(tagValueString)
-    if m:
-      # Split into a list of strings for multi-valued DICOM element
-      values = m[1].split(',') # split list elements by commas
-      tagValue = [v.strip() for v in values] # strip any extra whitespace around list elements
-    else:
-      # Not a multi-valued tag string, just return unmodified string (this is correct for numerical values as well)
-      tagValue = tagValueString
-    return tagValue
-
-  def isValidDICOMFile(self, filePath):
-    #TODO TODO write a minimal check that the supplied file looks like a dicom file
-    return True
-
-  def modifyDicomFile(self, inputFilePath, outputFilePath, tagNameDict={}, tagNumDict={}):
-    '''Do the actual modification'''
-    try: 
-      ds = pydicom.dcmread(inputFilePath)
-      for tag, val in tagNumDict.items():
-        ds[tag].value = val
-      for tag, val in tagNameDict.items():
-        setattr(ds, tag, val)
-        # NOTE: ds[tag].value = val will work IFF ds already has tag, but throws error if it doesn't,
-        # while the alternative setattr method works either way. 
-      # Ensure the folder to contain the output file exists (save_as will not create it!)
-      dirPath, fileName = os.path.split(outputFilePath)
-      os.makedirs(dirPath, exist_ok=True) # create folder and any needed parents, don't throw error if it already exists
-      # Save the output file
-      ds.save_as(outputFilePath)
-      return True, None
-    except Exception as err:
-      return False, err
 
-  def getListOfFiles(self, dirName, recursive=False):
-    ''' Get a list of all files in a directory. Include files in subdirectories
-    if recursive flag is set to True (default is False)
-    '''
-    # create a list of file and sub directories 
-    # names in the given directory 
-    listOfFile = os.listdir(dirName)
-    allFiles = list()
-    # Iterate over all the entries
-    for entry in listOfFile:
-        # Create full path
-        fullPath = os.path.join(dirName, entry)
-        # If entry is a directory then get the list of files in this directory 
-        if os.path.isdir(fullPath) and recursive:
-            allFiles = allFiles + self.getListOfFiles(fullPath)
-        else:
-            allFiles.append(fullPath)
-                
-    return allFiles        
-    
-    
 
 #
 # DICOM_ModifyTest
@@ -536,55 +752,945 @@ class DICOM_ModifyTest(ScriptedLoadableModuleTest):
     """ Do whatever is needed to reset the state - typically a scene clear will be enough.
     """
     slicer.mrmlScene.Clear()
+    self.testDir = os.path.join(slicer.app.temporaryPath, 'DICOM_ModifyTest')
+    if os.path.isdir(self.testDir):
+      shutil.rmtree(self.testDir)
+    # A few small DICOM files mixed with junk files (see DICOM_ModifyLib/SyntheticData.py)
+    self.corpus = generateCorpus(os.path.join(self.testDir, 'input'), 'mixedJunk', scale=0.02)
 
   def runTest(self):
     """Run as few or as many tests as needed here.
     """
     self.setUp()
-    self.test_DICOM_Modify1()
+    self.test_ModifySingleFile()
+    self.setUp()
+    self.test_EditPlan()
+    self.setUp()
+    self.test_FileDiscovery()
+    self.setUp()
+    self.test_ValidityProbe()
+    self.setUp()
+    self.test_ModifyAll()
+    self.setUp()
+    self.test_ModifyAllResultOrder()
+    self.setUp()
+    self.test_BatchProgress()
+    self.setUp()
+    self.test_BatchReport()
+    self.setUp()
+    self.test_CommandLine()
+    self.setUp()
+    self.test_ModifyHeaderOnly()
+    self.setUp()
+    self.test_StreamingThreshold()
+    self.setUp()
+    self.test_PipelinedBatch()
+    self.setUp()
+    self.test_ModifyAllInPlace()
+    self.setUp()
+    self.test_SkipUnchanged()
+    self.setUp()
+    self.test_InPlacePatch()
+    self.setUp()
+    self.test_AtomicWrite()
+    self.setUp()
+    self.test_ModifyAllFiltered()
+    self.setUp()
+    self.test_RemapUIDs()
+    self.setUp()
+    self.test_ModifyArchive()
+    self.setUp()
+    self.test_ApplyProfile()
+    self.setUp()
+    self.test_UndoRollback()
+    self.setUp()
+    self.test_ShardedBatch()
+    self.setUp()
+    self.test_UpdateDicomDatabase()
+    self.setUp()
+    self.test_DryRun()
+    self.setUp()
+    self.test_ResumeJournal()
+    self.setUp()
+    self.test_ResumeRemap()
+
+  def test_ModifySingleFile(self):
+    """ Modify one file into an output folder, with a full rewrite, header only, and streamed
+    as a large file would be, and check that invalid tag names are rejected before anything is written.
+    """
+    self.delayDisplay("Starting the test")
+    logic = DICOM_ModifyLogic()
+    inputFilePath = self.corpus.filePaths[0]
+    self.assertTrue(logic.isValidDICOMFile(inputFilePath))
+    for headerOnly, streamingThreshold in [(False, None), (True, None), (False, 0)]:
+      outputFilePath = os.path.join(self.testDir, 'output%i%s' % (headerOnly, streamingThreshold), 'IM1.dcm')
+      successFlag, err = logic.modifyDicomFile(inputFilePath, outputFilePath, tagNameDict={'PatientID': 'TEST01'},
+        tagNumDict={(0x0008, 0x103E): 'Modified series'}, headerOnly=headerOnly, streamingThreshold=streamingThreshold)
+      self.assertTrue(successFlag, err)
+      inputDs = pydicom.dcmread(inputFilePath)
+      outputDs = pydicom.dcmread(outputFilePath)
+      self.assertEqual(outputDs.PatientID, 'TEST01')
+      self.assertEqual(outputDs.SeriesDescription, 'Modified series')
+      self.assertEqual(outputDs.PixelData, inputDs.PixelData)
+    # A keyword with an ambiguous VR ('US or SS') is added if missing, with the VR of the file
+    outputFilePath = os.path.join(self.testDir, 'outputAmbiguousVR', 'IM1.dcm')
+    self.assertNotIn('SmallestImagePixelValue', pydicom.dcmread(inputFilePath))
+    successFlag, err = logic.modifyDicomFile(inputFilePath, outputFilePath, {'SmallestImagePixelValue': '0'})
+    self.assertTrue(successFlag, err)
+    outputDs = pydicom.dcmread(outputFilePath)
+    self.assertEqual(outputDs.SmallestImagePixelValue, 0)
+    self.assertEqual(outputDs['SmallestImagePixelValue'].VR, 'SS' if outputDs.PixelRepresentation else 'US')
+    with self.assertRaises(ValueError):
+      logic.compileEditPlan({'NotADicomKeyword': '1'})
+    self.delayDisplay('Test passed')
+
+  def test_EditPlan(self):
+    """ Compile tag edits once: keywords are resolved, values converted for their VR, invalid edits
+    are rejected before any file is touched, and a batch does no more conversions per file.
+    """
+    self.delayDisplay("Starting the test")
+    logic = DICOM_ModifyLogic()
+    editPlan = logic.compileEditPlan({'PatientID': 'PLAN', 'ImageType': '[DERIVED, SECONDARY]', 'Rows': '64'},
+      {(0x0008, 0x103E): 'Planned'})
+    edits = {edit.tag: edit for edit in editPlan.edits}
+    self.assertEqual(edits[pydicom.tag.Tag('ImageType')].value, ['DERIVED', 'SECONDARY'])
+    self.assertEqual((edits[pydicom.tag.Tag('Rows')].VR, edits[pydicom.tag.Tag('Rows')].value), ('US', 64))
+    self.assertEqual(edits[pydicom.tag.Tag(0x0008, 0x103E)].value, 'Planned')
+    self.assertFalse(edits[pydicom.tag.Tag(0x0008, 0x103E)].createIfMissing)
+    self.assertEqual(editPlan.fingerprint, logic.compileEditPlan({'PatientID': 'PLAN', 'ImageType': '[DERIVED, SECONDARY]',
+      'Rows': '64'}, {(0x0008, 0x103E): 'Planned'}).fingerprint)
+    self.assertNotEqual(editPlan.fingerprint, logic.compileEditPlan({'PatientID': 'OTHER'}).fingerprint)
+    for tagNameDict, tagNumDict in [({'NotADicomKeyword': '1'}, {}), ({'Rows': 'many'}, {}), ({}, {'zz': '1'})]:
+      with self.assertRaises(ValueError):
+        logic.compileEditPlan(tagNameDict, tagNumDict)
+    # Invalid edits fail the batch before any file is written
+    inputDir = self.corpus.rootDir
+    outputDir = os.path.join(self.testDir, 'output')
+    with self.assertRaises(ValueError):
+      logic.modifyDicomFiles(logic.iterFilePathPairs(inputDir, outputDir, recursive=True), {'Rows': 'many'})
+    self.assertFalse(os.path.exists(outputDir))
+    # The package exports classes with the names of their modules, so the module is patched as an object
+    with unittest.mock.patch.object(sys.modules['DICOM_ModifyLib.EditPlan'], 'convertTagValueString') as convertTagValueString:
+      results = logic.modifyDicomFiles(logic.iterFilePathPairs(inputDir, outputDir, recursive=True), editPlan=editPlan,
+        numWorkers=1)
+    convertTagValueString.assert_not_called()
+    for result in results:
+      if result.status == 'modified':
+        outputDs = pydicom.dcmread(result.outputFilePath)
+        self.assertEqual((outputDs.PatientID, list(outputDs.ImageType), outputDs.Rows, outputDs.SeriesDescription),
+          ('PLAN', ['DERIVED', 'SECONDARY'], 64, 'Planned'))
+    self.assertEqual(collections.Counter(result.status for result in results)['modified'], self.corpus.dicomFileCount)
+    self.delayDisplay('Test passed')
+
+  def test_FileDiscovery(self):
+    """ List the files of a folder lazily: files which are obviously not DICOM are left out, subfolders
+    are only listed if recursive, and a subfolder which disappears during the walk is skipped.
+    """
+    self.delayDisplay("Starting the test")
+    logic = DICOM_ModifyLogic()
+    treeDir = os.path.join(self.testDir, 'tree')
+    for relativePath in ['a.dcm', 'notes.txt', '.hidden', os.path.join('sub', 'b.dcm'), os.path.join('gone', 'c.dcm')]:
+      filePath = os.path.join(treeDir, relativePath)
+      os.makedirs(os.path.dirname(filePath), exist_ok=True)
+      with open(filePath, 'wb'):
+        pass
+    def relativePaths(filePaths):
+      return sorted(os.path.relpath(filePath, treeDir) for filePath in filePaths)
+    self.assertEqual(relativePaths(logic.iterFilePaths(treeDir)), ['a.dcm'])
+    self.assertEqual(relativePaths(logic.iterFilePaths(treeDir, recursive=True)),
+      ['a.dcm', os.path.join('gone', 'c.dcm'), os.path.join('sub', 'b.dcm')])
+    self.assertEqual(len(logic.getListOfFiles(treeDir, recursive=True)), 5)
+    outputDir = os.path.join(self.testDir, 'output')
+    self.assertIn((os.path.join(treeDir, 'sub', 'b.dcm'), os.path.join(outputDir, 'sub', 'b.dcm')),
+      list(logic.iterFilePathPairs(treeDir, outputDir, recursive=True)))
+    # Subfolders are listed after the files of their parent
+    filePaths = logic.iterFilePaths(treeDir, recursive=True)
+    self.assertEqual(next(filePaths), os.path.join(treeDir, 'a.dcm'))
+    shutil.rmtree(os.path.join(treeDir, 'gone'))
+    self.assertEqual(relativePaths(filePaths), [os.path.join('sub', 'b.dcm')])
+    self.delayDisplay('Test passed')
+
+  def test_ValidityProbe(self):
+    """ Check which files the quick DICOM probe accepts, with and without allowNoPreamble, that a batch
+    skips the files it rejects without parsing them, and that cached results follow changes to the files.
+    """
+    self.delayDisplay("Starting the test")
+    logic = DICOM_ModifyLogic()
+    inputDir = self.corpus.rootDir
+    dicomFilePaths = self.corpus.filePaths[:self.corpus.dicomFileCount]
+    junkFilePaths = self.corpus.filePaths[self.corpus.dicomFileCount:]
+    noPreambleFilePaths = [filePath for filePath in junkFilePaths if os.path.basename(filePath).startswith('nopreamble')]
+    self.assertGreater(len(noPreambleFilePaths), 0)
+    for filePath in dicomFilePaths:
+      self.assertTrue(logic.isValidDICOMFile(filePath))
+    for filePath in junkFilePaths:
+      self.assertFalse(logic.isValidDICOMFile(filePath))
+    for filePath in noPreambleFilePaths:
+      self.assertTrue(logic.isValidDICOMFile(filePath, allowNoPreamble=True))
+    for filePath in junkFilePaths:
+      if filePath.endswith('.txt') or os.path.getsize(filePath) == 0:
+        self.assertFalse(logic.isValidDICOMFile(filePath, allowNoPreamble=True))
+    self.assertFalse(logic.isValidDICOMFile(os.path.join(inputDir, 'missing.dcm')))
+    # Rejected files are never parsed
+    with unittest.mock.patch('pydicom.dcmread', wraps=pydicom.dcmread) as dcmread:
+      results = logic.modifyDicomFiles(logic.iterFilePathPairs(inputDir, inputDir, recursive=True), {'PatientID': 'PROBED'},
+        numWorkers=1)
+    readFilePaths = set(getattr(call.args[0], 'name', call.args[0]) for call in dcmread.call_args_list)
+    self.assertEqual(readFilePaths, set(dicomFilePaths))
+    for result in results:
+      self.assertEqual(result.status, 'modified' if result.inputFilePath in dicomFilePaths else 'skipped')
+    # Files without preamble are modified if allowed
+    results = logic.modifyDicomFiles([(filePath, filePath) for filePath in noPreambleFilePaths], {'PatientID': 'PROBED'},
+      numWorkers=1, allowNoPreamble=True)
+    for result in results:
+      self.assertEqual(result.status, 'modified', result.error)
+      self.assertEqual(pydicom.dcmread(result.inputFilePath, force=True).PatientID, 'PROBED')
+    # Results are cached by path, size and modification time, so a file which changes is probed again
+    emptyFilePath = next(filePath for filePath in junkFilePaths if os.path.getsize(filePath) == 0)
+    self.assertFalse(logic.isValidDICOMFile(emptyFilePath))
+    shutil.copyfile(dicomFilePaths[0], emptyFilePath)
+    self.assertTrue(logic.isValidDICOMFile(emptyFilePath))
+    self.delayDisplay('Test passed')
+
+  def test_ModifyAll(self):
+    """ Modify a folder of files into an output folder; junk files are skipped, and a second
+    (pipelined) run with the same edits finds nothing to change.
+    """
+    self.delayDisplay("Starting the test")
+    logic = DICOM_ModifyLogic()
+    inputDir = self.corpus.rootDir
+    outputDir = os.path.join(self.testDir, 'output')
+    filePathPairs = logic.iterFilePathPairs(inputDir, outputDir, recursive=True)
+    results = logic.modifyDicomFiles(filePathPairs, {'PatientName': 'Test^Patient'}, numWorkers=2)
+    statusCounts = collections.Counter(result.status for result in results)
+    self.assertEqual(statusCounts['modified'], self.corpus.dicomFileCount)
+    self.assertEqual(statusCounts['failed'], 0)
+    self.assertGreater(statusCounts['skipped'], 0)
+    for result in results:
+      if result.status == 'modified':
+        self.assertEqual(str(pydicom.dcmread(result.outputFilePath).PatientName), 'Test^Patient')
+    filePathPairs = logic.iterFilePathPairs(outputDir, outputDir, recursive=True)
+    results = logic.modifyDicomFiles(filePathPairs, {'PatientName': 'Test^Patient'}, pipelined=True)
+    self.assertEqual(collections.Counter(result.status for result in results)['unchanged'], self.corpus.dicomFileCount)
+    self.delayDisplay('Test passed')
+
+  def test_ModifyAllResultOrder(self):
+    """ Modify a list of files in small chunks across worker processes, and check that there is a
+    result for every file, in input order, and that failures are reported with their error.
+    """
+    self.delayDisplay("Starting the test")
+    logic = DICOM_ModifyLogic()
+    inputDir = self.corpus.rootDir
+    outputDir = os.path.join(self.testDir, 'output')
+    filePathPairs = list(logic.iterFilePathPairs(inputDir, outputDir, recursive=True))
+    filePathPairs.insert(3, (os.path.join(inputDir, 'missing.dcm'), os.path.join(outputDir, 'missing.dcm')))
+    results = logic.modifyDicomFiles(filePathPairs, {'PatientID': 'ORDERED'}, numWorkers=2, chunkSize=2,
+      skipInvalidFiles=False)
+    self.assertEqual([(result.inputFilePath, result.outputFilePath) for result in results], filePathPairs)
+    self.assertEqual(results[3].status, 'failed')
+    self.assertIsInstance(results[3].error, FileNotFoundError)
+    statusCounts = collections.Counter(result.status for result in results)
+    self.assertEqual(statusCounts['modified'], self.corpus.dicomFileCount)
+    self.assertEqual(statusCounts['failed'], len(filePathPairs) - self.corpus.dicomFileCount)
+    for result in results:
+      self.assertEqual(result.success, result.error is None)
+      if result.status == 'modified':
+        self.assertEqual(pydicom.dcmread(result.outputFilePath).PatientID, 'ORDERED')
+    self.delayDisplay('Test passed')
+
+  def test_BatchProgress(self):
+    """ Run a batch in a background thread as the widget does, following its progress through the
+    callback, and cancel batches after their first result: the files already dispatched are finished,
+    and no more are started.
+    """
+    self.delayDisplay("Starting the test")
+    logic = DICOM_ModifyLogic()
+    logic.progressInterval = 0
+    inputDir = self.corpus.rootDir
+    filesTotal = len(list(logic.iterFilePathPairs(inputDir, inputDir, recursive=True)))
+    progresses = []
+    results = []
+    batchThread = threading.Thread(target=lambda: results.extend(logic.iterModifyDicomFiles(
+      logic.iterFilePathPairs(inputDir, inputDir, recursive=True), {'PatientID': 'PROGRESS'}, numWorkers=1, chunkSize=2,
+      progressCallback=progresses.append)))
+    batchThread.start()
+    batchThread.join()
+    self.assertEqual(len(results), filesTotal)
+    self.assertEqual(progresses[0].filesDone, 0)
+    self.assertEqual([progress.filesDone for progress in progresses], sorted(progress.filesDone for progress in progresses))
+    lastProgress = progresses[-1]
+    self.assertTrue(lastProgress.discoveryComplete)
+    self.assertEqual((lastProgress.filesDone, lastProgress.filesDiscovered, lastProgress.filesFailed), (filesTotal, filesTotal, 0))
+    self.assertEqual(lastProgress.etaSeconds, 0)
+    self.assertEqual(_formatDuration(3725), '01:02:05')
+    for numWorkers in [1, 2]:
+      cancelEvent = threading.Event()
+      results = []
+      for result in logic.iterModifyDicomFiles(logic.iterFilePathPairs(inputDir, inputDir, recursive=True),
+          {'PatientID': 'CANCELED'}, numWorkers=numWorkers, chunkSize=2, cancelEvent=cancelEvent):
+        cancelEvent.set()
+        results.append(result)
+      self.assertGreater(len(results), 0)
+      self.assertLess(len(results), filesTotal)
+      for result in results:
+        self.assertNotEqual(result.status, 'failed')
+        if result.status == 'modified':
+          self.assertEqual(pydicom.dcmread(result.outputFilePath).PatientID, 'CANCELED')
+    self.delayDisplay('Test passed')
 
-  def test_DICOM_Modify1(self):
-    """ Ideally you should have several levels of tests.  At the lowest level
-    tests should exercise the functionality of the logic with different inputs
-    (both valid and invalid).  At higher levels your tests should emulate the
-    way the user would interact with your code and confirm that it still works
-    the way you intended.
-    One of the most important features of the tests is that it should alert other
-    developers when their changes will have an impact on the behavior of your
-    module.  For example, if a developer removes a feature that you depend on,
-    your test should break so they know that the feature is needed.
+  def test_BatchReport(self):
+    """ Time the phases of a batch across worker processes, and check the report's counts, bytes and
+    failures, and its JSON and CSV exports.  Without a report, nothing is timed.
     """
+    self.delayDisplay("Starting the test")
+    logic = DICOM_ModifyLogic()
+    inputDir = self.corpus.rootDir
+    outputDir = os.path.join(self.testDir, 'output')
+    report = BatchReport()
+    results = logic.modifyDicomFiles(logic.iterFilePathPairs(inputDir, outputDir, recursive=True), {'PatientID': 'REPORT'},
+      numWorkers=2, chunkSize=4, skipInvalidFiles=False, report=report)
+    modifiedResults = [result for result in results if result.status == 'modified']
+    failedCount = len(results) - len(modifiedResults)
+    self.assertEqual(len(modifiedResults), self.corpus.dicomFileCount)
+    self.assertEqual(report.statusCounts, collections.Counter(modified=len(modifiedResults), failed=failedCount))
+    self.assertEqual(sum(count for count, examples in report.failures.values()), failedCount)
+    self.assertEqual(report.phaseStatistics('write')['count'], len(modifiedResults))
+    self.assertGreaterEqual(report.phaseStatistics('read')['count'], len(modifiedResults))
+    self.assertEqual(report.phaseStatistics('discovery')['count'], 1)
+    self.assertEqual(report.bytesOut, sum(os.path.getsize(result.outputFilePath) for result in modifiedResults))
+    self.assertGreaterEqual(report.bytesIn, sum(os.path.getsize(result.inputFilePath) for result in modifiedResults))
+    jsonPath = os.path.join(self.testDir, 'report.json')
+    report.write(jsonPath)
+    with open(jsonPath, 'r', encoding='utf-8') as jsonFile:
+      reportDict = json.load(jsonFile)
+    self.assertEqual(reportDict['filesTotal'], len(results))
+    self.assertEqual(reportDict['files'], {'modified': len(modifiedResults), 'failed': failedCount})
+    self.assertEqual(sum(failure['count'] for failure in reportDict['failures'].values()), failedCount)
+    self.assertEqual(reportDict['phases']['write']['count'], len(modifiedResults))
+    csvPath = os.path.join(self.testDir, 'report.csv')
+    report.write(csvPath)
+    with open(csvPath, 'r', newline='', encoding='utf-8') as csvFile:
+      rows = list(csv.DictReader(csvFile))
+    self.assertEqual([row['phase'] for row in rows], list(reportDict['phases']))
+    self.assertEqual(int(next(row for row in rows if row['phase'] == 'write')['count']), len(modifiedResults))
+    results = logic.modifyDicomFiles(logic.iterFilePathPairs(inputDir, outputDir, recursive=True), {'PatientID': 'REPORT'},
+      numWorkers=1)
+    self.assertEqual([result.metrics for result in results], [None] * len(results))
+    self.delayDisplay('Test passed')
 
+  def test_CommandLine(self):
+    """ Modify a folder with the command line entry point, and check that the modification logic can be
+    imported without any of the Slicer modules.
+    """
     self.delayDisplay("Starting the test")
+    logic = DICOM_ModifyLogic()
+    inputDir = self.corpus.rootDir
+    outputDir = os.path.join(self.testDir, 'output')
+    exitCode = runCommandLine([inputDir, '--output-dir', outputDir, '--recursive', '--workers', '2',
+      '--tag', 'PatientID=CLI', '--tag-num', '0008,103E=Command line'])
+    self.assertEqual(exitCode, 0)
+    outputFilePaths = [os.path.join(outputDir, os.path.relpath(filePath, inputDir))
+      for filePath in self.corpus.filePaths[:self.corpus.dicomFileCount]]
+    for outputFilePath in outputFilePaths:
+      outputDs = pydicom.dcmread(outputFilePath)
+      self.assertEqual((outputDs.PatientID, outputDs.SeriesDescription), ('CLI', 'Command line'))
+    self.assertEqual(runCommandLine([inputDir, '--overwrite', '--tag', 'NotADicomKeyword=1']), 2)
+    self.assertEqual(runCommandLine([inputDir, '--overwrite']), 2)
+    script = 'import sys, DICOM_ModifyLib.__main__; sys.exit(", ".join(sorted({"ctk", "qt", "slicer", "vtk"} & set(sys.modules))) or None)'
+    process = subprocess.run([logic.workerExecutable or sys.executable, '-c', script],
+      cwd=os.path.dirname(os.path.abspath(__file__)), stdout=subprocess.PIPE, stderr=subprocess.PIPE, universal_newlines=True)
+    self.assertEqual(process.returncode, 0, process.stderr)
+    self.delayDisplay('Test passed')
 
-    # Get/create input data
+  def test_ModifyHeaderOnly(self):
+    """ Modify files header only, and check that only the header is parsed and the pixel data is
+    copied to the output byte for byte.
+    """
+    self.delayDisplay("Starting the test")
+    logic = DICOM_ModifyLogic()
+    inputDir = self.corpus.rootDir
+    outputDir = os.path.join(self.testDir, 'output')
+    with unittest.mock.patch('pydicom.dcmread', wraps=pydicom.dcmread) as dcmread:
+      results = logic.modifyDicomFiles(logic.iterFilePathPairs(inputDir, outputDir, recursive=True),
+        {'PatientID': 'HEADER', 'SeriesDescription': 'Header only'}, numWorkers=1, headerOnly=True, streamingThreshold=None)
+    self.assertGreater(dcmread.call_count, 0)
+    for call in dcmread.call_args_list:
+      self.assertTrue(call.kwargs.get('stop_before_pixels'))
+    self.assertEqual(collections.Counter(result.status for result in results)['modified'], self.corpus.dicomFileCount)
+    pixelDataTagBytes = b'\xe0\x7f\x10\x00'
+    for result in results:
+      if result.status != 'modified':
+        continue
+      outputDs = pydicom.dcmread(result.outputFilePath)
+      self.assertEqual(outputDs.PatientID, 'HEADER')
+      self.assertEqual(outputDs.SeriesDescription, 'Header only')
+      with open(result.inputFilePath, 'rb') as inputFile, open(result.outputFilePath, 'rb') as outputFile:
+        inputContent, outputContent = inputFile.read(), outputFile.read()
+      pixelDataOffset = inputContent.rfind(pixelDataTagBytes)
+      self.assertGreater(pixelDataOffset, 0)
+      self.assertTrue(outputContent.endswith(inputContent[pixelDataOffset:]))
+    self.delayDisplay('Test passed')
 
-    import SampleData
-    registerSampleData()
-    inputVolume = SampleData.downloadSample('DICOM_Modify1')
-    self.delayDisplay('Loaded test data set')
+  def test_StreamingThreshold(self):
+    """ Files of at least the streaming threshold are modified header only, the rest of the file being
+    copied in chunks, by the OS or, where it can't, through Python; smaller files are read whole.
+    """
+    self.delayDisplay("Starting the test")
+    logic = DICOM_ModifyLogic()
+    inputFilePath = self.corpus.filePaths[0]
+    fileSize = os.path.getsize(inputFilePath)
+    inputDs = pydicom.dcmread(inputFilePath)
+    modifyLogicModule = sys.modules[ModifyLogic.__module__]
+    for streamingThreshold, kernelCopyFunctions in [(fileSize, None), (fileSize, []), (fileSize + 1, None)]:
+      outputFilePath = os.path.join(self.testDir, 'output%i%s' % (streamingThreshold, kernelCopyFunctions), 'IM1.dcm')
+      patches = [unittest.mock.patch.object(modifyLogicModule, '_copyFileTail', wraps=modifyLogicModule._copyFileTail),
+        unittest.mock.patch.object(modifyLogicModule, '_KERNEL_COPY_CHUNK_SIZE', 1000),
+        unittest.mock.patch.object(modifyLogicModule, '_COPY_CHUNK_SIZE', 1000)]
+      if kernelCopyFunctions is not None:
+        patches.append(unittest.mock.patch.object(modifyLogicModule, '_KERNEL_COPY_FUNCTIONS', kernelCopyFunctions))
+      with contextlib.ExitStack() as patchStack:
+        copyFileTail = patchStack.enter_context(patches[0])
+        for patch in patches[1:]:
+          patchStack.enter_context(patch)
+        success, err = logic.modifyDicomFile(inputFilePath, outputFilePath, {'PatientID': 'STREAMED'},
+          streamingThreshold=streamingThreshold)
+      self.assertTrue(success, err)
+      self.assertEqual(copyFileTail.call_count, 1 if streamingThreshold <= fileSize else 0)
+      outputDs = pydicom.dcmread(outputFilePath)
+      self.assertEqual(outputDs.PatientID, 'STREAMED')
+      self.assertEqual(outputDs.PixelData, inputDs.PixelData)
+    self.delayDisplay('Test passed')
 
-    inputScalarRange = inputVolume.GetImageData().GetScalarRange()
-    self.assertEqual(inputScalarRange[0], 0)
-    self.assertEqual(inputScalarRange[1], 695)
+  def test_PipelinedBatch(self):
+    """ Modify files with the pipelined stages: results come in input order even when an early read is
+    slow, and reading ahead stops while writes are stuck, so only a bounded number of files is in flight.
+    """
+    self.delayDisplay("Starting the test")
+    logic = DICOM_ModifyLogic()
+    inputDir = self.corpus.rootDir
+    outputDir = os.path.join(self.testDir, 'output')
+    filePathPairs = list(logic.iterFilePathPairs(inputDir, outputDir, recursive=True))
+    readDicomFileStage, writeDicomFileStage = logic.readDicomFileStage, logic.writeDicomFileStage
+    def slowFirstRead(inputFilePath, *args):
+      if inputFilePath == filePathPairs[0][0]:
+        time.sleep(0.2)
+      return readDicomFileStage(inputFilePath, *args)
+    logic.readDicomFileStage = slowFirstRead
+    results = logic.modifyDicomFiles(filePathPairs, {'PatientID': 'PIPELINE'}, pipelined=True, readThreads=3, writeThreads=2)
+    self.assertEqual([(result.inputFilePath, result.outputFilePath) for result in results], filePathPairs)
+    self.assertEqual(collections.Counter(result.status for result in results)['modified'], self.corpus.dicomFileCount)
+    for result in results:
+      if result.status == 'modified':
+        self.assertEqual(pydicom.dcmread(result.outputFilePath).PatientID, 'PIPELINE')
+    # Backpressure
+    writesReleased = threading.Event()
+    def stuckWrite(*args):
+      writesReleased.wait()
+      return writeDicomFileStage(*args)
+    logic.writeDicomFileStage = stuckWrite
+    takenFilePathPairs = []
+    def iterFilePathPairs():
+      for filePathPair in filePathPairs:
+        takenFilePathPairs.append(filePathPair)
+        yield filePathPair
+    results = []
+    batchThread = threading.Thread(target=lambda: results.extend(logic.iterModifyDicomFiles(iterFilePathPairs(),
+      {'PatientID': 'BACKPRESSURE'}, pipelined=True, readThreads=1, writeThreads=1)))
+    batchThread.start()
+    time.sleep(0.5)
+    # At most twice as many files as threads wait in each of the read and write queues, plus the one being edited
+    self.assertLessEqual(len(takenFilePathPairs), 2 * 1 + 2 * 1 + 1)
+    self.assertEqual(results, [])
+    writesReleased.set()
+    batchThread.join()
+    self.assertEqual([(result.inputFilePath, result.outputFilePath) for result in results], filePathPairs)
+    self.assertEqual(collections.Counter(result.status for result in results)['modified'], self.corpus.dicomFileCount)
+    self.delayDisplay('Test passed')
 
-    outputVolume = slicer.mrmlScene.AddNewNodeByClass("vtkMRMLScalarVolumeNode")
-    threshold = 100
+  def test_ModifyAllInPlace(self):
+    """ Overwrite a folder of files, with values which fit in place and values which don't, and a
+    copy hard linked to them, without changing them through the links.
+    """
+    self.delayDisplay("Starting the test")
+    logic = DICOM_ModifyLogic()
+    inputDir = self.corpus.rootDir
+    for patientID in ['SHORT', 'A much longer patient ID']:
+      filePathPairs = logic.iterFilePathPairs(inputDir, inputDir, recursive=True)
+      results = logic.modifyDicomFiles(filePathPairs, {'PatientID': patientID}, numWorkers=1)
+      self.assertEqual(collections.Counter(result.status for result in results)['modified'], self.corpus.dicomFileCount)
+      for result in results:
+        if result.status == 'modified':
+          self.assertEqual(pydicom.dcmread(result.inputFilePath).PatientID, patientID)
+    linkedDir = os.path.join(self.testDir, 'linked')
+    logic.modifyDicomFiles(logic.iterFilePathPairs(inputDir, linkedDir, recursive=True), {'PatientID': patientID},
+      numWorkers=1, linkUnchanged=True)
+    results = logic.modifyDicomFiles(logic.iterFilePathPairs(linkedDir, linkedDir, recursive=True), {'PatientID': 'LINKED'},
+      numWorkers=1)
+    self.assertEqual(collections.Counter(result.status for result in results)['modified'], self.corpus.dicomFileCount)
+    for result in results:
+      if result.status == 'modified':
+        self.assertEqual(pydicom.dcmread(result.inputFilePath).PatientID, 'LINKED')
+        linkedFilePath = os.path.join(inputDir, os.path.relpath(result.inputFilePath, linkedDir))
+        self.assertEqual(pydicom.dcmread(linkedFilePath).PatientID, patientID)
+    self.delayDisplay('Test passed')
 
-    # Test the module logic
+  def test_SkipUnchanged(self):
+    """ Apply edits which change nothing: files are not written when overwriting, and copied, or hard
+    linked with linkUnchanged, to an output folder.
+    """
+    self.delayDisplay("Starting the test")
+    logic = DICOM_ModifyLogic()
+    inputDir = self.corpus.rootDir
+    dicomFilePaths = self.corpus.filePaths[:self.corpus.dicomFileCount]
+    tagNameDict = {'PatientID': 'SAME', 'StudyDescription': 'Same study'}
+    logic.modifyDicomFiles([(filePath, filePath) for filePath in dicomFilePaths], tagNameDict, numWorkers=1)
+    originalStats = {filePath: os.stat(filePath) for filePath in dicomFilePaths}
+    results = logic.modifyDicomFiles([(filePath, filePath) for filePath in dicomFilePaths], tagNameDict, numWorkers=1)
+    self.assertEqual([result.status for result in results], ['unchanged'] * len(dicomFilePaths))
+    for filePath, originalStat in originalStats.items():
+      fileStat = os.stat(filePath)
+      self.assertEqual((fileStat.st_ino, fileStat.st_mtime_ns), (originalStat.st_ino, originalStat.st_mtime_ns))
+    for linkUnchanged in [False, True]:
+      outputDir = os.path.join(self.testDir, 'output%i' % linkUnchanged)
+      results = logic.modifyDicomFiles(logic.iterFilePathPairs(inputDir, outputDir, recursive=True), tagNameDict,
+        numWorkers=1, linkUnchanged=linkUnchanged)
+      self.assertEqual(collections.Counter(result.status for result in results)['unchanged'], len(dicomFilePaths))
+      for result in results:
+        if result.status == 'unchanged':
+          self.assertEqual(os.path.samefile(result.inputFilePath, result.outputFilePath), linkUnchanged)
+          with open(result.inputFilePath, 'rb') as inputFile, open(result.outputFilePath, 'rb') as outputFile:
+            self.assertEqual(inputFile.read(), outputFile.read())
+    # Written anyway if asked to
+    results = logic.modifyDicomFiles([(filePath, filePath) for filePath in dicomFilePaths], tagNameDict, numWorkers=1,
+      skipUnchanged=False, inPlacePatch=False)
+    self.assertEqual([result.status for result in results], ['modified'] * len(dicomFilePaths))
+    for filePath, originalStat in originalStats.items():
+      self.assertNotEqual(os.stat(filePath).st_ino, originalStat.st_ino)
+    self.delayDisplay('Test passed')
 
+  def test_InPlacePatch(self):
+    """ Overwrite a file with a value which fits in the existing element, and check that only its bytes
+    are written over in the same file; values which don't fit, or inPlacePatch=False, rewrite the file.
+    """
+    self.delayDisplay("Starting the test")
     logic = DICOM_ModifyLogic()
+    filePath = self.corpus.filePaths[0]
+    with open(filePath, 'rb') as inputFile:
+      originalContent = inputFile.read()
+    originalStat = os.stat(filePath)
+    patientIDLength = len(pydicom.dcmread(filePath).PatientID)
+    success, err = logic.modifyDicomFile(filePath, filePath, {'PatientID': 'P' * patientIDLength})
+    self.assertTrue(success, err)
+    patchedStat = os.stat(filePath)
+    self.assertEqual(patchedStat.st_ino, originalStat.st_ino)
+    with open(filePath, 'rb') as patchedFile:
+      patchedContent = patchedFile.read()
+    self.assertEqual(len(patchedContent), len(originalContent))
+    changedByteCount = sum(originalByte != patchedByte for originalByte, patchedByte in zip(originalContent, patchedContent))
+    self.assertGreater(changedByteCount, 0)
+    self.assertLessEqual(changedByteCount, patientIDLength)
+    self.assertEqual(pydicom.dcmread(filePath).PatientID, 'P' * patientIDLength)
+    for patientID, inPlacePatch in [('Q' * patientIDLength, False), ('R' * (patientIDLength + 2), True)]:
+      success, err = logic.modifyDicomFile(filePath, filePath, {'PatientID': patientID}, inPlacePatch=inPlacePatch)
+      self.assertTrue(success, err)
+      self.assertNotEqual(os.stat(filePath).st_ino, patchedStat.st_ino)
+      self.assertEqual(pydicom.dcmread(filePath).PatientID, patientID)
+      patchedStat = os.stat(filePath)
+    self.delayDisplay('Test passed')
 
-    # Test algorithm with non-inverted threshold
-    logic.process(inputVolume, outputVolume, threshold, True)
-    outputScalarRange = outputVolume.GetImageData().GetScalarRange()
-    self.assertEqual(outputScalarRange[0], inputScalarRange[0])
-    self.assertEqual(outputScalarRange[1], threshold)
+  def test_AtomicWrite(self):
+    """ Output files are replaced in one rename, keeping the permissions of the file they replace, and
+    left as they were if writing fails.
+    """
+    self.delayDisplay("Starting the test")
+    logic = DICOM_ModifyLogic()
+    inputFilePath = self.corpus.filePaths[0]
+    outputDir = os.path.join(self.testDir, 'output')
+    outputFilePath = os.path.join(outputDir, 'output.dcm')
+    os.makedirs(outputDir)
+    shutil.copyfile(inputFilePath, outputFilePath)
+    os.chmod(outputFilePath, 0o640)
+    success, err = logic.modifyDicomFile(inputFilePath, outputFilePath, {'PatientID': 'ATOMIC'}, fsyncPolicy='file')
+    self.assertTrue(success, err)
+    self.assertEqual(pydicom.dcmread(outputFilePath).PatientID, 'ATOMIC')
+    self.assertEqual(os.stat(outputFilePath).st_mode & 0o777, 0o640)
+    # New files get the permissions open() gives them
+    referenceFilePath = os.path.join(self.testDir, 'reference')
+    with open(referenceFilePath, 'wb'):
+      pass
+    newFilePath = os.path.join(outputDir, 'new.dcm')
+    with atomicOutputFile(newFilePath) as outputFile:
+      outputFile.write(b'new')
+    self.assertEqual(os.stat(newFilePath).st_mode & 0o777, os.stat(referenceFilePath).st_mode & 0o777)
+    # A failed write leaves the old content, and no temporary file
+    with open(outputFilePath, 'rb') as outputFile:
+      outputContent = outputFile.read()
+    with self.assertRaises(ValueError):
+      with atomicOutputFile(outputFilePath) as outputFile:
+        outputFile.write(b'partial')
+        raise ValueError('Failed')
+    with open(outputFilePath, 'rb') as outputFile:
+      self.assertEqual(outputFile.read(), outputContent)
+    self.assertEqual(sorted(os.listdir(outputDir)), ['new.dcm', 'output.dcm'])
+    self.delayDisplay('Test passed')
 
-    # Test algorithm with inverted threshold
-    logic.process(inputVolume, outputVolume, threshold, False)
-    outputScalarRange = outputVolume.GetImageData().GetScalarRange()
-    self.assertEqual(outputScalarRange[0], inputScalarRange[0])
-    self.assertEqual(outputScalarRange[1], inputScalarRange[1])
+  def test_ModifyAllFiltered(self):
+    """ Only modify the files whose tags match a filter expression, using a kept tag index.
+    """
+    self.delayDisplay("Starting the test")
+    logic = DICOM_ModifyLogic()
+    inputDir = self.corpus.rootDir
+    indexPath = os.path.join(self.testDir, 'TagIndex.sqlite')
+    filePathPairs = logic.iterFilteredFilePathPairs(inputDir, inputDir, 'InstanceNumber <= 4 and SeriesNumber == 1',
+      recursive=True, indexPath=indexPath)
+    results = logic.modifyDicomFiles(filePathPairs, {'PatientID': 'FILTERED'}, numWorkers=1)
+    self.assertEqual([os.path.basename(result.inputFilePath) for result in results], ['IM000000.dcm', 'IM000002.dcm'])
+    # The modified files are read again (they changed), so the index finds them by their new value
+    filePathPairs = logic.iterFilteredFilePathPairs(inputDir, inputDir, 'PatientID == FILTERED', recursive=True,
+      indexPath=indexPath)
+    self.assertEqual(len(list(filePathPairs)), 2)
+    # Values of text VRs are compared as text, even if they look like numbers
+    logic.modifyDicomFiles(logic.iterFilePathPairs(inputDir, inputDir, recursive=True), {'PatientID': '12345'}, numWorkers=1)
+    for filterExpression, expectedCount in [('StudyDate == 20200101', self.corpus.dicomFileCount),
+        ('StudyDate >= 20190101', self.corpus.dicomFileCount), ('StudyDate < 20190101', 0),
+        ('PatientID == 12345', self.corpus.dicomFileCount), ('PatientID in (12345, 999)', self.corpus.dicomFileCount)]:
+      filePathPairs = logic.iterFilteredFilePathPairs(inputDir, inputDir, filterExpression, recursive=True,
+        indexPath=indexPath)
+      self.assertEqual(len(list(filePathPairs)), expectedCount, filterExpression)
+    with self.assertRaises(ValueError):
+      logic.iterFilteredFilePathPairs(inputDir, inputDir, 'Modality == (CT', recursive=True)
+    self.delayDisplay('Test passed')
 
+  def test_RemapUIDs(self):
+    """ Replace the study, series and instance UIDs with new ones, consistently across files
+    (modified in parallel) and across runs sharing a UID map.
+    """
+    self.delayDisplay("Starting the test")
+    logic = DICOM_ModifyLogic()
+    inputDir = self.corpus.rootDir
+    mapPath = os.path.join(self.testDir, 'UIDMap.jsonl')
+    outputDatasets = []
+    for outputName in ['output1', 'output2']:
+      outputDir = os.path.join(self.testDir, outputName)
+      uidMap = UIDMap(mapPath)
+      editPlan = logic.compileEditPlan(remapUIDKeywords=DEFAULT_REMAP_KEYWORDS, uidMap=uidMap)
+      results = logic.modifyDicomFiles(logic.iterFilePathPairs(inputDir, outputDir, recursive=True), editPlan=editPlan,
+        numWorkers=2)
+      uidMap.close()
+      outputDatasets.append({os.path.relpath(result.outputFilePath, outputDir): pydicom.dcmread(result.outputFilePath)
+        for result in results if result.status == 'modified'})
+    self.assertEqual(len(outputDatasets[0]), self.corpus.dicomFileCount)
+    seriesUIDs = collections.defaultdict(set)
+    for relativePath, ds in outputDatasets[0].items():
+      inputDs = pydicom.dcmread(os.path.join(inputDir, relativePath))
+      self.assertNotEqual(ds.SOPInstanceUID, inputDs.SOPInstanceUID)
+      self.assertEqual(ds.file_meta.MediaStorageSOPInstanceUID, ds.SOPInstanceUID)
+      seriesUIDs[inputDs.SeriesInstanceUID].add(ds.SeriesInstanceUID)
+      # The second run (loading the map saved by the first) gives the same new UIDs
+      self.assertEqual(outputDatasets[1][relativePath].SOPInstanceUID, ds.SOPInstanceUID)
+    self.assertTrue(all(len(newUIDs) == 1 for newUIDs in seriesUIDs.values()))
+    self.assertEqual(len({ds.SOPInstanceUID for ds in outputDatasets[0].values()}), self.corpus.dicomFileCount)
+    self.delayDisplay('Test passed')
+
+  def test_ModifyArchive(self):
+    """ Modify the files in a ZIP archive into a compressed TAR archive, without extracting them;
+    junk members are stored unchanged.
+    """
+    self.delayDisplay("Starting the test")
+    logic = DICOM_ModifyLogic()
+    inputArchivePath = os.path.join(self.testDir, 'input.zip')
+    with zipfile.ZipFile(inputArchivePath, 'w', zipfile.ZIP_DEFLATED) as inputArchive:
+      for filePath in self.corpus.filePaths:
+        inputArchive.write(filePath, os.path.relpath(filePath, self.corpus.rootDir))
+    outputArchivePath = os.path.join(self.testDir, 'output.tar.gz')
+    results = list(logic.iterModifyArchive(inputArchivePath, outputArchivePath, {'PatientID': 'ARCHIVED'}))
+    self.assertEqual(collections.Counter(result.status for result in results)['modified'], self.corpus.dicomFileCount)
+    with tarfile.open(outputArchivePath) as outputArchive:
+      self.assertEqual(len(outputArchive.getnames()), len(self.corpus.filePaths))
+      for filePath in self.corpus.filePaths:
+        memberFile = outputArchive.extractfile(os.path.relpath(filePath, self.corpus.rootDir).replace(os.sep, '/'))
+        if logic.isValidDICOMFile(filePath):
+          self.assertEqual(pydicom.dcmread(memberFile).PatientID, 'ARCHIVED')
+        else:
+          with open(filePath, 'rb') as inputFile:
+            self.assertEqual(memberFile.read(), inputFile.read())
+    self.delayDisplay('Test passed')
+
+  def test_ApplyProfile(self):
+    """ De-identify files with the basic profile: identifying elements are emptied or removed, also
+    in sequences, private elements are removed, UIDs are replaced, and explicit tag values win.
+    """
+    self.delayDisplay("Starting the test")
+    logic = DICOM_ModifyLogic()
+    inputFilePath = self.corpus.filePaths[0]
+    ds = pydicom.dcmread(inputFilePath)
+    ds.add_new(0x00091010, 'LO', 'PRIVATE VALUE')
+    ds.InstitutionName = 'HOSPITAL'
+    referencedItem = pydicom.Dataset()
+    referencedItem.ReferencedSOPInstanceUID = ds.SOPInstanceUID
+    referencedItem.PersonName = 'Doe^John'
+    ds.ReferencedImageSequence = [referencedItem]
+    ds.save_as(inputFilePath)
+    outputDir = os.path.join(self.testDir, 'output')
+    editPlan = logic.compileEditPlan({'PatientID': 'SUBJECT01'}, profile='basic')
+    results = logic.modifyDicomFiles(logic.iterFilePathPairs(self.corpus.rootDir, outputDir, recursive=True),
+      editPlan=editPlan, numWorkers=2)
+    self.assertEqual(collections.Counter(result.status for result in results)['modified'], self.corpus.dicomFileCount)
+    outputDs = pydicom.dcmread(os.path.join(outputDir, os.path.relpath(inputFilePath, self.corpus.rootDir)))
+    self.assertEqual(outputDs.PatientName, '')
+    self.assertEqual(outputDs.PatientID, 'SUBJECT01')
+    self.assertEqual(outputDs.PatientIdentityRemoved, 'YES')
+    self.assertNotIn('InstitutionName', outputDs)
+    self.assertFalse(any(element.tag.is_private for element in outputDs))
+    self.assertNotEqual(outputDs.SOPInstanceUID, ds.SOPInstanceUID)
+    self.assertEqual(outputDs.file_meta.MediaStorageSOPInstanceUID, outputDs.SOPInstanceUID)
+    outputItem = outputDs.ReferencedImageSequence[0]
+    self.assertEqual(outputItem.ReferencedSOPInstanceUID, outputDs.SOPInstanceUID)
+    self.assertEqual(outputItem.PersonName, '')
+    # Rules files: the most specific rule applies
+    profile = Profile.fromText('VR=PN Z\nPatientName K  # kept\nprivate X\n(60xx,xxxx) X\n')
+    self.assertEqual(profile.actionFor(pydicom.tag.Tag('PatientName'), 'PN'), 'K')
+    self.assertEqual(profile.actionFor(pydicom.tag.Tag('OperatorsName'), 'PN'), 'Z')
+    self.assertEqual(profile.actionFor(pydicom.tag.Tag(0x6002, 0x3000), 'OW'), 'X')
+    with self.assertRaises(ValueError):
+      Profile.fromText('PatientName REMOVE')
+    # D on a UID gives it a new UID, which needs a UID map
+    editPlan = logic.compileEditPlan(profile=Profile.fromText('SOPInstanceUID D\n'))
+    self.assertIsNotNone(editPlan.uidMap)
+    outputDir = os.path.join(self.testDir, 'outputDummyUID')
+    results = logic.modifyDicomFiles(logic.iterFilePathPairs(self.corpus.rootDir, outputDir, recursive=True),
+      editPlan=editPlan, numWorkers=1)
+    self.assertEqual(collections.Counter(result.status for result in results)['modified'], self.corpus.dicomFileCount)
+    outputDs = pydicom.dcmread(os.path.join(outputDir, os.path.relpath(inputFilePath, self.corpus.rootDir)))
+    self.assertEqual(outputDs.SOPInstanceUID, editPlan.uidMap.newUID(ds.SOPInstanceUID))
+    self.delayDisplay('Test passed')
+
+  def test_UndoRollback(self):
+    """ Modify files in place keeping an undo log, in two runs, then roll both back and check that
+    the files are exactly as they were.
+    """
+    self.delayDisplay("Starting the test")
+    logic = DICOM_ModifyLogic()
+    inputDir = self.corpus.rootDir
+    originalContents = {}
+    for filePath in self.corpus.filePaths:
+      with open(filePath, 'rb') as inputFile:
+        originalContents[filePath] = inputFile.read()
+    undoLogPath = os.path.join(self.testDir, 'undo.jsonl')
+    # In place patches, then edits which don't fit in place
+    for tagNameDict in [{'PatientID': 'UNDO'}, {'PatientID': 'A LONGER PATIENT ID', 'ImageComments': 'Added'}]:
+      results = logic.modifyDicomFiles(logic.iterFilePathPairs(inputDir, inputDir, recursive=True), tagNameDict,
+        numWorkers=2, chunkSize=4, undoLogPath=undoLogPath)
+      self.assertEqual(collections.Counter(result.status for result in results)['modified'], self.corpus.dicomFileCount)
+    self.assertEqual(pydicom.dcmread(self.corpus.filePaths[0]).ImageComments, 'Added')
+    # Every worker process wrote whole records to its own segment of the log
+    segmentPaths = logSegmentPaths(undoLogPath)
+    self.assertGreater(len(segmentPaths), 1)
+    self.assertNotIn(undoLogPath, segmentPaths)
+    recordCount = 0
+    for segmentPath in segmentPaths:
+      with open(segmentPath, 'r', encoding='utf-8') as segmentFile:
+        recordCount += sum(1 for line in segmentFile if json.loads(line)['path'])
+    self.assertEqual(recordCount, 2 * self.corpus.dicomFileCount)
+    results = list(logic.iterRollback(undoLogPath))
+    self.assertEqual(len(results), 2 * self.corpus.dicomFileCount)
+    self.assertTrue(all(result.success for result in results))
+    for filePath, originalContent in originalContents.items():
+      with open(filePath, 'rb') as inputFile:
+        self.assertEqual(inputFile.read(), originalContent)
+    self.delayDisplay('Test passed')
+
+  def test_ShardedBatch(self):
+    """ Modify the files in shards with both strategies, as separate workers would, and check that
+    the shards are disjoint, cover every file, and merge into one complete report.
+    """
+    self.delayDisplay("Starting the test")
+    logic = DICOM_ModifyLogic()
+    inputDir = self.corpus.rootDir
+    shardCount = 3
+    for strategy in ['hash', 'size']:
+      outputDir = os.path.join(self.testDir, 'output_' + strategy)
+      planPath = os.path.join(self.testDir, 'plan_%s.jsonl' % strategy)
+      manifestPaths = []
+      shardInputPaths = []
+      for shardIndex in range(shardCount):
+        manifestPaths.append(os.path.join(self.testDir, 'manifest_%s_%i.jsonl' % (strategy, shardIndex)))
+        filePathPairs = logic.iterShardFilePathPairs(logic.iterFilePathPairs(inputDir, outputDir, recursive=True),
+          inputDir, shardIndex, shardCount, strategy, planPath)
+        results = logic.modifyDicomFiles(filePathPairs, {'PatientID': 'SHARD'}, numWorkers=2,
+          manifest=ShardManifest(manifestPaths[-1], shardIndex, shardCount))
+        shardInputPaths.append(set(result.inputFilePath for result in results))
+      allInputPaths = set.union(*shardInputPaths)
+      self.assertEqual(sum(len(inputPaths) for inputPaths in shardInputPaths), len(allInputPaths))
+      self.assertEqual(allInputPaths, set(inputFilePath for inputFilePath, outputFilePath
+        in logic.iterFilePathPairs(inputDir, outputDir, recursive=True)))
+      report, problems = mergeShardManifests(manifestPaths)
+      self.assertEqual(problems, [])
+      self.assertEqual(report.statusCounts['modified'], self.corpus.dicomFileCount)
+      # A missing shard is reported
+      report, problems = mergeShardManifests(manifestPaths[:-1])
+      self.assertEqual(len(problems), 1)
+    # Running a shard again doesn't replace its manifest, unless asked to
+    with self.assertRaises(FileExistsError):
+      ShardManifest(manifestPaths[0], 0, shardCount)
+    ShardManifest(manifestPaths[0], 0, shardCount, overwrite=True)
+    # Without hard links (e.g. on SMB), the first plan saved is still the one every shard uses
+    planPath = os.path.join(self.testDir, 'plan_nolink.jsonl')
+    shardInputPaths = []
+    with unittest.mock.patch('os.link', side_effect=PermissionError(1, 'Operation not permitted')):
+      for shardIndex in range(shardCount):
+        filePathPairs = logic.iterShardFilePathPairs(logic.iterFilePathPairs(inputDir, inputDir, recursive=True),
+          inputDir, shardIndex, shardCount, 'size', planPath)
+        shardInputPaths.append(set(inputFilePath for inputFilePath, outputFilePath in filePathPairs))
+    self.assertTrue(os.path.exists(planPath))
+    self.assertEqual(sum(len(inputPaths) for inputPaths in shardInputPaths), len(set.union(*shardInputPaths)))
+    self.assertEqual(set.union(*shardInputPaths), set(logic.iterFilePaths(inputDir, recursive=True)))
+    self.delayDisplay('Test passed')
+
+  def test_UpdateDicomDatabase(self):
+    """ Import the files into a temporary DICOM database, modify some of them in place, and check
+    that re-indexing them updates the tag values the database has cached.
+    """
+    self.delayDisplay("Starting the test")
+    from DICOMLib import DICOMUtils
+    logic = DICOM_ModifyLogic()
+    inputDir = self.corpus.rootDir
+    with DICOMUtils.TemporaryDICOMDatabase(os.path.join(self.testDir, 'database')) as database:
+      DICOMUtils.importDicom(inputDir, database)
+      patientIDTag = '0010,0020'
+      modifiedFilePath, otherFilePath = self.corpus.filePaths[0], self.corpus.filePaths[self.corpus.dicomFileCount - 1]
+      otherPatientID = database.fileValue(otherFilePath, patientIDTag)
+      results = logic.modifyDicomFiles([(modifiedFilePath, modifiedFilePath)], {'PatientID': 'REINDEXED'})
+      self.assertEqual(results[0].status, 'modified')
+      notInDatabaseFilePath = os.path.join(self.testDir, 'notInDatabase.dcm')
+      self.assertEqual(logic.updateDicomDatabase([modifiedFilePath, notInDatabaseFilePath], database),
+        len(database.filesForSeries(database.seriesForFile(modifiedFilePath))))
+      self.assertEqual(database.fileValue(modifiedFilePath, patientIDTag), 'REINDEXED')
+      self.assertEqual(database.fileValue(otherFilePath, patientIDTag), otherPatientID)
+    self.delayDisplay('Test passed')
+
+  def test_DryRun(self):
+    """ Preview modifying a file and a folder in place, and check that the changes are reported but
+    no file is written.
+    """
+    self.delayDisplay("Starting the test")
+    logic = DICOM_ModifyLogic()
+    inputDir = self.corpus.rootDir
+    originalContents = {}
+    for filePath in self.corpus.filePaths:
+      with open(filePath, 'rb') as inputFile:
+        originalContents[filePath] = inputFile.read()
+    filePath = self.corpus.filePaths[0]
+    originalPatientID = pydicom.dcmread(filePath).PatientID
+    changes, err = logic.previewDicomFile(filePath, {'PatientID': 'DRYRUN', 'ImageComments': 'Added'})
+    self.assertIsNone(err)
+    self.assertEqual([(change.keyword, change.oldValue, change.newValue) for change in changes],
+      [('PatientID', originalPatientID, 'DRYRUN'), ('ImageComments', None, 'Added')])
+    diffReportPath = os.path.join(self.testDir, 'diff.jsonl')
+    for pipelined in [False, True]:
+      results = logic.modifyDicomFiles(logic.iterFilePathPairs(inputDir, inputDir, recursive=True), {'PatientID': 'DRYRUN'},
+        numWorkers=2, pipelined=pipelined, dryRun=True, diffReportPath=diffReportPath)
+      resultCounts = collections.Counter(result.status for result in results)
+      self.assertEqual(resultCounts['wouldModify'], self.corpus.dicomFileCount)
+      self.assertEqual(resultCounts['modified'], 0)
+      with open(diffReportPath, 'r', encoding='utf-8') as diffReportFile:
+        self.assertEqual(len(diffReportFile.readlines()), len(results))
+    for filePath, originalContent in originalContents.items():
+      with open(filePath, 'rb') as inputFile:
+        self.assertEqual(inputFile.read(), originalContent)
+    self.delayDisplay('Test passed')
+
+  def test_ResumeJournal(self):
+    """ Modify a folder with a journal, and resume: only files which changed since, whose output is
+    gone, or which the journal doesn't record as complete with the same edits are processed again.
+    """
+    self.delayDisplay("Starting the test")
+    logic = DICOM_ModifyLogic()
+    inputDir = self.corpus.rootDir
+    outputDir = os.path.join(self.testDir, 'output')
+    journalPath = os.path.join(self.testDir, 'journal.jsonl')
+    results = logic.modifyDicomFiles(logic.iterFilePathPairs(inputDir, outputDir, recursive=True), {'PatientID': 'JOURNAL'},
+      numWorkers=2, chunkSize=4, journalPath=journalPath)
+    self.assertEqual(collections.Counter(result.status for result in results)['modified'], self.corpus.dicomFileCount)
+    # Skipped files have no output, so they are probed again (which is cheap)
+    results = logic.modifyDicomFiles(logic.iterFilePathPairs(inputDir, outputDir, recursive=True), {'PatientID': 'JOURNAL'},
+      numWorkers=1, journalPath=journalPath, resume=True)
+    self.assertEqual(collections.Counter(result.status for result in results),
+      collections.Counter(alreadyDone=self.corpus.dicomFileCount, skipped=len(results) - self.corpus.dicomFileCount))
+    # A line cut short by a crash is ignored
+    with open(journalPath, 'a', encoding='utf-8') as journalFile:
+      journalFile.write('{"input": "')
+    changedFilePath, removedOutputFilePath = self.corpus.filePaths[0], self.corpus.filePaths[1]
+    fileStat = os.stat(changedFilePath)
+    os.utime(changedFilePath, ns=(fileStat.st_atime_ns, fileStat.st_mtime_ns + 1000000000))
+    os.remove(os.path.join(outputDir, os.path.relpath(removedOutputFilePath, inputDir)))
+    results = logic.modifyDicomFiles(logic.iterFilePathPairs(inputDir, outputDir, recursive=True), {'PatientID': 'JOURNAL'},
+      numWorkers=1, journalPath=journalPath, resume=True)
+    self.assertEqual(sorted(result.inputFilePath for result in results if result.status == 'modified'),
+      sorted([changedFilePath, removedOutputFilePath]))
+    self.assertEqual(collections.Counter(result.status for result in results)['alreadyDone'], self.corpus.dicomFileCount - 2)
+    self.assertTrue(os.path.exists(os.path.join(outputDir, os.path.relpath(removedOutputFilePath, inputDir))))
+    # Other edits start over
+    results = logic.modifyDicomFiles(logic.iterFilePathPairs(inputDir, outputDir, recursive=True), {'PatientID': 'OTHER'},
+      numWorkers=1, journalPath=journalPath, resume=True)
+    self.assertEqual(collections.Counter(result.status for result in results)['alreadyDone'], 0)
+    self.delayDisplay('Test passed')
+
+  def test_ResumeRemap(self):
+    """ Remap UIDs in place with a journal, stop as if the run crashed after a few files, and resume:
+    the files done before the crash are not remapped a second time.  Then the same with worker
+    processes, stopping while they still have chunks of files in flight.
+    """
+    self.delayDisplay("Starting the test")
+    logic = DICOM_ModifyLogic()
+    inputDir = self.corpus.rootDir
+    workerInputDir = os.path.join(self.testDir, 'workerInput')
+    shutil.copytree(inputDir, workerInputDir)
+    mapPath = os.path.join(self.testDir, 'UIDMap.jsonl')
+    journalPath = os.path.join(self.testDir, 'journal.jsonl')
+    originalUIDs = {filePath: pydicom.dcmread(filePath).SOPInstanceUID
+      for filePath in self.corpus.filePaths[:self.corpus.dicomFileCount]}
+    uidMap = UIDMap(mapPath)
+    editPlan = logic.compileEditPlan(remapUIDKeywords=DEFAULT_REMAP_KEYWORDS, uidMap=uidMap)
+    results = logic.iterModifyDicomFiles(logic.iterFilePathPairs(inputDir, inputDir, recursive=True), editPlan=editPlan,
+      numWorkers=1, chunkSize=1, journalPath=journalPath)
+    modifiedCount = 0
+    for result in results:
+      modifiedCount += result.status == 'modified'
+      if modifiedCount == 3:
+        break
+    # Crash: only what is on disk by now survives, nothing is flushed when the run ends
+    savedContents = {}
+    for filePath in [mapPath, journalPath]:
+      with open(filePath, 'rb') as savedFile:
+        savedContents[filePath] = savedFile.read()
+    results.close()
+    for filePath, savedContent in savedContents.items():
+      with open(filePath, 'wb') as savedFile:
+        savedFile.write(savedContent)
+    uidMap = UIDMap(mapPath)
+    editPlan = logic.compileEditPlan(remapUIDKeywords=DEFAULT_REMAP_KEYWORDS, uidMap=uidMap)
+    results = logic.modifyDicomFiles(logic.iterFilePathPairs(inputDir, inputDir, recursive=True), editPlan=editPlan,
+      numWorkers=2, journalPath=journalPath, resume=True)
+    uidMap.close()
+    self.assertEqual(collections.Counter(result.status for result in results)['modified'],
+      self.corpus.dicomFileCount - modifiedCount)
+    for filePath, originalUID in originalUIDs.items():
+      self.assertEqual(pydicom.dcmread(filePath).SOPInstanceUID, uidMap.newUID(originalUID))
+    # Workers finish the chunks they have when the run is stopped, and record them in the journal themselves
+    mapPath = os.path.join(self.testDir, 'workerUIDMap.jsonl')
+    journalPath = os.path.join(self.testDir, 'workerJournal.jsonl')
+    for resume in [False, True]:
+      uidMap = UIDMap(mapPath)
+      editPlan = logic.compileEditPlan(remapUIDKeywords=DEFAULT_REMAP_KEYWORDS, uidMap=uidMap)
+      results = logic.iterModifyDicomFiles(logic.iterFilePathPairs(workerInputDir, workerInputDir, recursive=True),
+        editPlan=editPlan, numWorkers=2, chunkSize=4, journalPath=journalPath, resume=resume)
+      for result in results:
+        if result.status == 'modified' and not resume:
+          break
+      results.close()
+      uidMap.close()
+    for filePath, originalUID in originalUIDs.items():
+      workerFilePath = os.path.join(workerInputDir, os.path.relpath(filePath, inputDir))
+      self.assertEqual(pydicom.dcmread(workerFilePath).SOPInstanceUID, uidMap.newUID(originalUID))
     self.delayDisplay('Test passed')
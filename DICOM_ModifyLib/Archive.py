@@ -0,0 +1,214 @@
+"""Reading and writing the members of ZIP and TAR archives as streams, without extracting them.
+
+Members are read in archive order (TAR archives, including compressed ones, in a single forward
+pass), and written to the output archive one at a time, so only the member being processed is ever
+partly in memory.  See ModifyLogic.iterModifyArchive.
+"""
+
+import collections
+import io
+import logging
+import shutil
+import tarfile
+import time
+import zipfile
+
+# Archive file name extensions (lower case) and the tarfile write mode, or 'zip'
+ARCHIVE_FORMATS = collections.OrderedDict([('.zip', 'zip'), ('.tar', 'w'), ('.tar.gz', 'w:gz'), ('.tgz', 'w:gz'),
+  ('.tar.bz2', 'w:bz2'), ('.tbz2', 'w:bz2'), ('.tar.xz', 'w:xz'), ('.txz', 'w:xz')])
+
+_COPY_CHUNK_SIZE = 1024 * 1024
+
+# A member of an archive; kind is 'file', 'dir' or 'other' (e.g. links), info the ZipInfo or TarInfo
+ArchiveMember = collections.namedtuple('ArchiveMember', ['name', 'size', 'mtime', 'mode', 'kind', 'info'])
+
+
+def isArchivePath(filePath):
+  '''True if the file name has the extension of a supported archive format'''
+  return _archiveFormat(filePath) is not None
+
+
+def _archiveFormat(filePath):
+  lowerFilePath = filePath.lower()
+  for extension, archiveFormat in ARCHIVE_FORMATS.items():
+    if lowerFilePath.endswith(extension):
+      return archiveFormat
+  return None
+
+
+class ArchiveReader:
+  """Members of a ZIP or TAR archive.  Iterate over the members, and open each with openMember before
+  going on to the next one (TAR archives are read in a single pass).
+  """
+
+  def __init__(self, archivePath):
+    self.archivePath = archivePath
+    if zipfile.is_zipfile(archivePath):
+      self._zipFile = zipfile.ZipFile(archivePath)
+      self._tarFile = None
+    else:
+      self._zipFile = None
+      try:
+        self._tarFile = tarfile.open(archivePath, 'r|*') # stream mode, never seeks back
+      except tarfile.TarError as err:
+        raise ValueError('%s is not a ZIP or TAR archive: %s' % (archivePath, str(err)))
+
+  def __iter__(self):
+    if self._zipFile is not None:
+      for zipInfo in self._zipFile.infolist():
+        mtime = time.mktime(zipInfo.date_time + (0, 0, -1))
+        mode = (zipInfo.external_attr >> 16) & 0o7777 or (0o755 if zipInfo.is_dir() else 0o644)
+        yield ArchiveMember(zipInfo.filename.rstrip('/'), zipInfo.file_size, mtime, mode,
+          'dir' if zipInfo.is_dir() else 'file', zipInfo)
+    else:
+      for tarInfo in self._tarFile:
+        kind = 'file' if tarInfo.isfile() else 'dir' if tarInfo.isdir() else 'other'
+        yield ArchiveMember(tarInfo.name, tarInfo.size, tarInfo.mtime, tarInfo.mode, kind, tarInfo)
+
+  def openMember(self, member):
+    '''A MemberStream of the content of a file member'''
+    if self._zipFile is not None:
+      return MemberStream(self._zipFile.open(member.info), member.size)
+    return MemberStream(self._tarFile.extractfile(member.info), member.size)
+
+  def close(self):
+    (self._zipFile or self._tarFile).close()
+
+  def __enter__(self):
+    return self
+
+  def __exit__(self, excType, excValue, traceback):
+    self.close()
+
+
+class ArchiveWriter:
+  """Writes members to a new ZIP or TAR archive, in the format given by the extension of archivePath,
+  into outputFile (an open binary file, e.g. from SafeWrite.atomicOutputFile).
+  """
+
+  def __init__(self, outputFile, archivePath):
+    self.archivePath = archivePath
+    archiveFormat = _archiveFormat(archivePath)
+    if archiveFormat is None:
+      raise ValueError('Unknown archive format of %s, expected one of %s' % (archivePath, ', '.join(ARCHIVE_FORMATS)))
+    if archiveFormat == 'zip':
+      self._zipFile = zipfile.ZipFile(outputFile, 'w', zipfile.ZIP_DEFLATED)
+      self._tarFile = None
+    else:
+      self._zipFile = None
+      self._tarFile = tarfile.open(fileobj=outputFile, mode=archiveFormat)
+
+  def addFile(self, member, size, stream):
+    '''Add a file member with the name and attributes of member, and size bytes read from stream'''
+    if self._zipFile is not None:
+      zipInfo = zipfile.ZipInfo(member.name, _zipDateTime(member.mtime))
+      zipInfo.external_attr = (0o100000 | member.mode) << 16
+      zipInfo.compress_type = member.info.compress_type if isinstance(member.info, zipfile.ZipInfo) else zipfile.ZIP_DEFLATED
+      with self._zipFile.open(zipInfo, 'w', force_zip64=size >= zipfile.ZIP64_LIMIT) as memberFile:
+        shutil.copyfileobj(stream, memberFile, _COPY_CHUNK_SIZE)
+    else:
+      tarInfo = _copyTarInfo(member)
+      tarInfo.size = size
+      self._tarFile.addfile(tarInfo, stream)
+
+  def addMember(self, member):
+    '''Add a directory (or, to TAR archives, a link or other special) member'''
+    if self._zipFile is not None:
+      if member.kind != 'dir':
+        logging.warning('%s: %s can not be stored in a ZIP archive, left out' % (self.archivePath, member.name))
+        return
+      zipInfo = zipfile.ZipInfo(member.name + '/', _zipDateTime(member.mtime))
+      zipInfo.external_attr = (0o40000 | member.mode) << 16 | 0x10 # MS-DOS directory flag
+      self._zipFile.writestr(zipInfo, b'')
+    else:
+      self._tarFile.addfile(_copyTarInfo(member))
+
+  def close(self):
+    (self._zipFile or self._tarFile).close()
+
+  def __enter__(self):
+    return self
+
+  def __exit__(self, excType, excValue, traceback):
+    self.close()
+
+
+def _zipDateTime(mtime):
+  return max(time.localtime(mtime)[:6], (1980, 1, 1, 0, 0, 0)) # the earliest date ZIP can store
+
+
+def _copyTarInfo(member):
+  if isinstance(member.info, tarfile.TarInfo):
+    tarInfo = tarfile.TarInfo(member.name)
+    for attribute in ('size', 'mtime', 'mode', 'type', 'linkname', 'uid', 'gid', 'uname', 'gname'):
+      setattr(tarInfo, attribute, getattr(member.info, attribute))
+    return tarInfo
+  tarInfo = tarfile.TarInfo(member.name)
+  tarInfo.mtime = member.mtime
+  tarInfo.mode = member.mode
+  tarInfo.type = tarfile.DIRTYPE if member.kind == 'dir' else tarfile.REGTYPE
+  return tarInfo
+
+
+class MemberStream:
+  """Seekable view of a forward only member stream of known size.  Only the bytes read so far (the
+  header, while it is parsed) are kept, so seeking back within them is free; tail() then streams the
+  rest of the member from the current position without keeping it.
+  """
+
+  def __init__(self, source, size):
+    self._source = source
+    self.size = size
+    self._buffer = bytearray()
+    self._position = 0
+
+  def _fill(self, end):
+    while end > len(self._buffer):
+      data = self._source.read(end - len(self._buffer))
+      if not data:
+        break
+      self._buffer += data
+
+  def read(self, size=-1):
+    end = self.size if size is None or size < 0 else min(self._position + size, self.size)
+    self._fill(end)
+    data = bytes(self._buffer[self._position:end])
+    self._position += len(data)
+    return data
+
+  def seek(self, offset, whence=io.SEEK_SET):
+    if whence == io.SEEK_CUR:
+      offset += self._position
+    elif whence == io.SEEK_END:
+      offset += self.size
+    self._position = max(0, offset)
+    return self._position
+
+  def tell(self):
+    return self._position
+
+  def tail(self):
+    '''Readable stream of the member from the current position to its end; use the MemberStream no
+    more after calling this
+    '''
+    self._fill(self._position)
+    return ConcatenatedStream([io.BytesIO(bytes(self._buffer[self._position:])), self._source])
+
+
+class ConcatenatedStream:
+  """Readable stream of the content of several streams, one after the other"""
+
+  def __init__(self, streams):
+    self._streams = collections.deque(streams)
+
+  def read(self, size=-1):
+    chunks = []
+    while self._streams and (size is None or size < 0 or size > 0):
+      chunk = self._streams[0].read(size)
+      if not chunk:
+        self._streams.popleft()
+        continue
+      chunks.append(chunk)
+      if size is not None and size > 0:
+        size -= len(chunk)
+    return b''.join(chunks)
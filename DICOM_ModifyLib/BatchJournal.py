@@ -0,0 +1,123 @@
+"""Checkpoint journal of DICOM_Modify batch runs, used to resume interrupted batches."""
+
+import json
+import os
+import threading
+import time
+
+from .SafeWrite import appendPath, logSegmentPaths
+
+# Outcomes after which a file doesn't need to be processed again (if it hasn't changed since)
+_COMPLETE_STATUSES = {'modified', 'unchanged', 'skipped'}
+
+
+class BatchJournal:
+  """Append-only journal of a batch run, with one JSON line per processed file recording the input
+  path, its size and modification time after processing, the fingerprint of the edit plan, the
+  outcome, and when it was recorded.  When resuming, files which the journal records as complete
+  with the same edit plan, and which have not changed since, don't need to be processed again (see
+  isComplete).
+  Files are recorded by the process which modified them, as soon as they are written: worker
+  processes (which get a copy of the journal, see __getstate__) each append to their own segment of
+  the journal (see SafeWrite.appendPath), which are all read when resuming.
+  Lines are flushed every flushInterval entries (and by workers after every chunk), so a crash may
+  lose the last few entries; those files are then simply processed again.  That is only harmless if
+  modifying a file twice gives the same result, so pass flushInterval=1 for edits which are not
+  (e.g. remapping UIDs in place).  With an fsyncPolicy other than 'none', every flush is also synced
+  to disk.
+  """
+
+  def __init__(self, journalPath, planFingerprint, resume=False, flushInterval=100, fsyncPolicy='none'):
+    self.journalPath = os.path.abspath(journalPath)
+    self.planFingerprint = planFingerprint
+    self.flushInterval = flushInterval
+    self.fsyncPolicy = fsyncPolicy
+    self._ownerPid = os.getpid()
+    self._completedFiles = {} # input file path -> (size, modification time) when it was completed
+    if resume:
+      self._load()
+    self._journalFile = None # opened by the first record, so a journal which records nothing leaves nothing open
+    self._unflushedCount = 0
+    self._lock = threading.Lock()
+
+  def __getstate__(self):
+    # Sent to worker processes without the open file, the lock, and the completed files (only used here)
+    state = self.__dict__.copy()
+    state.update(_journalFile=None, _lock=None, _unflushedCount=0, _completedFiles={})
+    return state
+
+  def __setstate__(self, state):
+    self.__dict__.update(state)
+    self._lock = threading.Lock()
+
+  def _load(self):
+    latestEntries = {} # input file path -> (time, (size, modification time) if it was completed)
+    for segmentPath in logSegmentPaths(self.journalPath):
+      with open(segmentPath, 'r', encoding='utf-8') as journalFile:
+        for line in journalFile:
+          try:
+            entry = json.loads(line)
+          except ValueError:
+            continue # partially written line from an interrupted run
+          # A later entry overrides an earlier one, e.g. the file failed when processed again
+          entryTime = entry.get('time', 0)
+          latestEntry = latestEntries.get(entry.get('input'))
+          if latestEntry is not None and latestEntry[0] > entryTime:
+            continue
+          isComplete = entry.get('plan') == self.planFingerprint and entry.get('status') in _COMPLETE_STATUSES
+          latestEntries[entry.get('input')] = (entryTime, (entry['size'], entry['mtime']) if isComplete else None)
+    self._completedFiles = {inputFilePath: completedStat
+      for inputFilePath, (entryTime, completedStat) in latestEntries.items() if completedStat is not None}
+
+  def isComplete(self, inputFilePath, outputFilePath):
+    '''True if the journal records the file as complete, and it hasn't changed since'''
+    completedStat = self._completedFiles.get(inputFilePath)
+    if completedStat is None:
+      return False
+    try:
+      fileStat = os.stat(inputFilePath)
+    except OSError:
+      return False
+    if (fileStat.st_size, fileStat.st_mtime_ns) != completedStat:
+      return False
+    return outputFilePath == inputFilePath or os.path.exists(outputFilePath)
+
+  def record(self, result):
+    '''Append the outcome of processing one file (a ModifyResult)'''
+    try:
+      fileStat = os.stat(result.inputFilePath)
+      size, modifiedTime = fileStat.st_size, fileStat.st_mtime_ns
+    except OSError:
+      size, modifiedTime = None, None
+    entry = {'input': result.inputFilePath, 'output': result.outputFilePath, 'size': size, 'mtime': modifiedTime,
+      'plan': self.planFingerprint, 'status': result.status, 'time': time.time()}
+    if result.error is not None:
+      entry['error'] = '%s: %s' % (type(result.error).__name__, str(result.error))
+    with self._lock:
+      if self._journalFile is None:
+        self._journalFile = open(appendPath(self.journalPath, self._ownerPid), 'a', encoding='utf-8')
+      self._journalFile.write(json.dumps(entry) + '\n')
+      self._unflushedCount += 1
+      if self._unflushedCount >= self.flushInterval:
+        self._flush()
+
+  def flush(self):
+    with self._lock:
+      self._flush()
+
+  def _flush(self):
+    if self._journalFile is None:
+      return
+    self._journalFile.flush()
+    if self.fsyncPolicy != 'none':
+      os.fsync(self._journalFile.fileno())
+    self._unflushedCount = 0
+
+  def close(self):
+    with self._lock:
+      if self._journalFile is None:
+        return
+      if self._unflushedCount:
+        self._flush()
+      self._journalFile.close()
+      self._journalFile = None
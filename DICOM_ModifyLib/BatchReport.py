@@ -0,0 +1,185 @@
+"""Per-phase timing of DICOM file modification, and the structured report of a batch run.
+
+Timing is optional: modification code always times its phases through a PhaseTimer, but by default
+that is NULL_PHASE_TIMER, which does nothing, so there is next to no overhead unless a report is
+requested.
+"""
+
+import array
+import collections
+import csv
+import json
+import time
+
+# Phases of modifying a file, in the order they happen
+PHASES = ('discovery', 'probe', 'read', 'edit', 'mkdir', 'write')
+
+# Number of example files listed per exception type in a report
+_FAILURE_EXAMPLE_COUNT = 5
+
+
+class _TimedPhase:
+  __slots__ = ('_timings', '_name', '_startTime')
+
+  def __init__(self, timings, name):
+    self._timings = timings
+    self._name = name
+
+  def __enter__(self):
+    self._startTime = time.perf_counter()
+
+  def __exit__(self, excType, excValue, traceback):
+    self._timings[self._name] = self._timings.get(self._name, 0.0) + time.perf_counter() - self._startTime
+
+
+class PhaseTimer:
+  """Seconds spent in each phase of modifying one file, and the bytes read and written.
+  Use as:  with timer.phase('read'): ...
+  """
+  enabled = True
+
+  def __init__(self):
+    self.timings = {}
+    self.bytesIn = 0
+    self.bytesOut = 0
+
+  def phase(self, name):
+    return _TimedPhase(self.timings, name)
+
+
+class _NullPhase:
+  __slots__ = ()
+
+  def __enter__(self):
+    pass
+
+  def __exit__(self, excType, excValue, traceback):
+    pass
+
+
+class _NullPhaseTimer:
+  """PhaseTimer which records nothing"""
+  enabled = False
+  _nullPhase = _NullPhase()
+
+  def phase(self, name):
+    return self._nullPhase
+
+NULL_PHASE_TIMER = _NullPhaseTimer()
+
+
+class BatchReport:
+  """Aggregated metrics of a batch run: result counts, phase timings (totals and percentiles), bytes
+  in and out, and failures grouped by exception type.  Pass one to ModifyLogic.iterModifyDicomFiles
+  (report=...), which fills it in as results are yielded.
+  The duration of every phase of every file is kept (8 bytes each) for exact percentiles.
+  """
+
+  def __init__(self):
+    self.statusCounts = collections.Counter()
+    self.phaseDurations = collections.defaultdict(lambda: array.array('d'))
+    self.bytesIn = 0
+    self.bytesOut = 0
+    self.failures = collections.OrderedDict() # exception type name -> [count, [(input file path, message), ...]]
+    self.startTime = None
+    self.elapsedSeconds = None
+
+  def begin(self):
+    self.startTime = time.monotonic()
+
+  def end(self, discoverySeconds=None):
+    self.elapsedSeconds = time.monotonic() - self.startTime
+    if discoverySeconds is not None:
+      self.phaseDurations['discovery'].append(discoverySeconds)
+
+  def add(self, result):
+    '''Add the outcome of one file (a ModifyResult)'''
+    self.statusCounts[result.status] += 1
+    if result.metrics is not None:
+      for phase, seconds in result.metrics.timings.items():
+        self.phaseDurations[phase].append(seconds)
+      self.bytesIn += result.metrics.bytesIn
+      self.bytesOut += result.metrics.bytesOut
+    if result.status == 'failed':
+      self.addFailure(type(result.error).__name__, result.inputFilePath, str(result.error))
+
+  def addFailure(self, typeName, inputFilePath, message):
+    '''Count a failure with an exception of this type name, keeping the first few as examples'''
+    failure = self.failures.setdefault(typeName, [0, []])
+    failure[0] += 1
+    if len(failure[1]) < _FAILURE_EXAMPLE_COUNT:
+      failure[1].append((inputFilePath, message))
+
+  @property
+  def filesTotal(self):
+    return sum(self.statusCounts.values())
+
+  def phaseStatistics(self, phase):
+    '''Count, total, mean, percentiles and maximum of the durations (in seconds) of a phase'''
+    durations = sorted(self.phaseDurations.get(phase, ()))
+    if not durations:
+      return None
+    total = sum(durations)
+    return collections.OrderedDict([('count', len(durations)), ('totalSeconds', total),
+      ('meanSeconds', total / len(durations)), ('p50Seconds', _percentile(durations, 50)),
+      ('p90Seconds', _percentile(durations, 90)), ('p99Seconds', _percentile(durations, 99)),
+      ('maxSeconds', durations[-1])])
+
+  def toDict(self):
+    '''The report as a JSON serializable dictionary'''
+    elapsedSeconds = self.elapsedSeconds
+    phases = collections.OrderedDict()
+    for phase in PHASES + tuple(sorted(set(self.phaseDurations) - set(PHASES))):
+      statistics = self.phaseStatistics(phase)
+      if statistics is not None:
+        phases[phase] = statistics
+    return collections.OrderedDict([
+      ('files', dict(self.statusCounts)),
+      ('filesTotal', self.filesTotal),
+      ('elapsedSeconds', elapsedSeconds),
+      ('filesPerSecond', self.filesTotal / elapsedSeconds if elapsedSeconds else None),
+      ('bytesIn', self.bytesIn),
+      ('bytesOut', self.bytesOut),
+      ('phases', phases),
+      ('failures', collections.OrderedDict((typeName, {'count': count, 'examples': [
+        {'input': inputFilePath, 'error': message} for inputFilePath, message in examples]})
+        for typeName, (count, examples) in self.failures.items())),
+    ])
+
+  def writeJson(self, filePath):
+    with open(filePath, 'w', encoding='utf-8') as jsonFile:
+      json.dump(self.toDict(), jsonFile, indent=2)
+
+  def writeCsv(self, filePath):
+    '''Write the phase statistics as a table, one row per phase'''
+    phases = self.toDict()['phases']
+    fieldNames = ['phase', 'count', 'totalSeconds', 'meanSeconds', 'p50Seconds', 'p90Seconds', 'p99Seconds', 'maxSeconds']
+    with open(filePath, 'w', newline='', encoding='utf-8') as csvFile:
+      writer = csv.DictWriter(csvFile, fieldNames)
+      writer.writeheader()
+      for phase, statistics in phases.items():
+        writer.writerow(dict(statistics, phase=phase))
+
+  def write(self, filePath):
+    '''Write as CSV if the file name ends with .csv, JSON otherwise'''
+    if filePath.lower().endswith('.csv'):
+      self.writeCsv(filePath)
+    else:
+      self.writeJson(filePath)
+
+  def formatSummary(self):
+    '''Human readable lines summarizing the report'''
+    lines = ['%i files in %.1f s, %.1f MB read, %.1f MB written' % (self.filesTotal, self.elapsedSeconds or 0,
+      self.bytesIn / 1e6, self.bytesOut / 1e6)]
+    for phase, statistics in self.toDict()['phases'].items():
+      lines.append('  %-9s total %8.2f s, median %7.2f ms, 99th percentile %7.2f ms' % (phase,
+        statistics['totalSeconds'], statistics['p50Seconds'] * 1000, statistics['p99Seconds'] * 1000))
+    for typeName, (count, examples) in self.failures.items():
+      lines.append('  %i failed with %s, e.g. %s: %s' % (count, typeName, examples[0][0], examples[0][1]))
+    return lines
+
+
+def _percentile(sortedValues, percent):
+  '''Nearest rank percentile'''
+  rank = max(1, -(-len(sortedValues) * percent // 100))
+  return sortedValues[int(rank) - 1]
@@ -0,0 +1,225 @@
+"""Benchmarks of DICOM_Modify on synthetic DICOM trees (see SyntheticData.py).
+
+Every combination of corpus shape and mode is run in a fresh process, so that the peak memory
+use (RSS) of each case is measured separately.  Results are written as JSON, and can be compared
+against the results of an earlier version to find performance regressions.
+
+Examples:
+  python -m DICOM_ModifyLib.Benchmark --scale 0.1 --output results.json
+  python -m DICOM_ModifyLib.Benchmark --shapes smallSlices --modes batchSerial,batchParallel --baseline results.json
+"""
+
+import argparse
+import concurrent.futures
+import json
+import logging
+import multiprocessing
+import os
+import platform
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+
+import pydicom
+
+try:
+  import resource
+except ImportError:
+  resource = None # not available on Windows, peak memory use is not reported there
+
+from .ModifyLogic import STREAMING_THRESHOLD, ModifyLogic
+from .SyntheticData import CORPUS_SHAPES, generateCorpus
+
+# Version of the results file format
+RESULTS_FORMAT_VERSION = 1
+
+# Edits applied by all modes; they fit in the existing values, so in place patching applies
+_BENCHMARK_EDITS = {'PatientID': 'BENCHMARK', 'PatientName': 'Benchmark^Run'}
+# Edits which don't change the synthetic files (generated with seed 0)
+_UNCHANGED_EDITS = {'PatientID': 'SYNTH0000', 'PatientName': 'Synthetic^Patient'}
+
+# How each mode runs; 'single' modes call modifyDicomFile file by file, 'batch' modes use iterModifyDicomFiles
+BENCHMARK_MODES = {
+  'single': {'api': 'single'},
+  'singleHeaderOnly': {'api': 'single', 'headerOnly': True},
+  'singleInPlace': {'api': 'single', 'overwrite': True},
+  'batchSerial': {'api': 'batch', 'numWorkers': 1},
+  'batchParallel': {'api': 'batch'},
+  'batchHeaderOnly': {'api': 'batch', 'headerOnly': True},
+  'batchNoStreaming': {'api': 'batch', 'streamingThreshold': None},
+  'batchPipelined': {'api': 'batch', 'pipelined': True},
+  'batchInPlace': {'api': 'batch', 'overwrite': True},
+  'batchUnchanged': {'api': 'batch', 'overwrite': True, 'unchanged': True},
+}
+
+
+def runBenchmarks(workDir, shapes, modes, scale=1.0, repeat=1, numWorkers=None):
+  '''Run every mode on every corpus shape, and return the results document'''
+  results = []
+  for shape in shapes:
+    corpusDir = os.path.join(workDir, 'corpus', shape)
+    if os.path.isdir(corpusDir):
+      shutil.rmtree(corpusDir)
+    logging.info('Generating %s corpus' % shape)
+    corpus = generateCorpus(corpusDir, shape, scale)
+    for mode in modes:
+      caseSeconds = []
+      for repetition in range(repeat):
+        caseResult = _runCaseInNewProcess(workDir, corpusDir, mode, numWorkers)
+        caseSeconds.append(caseResult['seconds'])
+        if caseResult['seconds'] <= min(caseSeconds):
+          bestResult = caseResult
+      result = dict(shape=shape, mode=mode, scale=scale, corpusFiles=len(corpus.filePaths),
+        corpusDicomFiles=corpus.dicomFileCount, corpusBytes=corpus.totalBytes, allSeconds=caseSeconds)
+      result.update(bestResult)
+      result['filesPerSecond'] = result['filesProcessed'] / result['seconds'] if result['seconds'] else None
+      result['megabytesPerSecond'] = result['bytesProcessed'] / 1e6 / result['seconds'] if result['seconds'] else None
+      logging.info('%-16s %-16s %8.1f files/s %8.1f MB/s  peak RSS %s kB' % (shape, mode, result['filesPerSecond'] or 0,
+        result['megabytesPerSecond'] or 0, result['peakRssKilobytes']))
+      results.append(result)
+  return {'formatVersion': RESULTS_FORMAT_VERSION, 'environment': _describeEnvironment(numWorkers), 'results': results}
+
+
+def compareResults(baseline, current, tolerance=0.1):
+  '''Compare the throughput (files/sec) of cases in both results documents.  Returns a list of
+  (shape, mode, baselineFilesPerSecond, currentFilesPerSecond) for cases which got slower by
+  more than the tolerance (a fraction).
+  '''
+  baselineRates = {(result['shape'], result['mode']): result['filesPerSecond'] for result in baseline['results']}
+  regressions = []
+  for result in current['results']:
+    baselineRate = baselineRates.get((result['shape'], result['mode']))
+    if baselineRate and result['filesPerSecond'] is not None and result['filesPerSecond'] < baselineRate * (1 - tolerance):
+      regressions.append((result['shape'], result['mode'], baselineRate, result['filesPerSecond']))
+  return regressions
+
+
+def _runCaseInNewProcess(workDir, corpusDir, mode, numWorkers):
+  modeOptions = BENCHMARK_MODES[mode]
+  runDir = os.path.join(workDir, 'run')
+  if os.path.isdir(runDir):
+    shutil.rmtree(runDir)
+  if modeOptions.get('overwrite'):
+    # Modify a copy, so every case starts from the same files
+    shutil.copytree(corpusDir, runDir)
+    inputDir, outputDir = runDir, runDir
+  else:
+    inputDir, outputDir = corpusDir, runDir
+  # A fresh (spawned, not forked) process, so memory use of earlier cases doesn't count
+  with concurrent.futures.ProcessPoolExecutor(max_workers=1, mp_context=multiprocessing.get_context('spawn')) as executor:
+    caseResult = executor.submit(_runCase, inputDir, outputDir, modeOptions, numWorkers).result()
+  shutil.rmtree(runDir)
+  return caseResult
+
+
+def _runCase(inputDir, outputDir, modeOptions, numWorkers):
+  '''Run one benchmark case, in its own process'''
+  logic = ModifyLogic()
+  editPlan = logic.compileEditPlan(_UNCHANGED_EDITS if modeOptions.get('unchanged') else _BENCHMARK_EDITS)
+  headerOnly = modeOptions.get('headerOnly', False)
+  streamingThreshold = modeOptions.get('streamingThreshold', STREAMING_THRESHOLD)
+  statusCounts = {}
+  bytesProcessed = 0
+  startTime = time.perf_counter()
+  filePathPairs = logic.iterFilePathPairs(inputDir, outputDir, recursive=True)
+  if modeOptions['api'] == 'single':
+    for inputFilePath, outputFilePath in filePathPairs:
+      if not logic.isValidDICOMFile(inputFilePath):
+        status = 'skipped'
+      else:
+        bytesProcessed += os.path.getsize(inputFilePath)
+        successFlag, err = logic.modifyDicomFile(inputFilePath, outputFilePath, headerOnly=headerOnly, editPlan=editPlan,
+          streamingThreshold=streamingThreshold)
+        status = 'modified' if successFlag else 'failed'
+      statusCounts[status] = statusCounts.get(status, 0) + 1
+  else:
+    for result in logic.iterModifyDicomFiles(filePathPairs, numWorkers=modeOptions.get('numWorkers', numWorkers),
+        headerOnly=headerOnly, editPlan=editPlan, pipelined=modeOptions.get('pipelined', False),
+        streamingThreshold=streamingThreshold):
+      if result.status != 'skipped':
+        bytesProcessed += os.path.getsize(result.inputFilePath)
+      statusCounts[result.status] = statusCounts.get(result.status, 0) + 1
+  seconds = time.perf_counter() - startTime
+  return {'seconds': seconds, 'filesProcessed': sum(statusCounts.values()) - statusCounts.get('skipped', 0),
+    'bytesProcessed': bytesProcessed, 'statusCounts': statusCounts,
+    'peakRssKilobytes': _peakRssKilobytes(resource.RUSAGE_SELF) if resource else None,
+    'peakWorkerRssKilobytes': _peakRssKilobytes(resource.RUSAGE_CHILDREN) if resource else None}
+
+
+def _peakRssKilobytes(who):
+  maxRss = resource.getrusage(who).ru_maxrss
+  # ru_maxrss is in bytes on macOS, kilobytes elsewhere
+  return maxRss // 1024 if sys.platform == 'darwin' else maxRss
+
+
+def _describeEnvironment(numWorkers):
+  return {'python': platform.python_version(), 'pydicom': pydicom.__version__, 'platform': platform.platform(),
+    'cpuCount': os.cpu_count(), 'numWorkers': numWorkers, 'gitRevision': _gitRevision(),
+    'time': time.strftime('%Y-%m-%dT%H:%M:%S%z')}
+
+
+def _gitRevision():
+  '''Revision of the DICOM_Modify source tree, if it is a git checkout'''
+  try:
+    return subprocess.run(['git', 'describe', '--always', '--dirty'], cwd=os.path.dirname(os.path.abspath(__file__)),
+      capture_output=True, text=True, check=True).stdout.strip()
+  except (OSError, subprocess.CalledProcessError):
+    return None
+
+
+def _splitNames(namesArgument, knownNames):
+  names = [name.strip() for name in namesArgument.split(',') if name.strip()]
+  unknownNames = [name for name in names if name not in knownNames]
+  if unknownNames:
+    raise argparse.ArgumentTypeError('unknown %s, expected some of %s' % (', '.join(unknownNames), ', '.join(knownNames)))
+  return names
+
+
+def createArgumentParser():
+  parser = argparse.ArgumentParser(prog='python -m DICOM_ModifyLib.Benchmark',
+    description='Benchmark DICOM_Modify on synthetic DICOM trees.')
+  parser.add_argument('--shapes', type=lambda names: _splitNames(names, list(CORPUS_SHAPES)), default=list(CORPUS_SHAPES),
+    help='comma separated corpus shapes (default: all of %s)' % ', '.join(CORPUS_SHAPES))
+  parser.add_argument('--modes', type=lambda names: _splitNames(names, list(BENCHMARK_MODES)), default=list(BENCHMARK_MODES),
+    help='comma separated modes (default: all of %s)' % ', '.join(BENCHMARK_MODES))
+  parser.add_argument('--scale', type=float, default=1.0, help='multiplies the number of files (frames) of each corpus')
+  parser.add_argument('--repeat', type=int, default=1, help='run every case this many times, and report the fastest')
+  parser.add_argument('-j', '--workers', type=int, default=None, help='number of worker processes of parallel batch modes')
+  parser.add_argument('--work-dir', help='generate the corpora here, and keep them afterwards (default: a temporary directory)')
+  parser.add_argument('--output', help='write the results JSON to this file (default: standard output)')
+  parser.add_argument('--baseline', help='compare files/sec with this earlier results JSON file')
+  parser.add_argument('--tolerance', type=float, default=0.1,
+    help='fraction by which a case may be slower than the baseline before it counts as a regression')
+  return parser
+
+
+def main(argv=None):
+  args = createArgumentParser().parse_args(argv)
+  logging.basicConfig(level=logging.INFO, format='%(message)s')
+  if args.work_dir:
+    os.makedirs(args.work_dir, exist_ok=True)
+    benchmarkResults = runBenchmarks(args.work_dir, args.shapes, args.modes, args.scale, args.repeat, args.workers)
+  else:
+    with tempfile.TemporaryDirectory(prefix='DICOM_ModifyBenchmark') as workDir:
+      benchmarkResults = runBenchmarks(workDir, args.shapes, args.modes, args.scale, args.repeat, args.workers)
+
+  if args.output:
+    with open(args.output, 'w', encoding='utf-8') as outputFile:
+      json.dump(benchmarkResults, outputFile, indent=2)
+  else:
+    json.dump(benchmarkResults, sys.stdout, indent=2)
+    sys.stdout.write('\n')
+
+  if args.baseline:
+    with open(args.baseline, 'r', encoding='utf-8') as baselineFile:
+      regressions = compareResults(json.load(baselineFile), benchmarkResults, args.tolerance)
+    for shape, mode, baselineRate, currentRate in regressions:
+      logging.warning('Regression in %s %s: %.1f files/s, was %.1f files/s' % (shape, mode, currentRate, baselineRate))
+    return 1 if regressions else 0
+  return 0
+
+
+if __name__ == '__main__':
+  sys.exit(main())
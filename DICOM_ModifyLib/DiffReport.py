@@ -0,0 +1,80 @@
+"""Dry run diffs of DICOM_Modify: what modifying each file would change, without writing anything.
+
+A dry run (ModifyLogic.previewDicomFile, or iterModifyDicomFiles with dryRun=True) applies the edits
+in memory to the header of each file (to the whole dataset only if the edits need it), and returns
+the TagChanges of the top level elements which differ.  Values are formatted as short text in the
+worker processes, so only a few strings per file are sent back, and a DiffReport streams them to a
+file as the results come in.
+"""
+
+import collections
+import json
+
+import pydicom
+
+# Formatted values longer than this are cut short
+MAX_VALUE_LENGTH = 64
+# Value representations of binary values, which are shown by their length only
+_BINARY_VRS = {'OB', 'OD', 'OF', 'OL', 'OV', 'OW', 'UN', 'OB or OW', 'US or OW'}
+
+# Change of one element: tag is "gggg,eeee", oldValue and newValue are formatted with formatElementValue,
+# oldValue is None if the element would be added, newValue None if it would be removed
+TagChange = collections.namedtuple('TagChange', ['tag', 'keyword', 'oldValue', 'newValue'])
+
+
+def formatElementValue(element):
+  '''Short text of the value of a data element, for showing in a diff'''
+  if element is None:
+    return None
+  if element.VR == 'SQ':
+    return '<sequence of %i items>' % len(element.value)
+  if element.VR in _BINARY_VRS:
+    return '<%i bytes>' % len(element.value or b'')
+  value = element.value
+  if value is None:
+    return ''
+  if isinstance(value, (pydicom.multival.MultiValue, list, tuple)):
+    text = '\\'.join(str(item) for item in value)
+  else:
+    text = str(value)
+  if len(text) > MAX_VALUE_LENGTH:
+    text = text[:MAX_VALUE_LENGTH - 3] + '...'
+  return text
+
+
+def formatChanges(result):
+  '''Lines of text showing the dry run result of one file (a ModifyResult)'''
+  if result.status == 'failed':
+    return ['%s: error: %s' % (result.inputFilePath, str(result.error))]
+  if result.status != 'wouldModify':
+    return ['%s: %s' % (result.inputFilePath, result.status)]
+  lines = ['%s: would modify' % result.inputFilePath]
+  for change in result.changes:
+    lines.append('  (%s) %s: %s -> %s' % (change.tag, change.keyword or 'Unknown',
+      '(absent)' if change.oldValue is None else repr(change.oldValue),
+      '(removed)' if change.newValue is None else repr(change.newValue)))
+  return lines
+
+
+class DiffReport:
+  """Report of a dry run, written as the results come in: one JSON line per file, with its status
+  ('wouldModify', 'unchanged', 'skipped' or 'failed') and either the changes, as
+  [tag, keyword, old value, new value] lists, or the error.  Pass its path to
+  ModifyLogic.iterModifyDicomFiles (diffReportPath=...).
+  """
+
+  def __init__(self, reportPath):
+    self.reportPath = reportPath
+    self._reportFile = open(reportPath, 'w', encoding='utf-8')
+
+  def record(self, result):
+    '''Add the dry run result of one file (a ModifyResult)'''
+    entry = {'input': result.inputFilePath, 'status': result.status}
+    if result.status == 'failed':
+      entry.update(errorType=type(result.error).__name__, error=str(result.error))
+    elif result.changes:
+      entry['changes'] = [list(change) for change in result.changes]
+    self._reportFile.write(json.dumps(entry) + '\n')
+
+  def close(self):
+    self._reportFile.close()
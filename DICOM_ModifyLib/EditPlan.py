@@ -0,0 +1,208 @@
+"""Compiled tag edits for DICOM_Modify.
+
+This module only depends on pydicom, it can be used without Slicer.
+"""
+
+import collections
+import copy
+import hashlib
+import re
+
+import pydicom
+
+from .UIDMap import UIDMap
+
+_INTEGER_VRS = {'SL', 'SS', 'SV', 'UL', 'US', 'UV'}
+_FLOAT_VRS = {'FD', 'FL'}
+_LIST_VALUE_PATTERN = re.compile(r"^\w*\[(.*)]\w*")
+# Value representations whose values may be padded with trailing spaces without changing their meaning
+_SPACE_PADDED_VRS = {'AE', 'AS', 'CS', 'DS', 'DT', 'IS', 'LO', 'LT', 'PN', 'SH', 'ST', 'TM', 'UC', 'UT'}
+# Value representations whose values are (possibly character set encoded) text
+_TEXT_VRS = _SPACE_PADDED_VRS | {'DA', 'UI', 'UR'}
+# Value representations with a 4 byte length (and 2 reserved bytes) in explicit VR encoding
+_LONG_LENGTH_VRS = {'OB', 'OD', 'OF', 'OL', 'OV', 'OW', 'SQ', 'SV', 'UC', 'UN', 'UR', 'UT', 'UV'}
+
+def encodeElementValue(element, isLittleEndian, isImplicitVR, encodings):
+  '''Return the encoded value bytes (without tag, VR and length) of a data element'''
+  fp = pydicom.filebase.DicomBytesIO()
+  fp.is_little_endian = isLittleEndian
+  fp.is_implicit_VR = isImplicitVR
+  pydicom.filewriter.write_data_element(fp, element, encodings)
+  if isImplicitVR:
+    headerSize = 8
+  else:
+    headerSize = 12 if element.VR in _LONG_LENGTH_VRS else 8
+  return fp.getvalue()[headerSize:]
+
+def padValueBytes(valueBytes, length, VR):
+  '''Pad encoded value bytes out to length, if that is allowed for the value representation.
+  Returns None if the value doesn't fit.
+  '''
+  if len(valueBytes) == length:
+    return valueBytes
+  if len(valueBytes) > length:
+    return None
+  if VR in _SPACE_PADDED_VRS:
+    return valueBytes + b' ' * (length - len(valueBytes))
+  if VR == 'UI':
+    return valueBytes + b'\0' * (length - len(valueBytes))
+  return None
+
+# element is None if the VR can only be taken from the existing element (private tags, ambiguous VRs)
+TagEdit = collections.namedtuple('TagEdit', ['tag', 'VR', 'value', 'element', 'createIfMissing'])
+
+class EditPlan:
+  """Tag edits which have been resolved, validated and converted once, so that applying them to
+  each file of a batch is only a matter of assigning data elements.  tagNameDict maps DICOM keywords
+  to new values (the element is added if the file doesn't have it), and tagNumDict maps tags, e.g.
+  (group, element) tuples, to new values (the file must already have the element).  String values
+  in square brackets are converted to lists, and numbers are converted for numeric VRs.
+  The UIDs of the remapUIDKeywords (e.g. SeriesInstanceUID) are replaced through the uidMap (a new
+  UIDMap if None) everywhere in the dataset, see UIDMap.remapDataset.
+  A profile (see Profile) is applied to the whole dataset before the edits, which take precedence
+  over its rules; its additions are set like tagNameDict values (those in tagNameDict win).
+  Raises ValueError for unknown keywords, bad tags, and values which can't be encoded.
+  """
+
+  def __init__(self, tagNameDict={}, tagNumDict={}, remapUIDKeywords=(), uidMap=None, profile=None):
+    self.edits = []
+    self.profile = profile
+    if profile is not None:
+      tagNameDict = dict(profile.additions, **tagNameDict)
+      if remapUIDKeywords:
+        raise ValueError('UIDs can\'t be remapped along with a profile, use U rules of the profile instead')
+    self._encodedValues = {} # encoded value bytes, by (tag, little endian, implicit VR, encodings)
+    for tagNum, value in tagNumDict.items():
+      try:
+        tag = pydicom.tag.Tag(tagNum)
+      except (ValueError, TypeError, OverflowError) as err:
+        raise ValueError('Invalid tag number %s: %s' % (str(tagNum), str(err)))
+      self.edits.append(self._compileEdit(tag, value, createIfMissing=False))
+    for tagName, value in tagNameDict.items():
+      tag = pydicom.datadict.tag_for_keyword(tagName)
+      if tag is None:
+        raise ValueError('%s is not a DICOM keyword' % tagName)
+      self.edits.append(self._compileEdit(pydicom.tag.Tag(tag), value, createIfMissing=True))
+    self.remapUIDKeywords = tuple(remapUIDKeywords)
+    for keyword in self.remapUIDKeywords:
+      tag = pydicom.datadict.tag_for_keyword(keyword)
+      if tag is None or pydicom.datadict.dictionary_VR(tag) != 'UI':
+        raise ValueError('%s is not the keyword of a UID element' % keyword)
+      if any(edit.tag == tag for edit in self.edits):
+        raise ValueError('%s can\'t be both set and remapped' % keyword)
+    needsUIDMap = self.remapUIDKeywords or (profile is not None and profile.usesUIDMap)
+    self.uidMap = (uidMap if uidMap is not None else UIDMap()) if needsUIDMap else None
+    self._editTags = {edit.tag for edit in self.edits}
+
+  def _compileEdit(self, tag, value, createIfMissing):
+    if isinstance(value, str):
+      value = convertTagValueString(value)
+    VR = pydicom.datadict.dictionary_VR(tag) if pydicom.datadict.dictionary_has_tag(tag) else None
+    if VR is None or ' or ' in VR:
+      # Private tag or ambiguous VR (e.g. 'US or SS'), the element is made per file (see _newElement)
+      return TagEdit(tag, None, value, None, createIfMissing)
+    try:
+      value = _coerceValue(VR, value)
+      # Validate the value the same way pydicom would when writing it (warns or raises, depending on the settings)
+      element = pydicom.dataelem.DataElement(tag, VR, value,
+        validation_mode=pydicom.config.settings.writing_validation_mode)
+      if VR not in _TEXT_VRS:
+        encodeElementValue(element, True, False, None) # check that binary values can be encoded
+    except Exception as err:
+      raise ValueError('Invalid value %s for %s (%s): %s' % (repr(value), str(tag), VR, str(err)))
+    return TagEdit(tag, VR, value, element, createIfMissing)
+
+  @property
+  def fingerprint(self):
+    '''Short hash identifying the edits, e.g. to recognize files already modified with the same plan'''
+    description = repr([(int(edit.tag), edit.VR, str(edit.value), edit.createIfMissing) for edit in self.edits])
+    if self.uidMap is not None:
+      description += repr((self.remapUIDKeywords, self.uidMap.salt, self.uidMap.prefix))
+    if self.profile is not None:
+      description += self.profile.fingerprint
+    return hashlib.sha256(description.encode('utf-8')).hexdigest()[:16]
+
+  @property
+  def isIdempotent(self):
+    '''True if applying the plan again to a file it was applied to changes nothing more, which is not
+    the case when UIDs are remapped or a profile is applied
+    '''
+    return self.uidMap is None and self.profile is None
+
+  def apply(self, ds):
+    '''Apply the profile and the edits to a pydicom dataset'''
+    if self.profile is not None:
+      self.profile.apply(ds, self.uidMap, self._editTags)
+    for edit in self.edits:
+      if edit.tag in ds:
+        if edit.element is not None and ds[edit.tag].VR == edit.VR:
+          ds[edit.tag] = copy.copy(edit.element)
+        else:
+          element = ds[edit.tag]
+          element.value = _coerceValue(element.VR, edit.value) # keep the VR the file uses
+      elif edit.createIfMissing:
+        ds[edit.tag] = copy.copy(edit.element) if edit.element is not None else _newElement(ds, edit)
+      else:
+        raise KeyError('Tag %s not found in dataset' % str(edit.tag))
+    if self.remapUIDKeywords:
+      self.uidMap.remapDataset(ds, self.remapUIDKeywords)
+
+  def wouldChange(self, ds):
+    '''True if applying the edits would change the dataset'''
+    if self.remapUIDKeywords:
+      return True # UIDs are always replaced with new ones
+    if self.profile is not None and self.profile.wouldChange(ds, self._editTags):
+      return True
+    for edit in self.edits:
+      if edit.tag not in ds:
+        return True
+      oldValue = ds[edit.tag].value
+      newValue = _coerceValue(ds[edit.tag].VR, edit.value) if edit.element is None else edit.element.value
+      # Compare the string forms too, e.g. DS values 1.0 and 1.00 are equal but not written the same
+      if oldValue != newValue or str(oldValue) != str(newValue):
+        return True
+    return False
+
+  def encodedValue(self, edit, isLittleEndian, isImplicitVR, encodings):
+    '''Return the encoded value bytes for an edit, encoding it only the first time'''
+    key = (edit.tag, isLittleEndian, isImplicitVR, tuple(encodings or ()))
+    if key not in self._encodedValues:
+      self._encodedValues[key] = encodeElementValue(edit.element, isLittleEndian, isImplicitVR, encodings)
+    return self._encodedValues[key]
+
+def _newElement(ds, edit):
+  '''New element for an edit of a tag with an ambiguous VR (e.g. 'US or SS'), with the VR it has in this
+  dataset (depending on e.g. PixelRepresentation)
+  '''
+  element = pydicom.dataelem.DataElement(edit.tag, pydicom.datadict.dictionary_VR(edit.tag), None)
+  if hasattr(ds, 'original_encoding'):
+    isLittleEndian = ds.original_encoding[1] is not False
+  else:
+    isLittleEndian = getattr(ds, 'read_little_endian', True) is not False # pydicom 2
+  element = pydicom.filewriter.correct_ambiguous_vr_element(element, ds, isLittleEndian)
+  # The value is set once the VR is known, since resolving it would try to convert a str value
+  element.value = _coerceValue(element.VR, edit.value)
+  return element
+
+def convertTagValueString(tagValueString):
+  '''Convert to list if in brackets, otherwise return unchanged'''
+  m = _LIST_VALUE_PATTERN.fullmatch(tagValueString)
+  if m:
+    # Split into a list of strings for multi-valued DICOM element
+    values = m[1].split(',') # split list elements by commas
+    tagValue = [v.strip() for v in values] # strip any extra whitespace around list elements
+  else:
+    # Not a multi-valued tag string, just return unmodified string (this is correct for numerical values as well)
+    tagValue = tagValueString
+  return tagValue
+
+def _coerceValue(VR, value):
+  '''Convert strings (or lists of strings) to numbers for numeric VRs, pydicom won't do this itself'''
+  if isinstance(value, list):
+    return [_coerceValue(VR, v) for v in value]
+  if isinstance(value, str):
+    if VR in _INTEGER_VRS:
+      return int(value, 0)
+    if VR in _FLOAT_VRS:
+      return float(value)
+  return value
@@ -0,0 +1,1361 @@
+"""DICOM tag modification logic of the DICOM_Modify module.
+
+This module only depends on pydicom (not on Slicer), so that batch modification can be run
+headless, e.g. from the command line (see __main__.py), and so that batch worker processes
+start quickly.
+"""
+
+import collections
+import concurrent.futures
+import functools
+import io
+import itertools
+import logging
+import mmap
+import multiprocessing
+import os
+import shutil
+import struct
+import time
+
+import pydicom
+
+from .Archive import ArchiveReader, ArchiveWriter, ConcatenatedStream
+from .BatchJournal import BatchJournal
+from .BatchReport import NULL_PHASE_TIMER, PhaseTimer
+from .DiffReport import DiffReport, TagChange, formatElementValue
+from .EditPlan import EditPlan, convertTagValueString, encodeElementValue, padValueBytes
+from .Profile import Profile
+from .SafeWrite import DeferredSync, atomicLink, atomicOutputFile, checkFsyncPolicy
+from .Sharding import selectShard
+from .TagIndex import DEFAULT_INDEX_KEYWORDS, TagIndex, parseFilterExpression
+from .UndoLog import UndoEntry, UndoLog, UndoRecord
+
+# Elements with these tags or later are never parsed in header only mode
+_FIRST_PIXEL_DATA_TAG = pydicom.tag.Tag(0x7FE0, 0x0008) # Float Pixel Data, just before (Double Float) Pixel Data
+_COPY_CHUNK_SIZE = 1024 * 1024
+# Chunk size of copies done by the OS (copy_file_range or sendfile), which don't pass the data through Python
+_KERNEL_COPY_CHUNK_SIZE = 64 * 1024 * 1024
+# Files at least this large are modified header only (the rest is streamed), so that memory use
+# doesn't grow with the size of (e.g. multi-frame) files
+STREAMING_THRESHOLD = 64 * 1024 * 1024
+# Files which are often found in DICOM folders but are not DICOM image files (lower case)
+_NON_DICOM_FILE_NAMES = {'dicomdir', 'thumbs.db', 'desktop.ini', 'autorun.inf', 'lockfile', 'version'}
+_NON_DICOM_FILE_EXTENSIONS = {'.txt', '.log', '.csv', '.json', '.xml', '.htm', '.html', '.pdf', '.ini', '.inf',
+  '.db', '.exe', '.dll', '.jpg', '.jpeg', '.png', '.gif', '.bmp', '.zip', '.md', '.nrrd', '.nii', '.gz', '.tmp'}
+# VRs with a 4 byte length in explicit VR encoding
+_EXPLICIT_LONG_LENGTH_VRS = {'OB', 'OD', 'OF', 'OL', 'OV', 'OW', 'SQ', 'SV', 'UC', 'UN', 'UR', 'UT', 'UV'}
+_KNOWN_VRS = {'AE', 'AS', 'AT', 'CS', 'DA', 'DS', 'DT', 'FD', 'FL', 'IS', 'LO', 'LT', 'OB', 'OD', 'OF', 'OL', 'OV',
+  'OW', 'PN', 'SH', 'SL', 'SQ', 'SS', 'ST', 'SV', 'TM', 'UC', 'UI', 'UL', 'UN', 'UR', 'US', 'UT', 'UV'}
+
+#
+# ModifyLogic
+#
+
+class ModifyLogic:
+  """Modification of tags in DICOM files with pydicom, for single files and batches.
+  DICOM_ModifyLogic in the Slicer module derives from this class.
+  """
+
+  def __init__(self):
+    self.progressInterval = 0.25 # minimum time between batch progress callbacks (seconds)
+    # Batch worker processes are started fresh ('spawn'), never forked: the batch may run in a background
+    # thread of a multi-threaded application (e.g. Slicer), which must not be forked.  They run
+    # workerExecutable, or sys.executable if None (which in an embedding application may not be Python).
+    self.workerStartMethod = 'spawn'
+    self.workerExecutable = None
+
+  def convertTagValueString(self, tagValueString):
+    """ Convert to list if in brackets, otherwise return unchanged
+    """
+    return convertTagValueString(tagValueString)
+
+  def compileEditPlan(self, tagNameDict={}, tagNumDict={}, remapUIDKeywords=(), uidMap=None, profile=None):
+    '''Resolve, validate and convert the requested tag edits once, see EditPlan.  profile is a
+    Profile, or the name of a built in profile or path of a rules file (see Profile.fromName).
+    Raises ValueError if any of the edits is invalid.
+    '''
+    if isinstance(profile, str):
+      profile = Profile.fromName(profile)
+    return EditPlan(tagNameDict, tagNumDict, remapUIDKeywords, uidMap, profile)
+
+  def isValidDICOMFile(self, filePath, allowNoPreamble=False):
+    '''Quick check that a file looks like a DICOM file, by reading only its first 132 bytes and
+    checking for the "DICM" prefix after the preamble.  If allowNoPreamble is True, files without
+    a preamble are also accepted if they start with a plausible data element.  Results are cached
+    by path, size and modification time.
+    '''
+    try:
+      fileStat = os.stat(filePath)
+    except OSError:
+      return False
+    return _probeDicomFile(filePath, fileStat.st_size, fileStat.st_mtime_ns, allowNoPreamble)
+
+  def modifyDicomFile(self, inputFilePath, outputFilePath, tagNameDict={}, tagNumDict={}, headerOnly=False, inPlacePatch=True,
+      editPlan=None, skipUnchanged=True, linkUnchanged=False, timer=None, allowNoPreamble=False,
+      streamingThreshold=STREAMING_THRESHOLD, fsyncPolicy='none', undoLog=None):
+    '''Do the actual modification. If headerOnly is True, only the header (everything before
+    the pixel data) is parsed and modified, and the rest of the input file is copied to the
+    output unchanged, so the pixel data is never decoded or held in memory.  Files of at least
+    streamingThreshold bytes (unless it is None) are always modified that way if the edits allow it.
+    If the output file is the input file and inPlacePatch is True, edits which fit in the
+    existing elements are written directly over the old values instead of rewriting the file,
+    unless the file has other hard links, which would see the changes too.
+    If skipUnchanged is True and every edited element already has its new value, nothing is
+    written when overwriting, and the input file is copied to the output otherwise (hard linked
+    if linkUnchanged is True; modifying either of them later replaces it with a new file).
+    If an editPlan (see compileEditPlan) is given, it is used instead of tagNameDict and tagNumDict.
+    If a timer (BatchReport.PhaseTimer) is given, the time spent in each phase and the bytes read
+    and written are added to it.  If allowNoPreamble is True, files without the preamble and "DICM"
+    prefix are also read.
+    Output files are written to a temporary file which then replaces the output path (see SafeWrite),
+    so an interrupted modification never leaves a truncated file; fsyncPolicy is 'file' or 'none'
+    (for single files, 'directory' is the same as 'file').
+    If an UndoLog is given, the original values of the elements which are changed are recorded in it
+    before the output file is written, see iterRollback.
+    Returns (successFlag, err).
+    '''
+    try: 
+      if editPlan is None:
+        editPlan = EditPlan(tagNameDict, tagNumDict)
+      checkFsyncPolicy(fsyncPolicy)
+      self._modifyDicomFile(inputFilePath, outputFilePath, editPlan, headerOnly, inPlacePatch, skipUnchanged, linkUnchanged,
+        timer or NULL_PHASE_TIMER, allowNoPreamble, streamingThreshold, 'file' if fsyncPolicy == 'directory' else fsyncPolicy,
+        undoLog)
+      return True, None
+    except Exception as err:
+      return False, err
+
+  def _modifyDicomFile(self, inputFilePath, outputFilePath, editPlan, headerOnly=False, inPlacePatch=True,
+      skipUnchanged=True, linkUnchanged=False, timer=NULL_PHASE_TIMER, allowNoPreamble=False,
+      streamingThreshold=STREAMING_THRESHOLD, fsyncPolicy='none', undoLog=None):
+    '''Implementation of modifyDicomFile, raises on errors.  Returns 'modified', or 'unchanged' if
+    nothing needed to be written.
+    '''
+    fileWork = self.readDicomFileStage(inputFilePath, outputFilePath, editPlan, headerOnly, inPlacePatch, skipUnchanged,
+      timer, allowNoPreamble, streamingThreshold, undoLog)
+    self.editDicomFileStage(fileWork, editPlan, headerOnly, skipUnchanged)
+    return self.writeDicomFileStage(fileWork, editPlan, linkUnchanged, allowNoPreamble, fsyncPolicy)
+
+  def previewDicomFile(self, inputFilePath, tagNameDict={}, tagNumDict={}, editPlan=None, allowNoPreamble=False):
+    '''Dry run of modifyDicomFile: apply the edits in memory only, to the header of the file if they
+    allow it, and return (changes, err), changes being the list of DiffReport.TagChanges of the top
+    level elements which would change (empty if the file would be unchanged), or None on errors.
+    Nothing is written (new UIDs of a UIDMap are not recorded either).
+    '''
+    try:
+      if editPlan is None:
+        editPlan = EditPlan(tagNameDict, tagNumDict)
+      changes = self._previewDicomFile(inputFilePath, editPlan, NULL_PHASE_TIMER, allowNoPreamble)
+      return changes, None
+    except Exception as err:
+      return None, err
+
+  def _previewDicomFile(self, inputFilePath, editPlan, timer=NULL_PHASE_TIMER, allowNoPreamble=False):
+    '''Implementation of previewDicomFile, raises on errors'''
+    if timer.enabled:
+      timer.bytesIn += os.path.getsize(inputFilePath)
+    with timer.phase('read'):
+      ds = None
+      if self.canModifyHeaderOnly(editPlan):
+        header = _readDicomHeader(inputFilePath, allowNoPreamble, self._mayAffectTrailingElements(editPlan))
+        if not header.hasTrailingElements:
+          ds = header.ds
+      if ds is None:
+        ds = pydicom.dcmread(inputFilePath, force=allowNoPreamble)
+    with timer.phase('edit'):
+      originalElements = _snapshotElements(ds)
+      try:
+        editPlan.apply(ds)
+      finally:
+        if editPlan.uidMap is not None:
+          editPlan.uidMap.discardNewEntries() # generated again when a real run uses them
+      return _diffElements(inputFilePath, originalElements, ds)
+
+  def readDicomFileStage(self, inputFilePath, outputFilePath, editPlan, headerOnly=False, inPlacePatch=True,
+      skipUnchanged=True, timer=NULL_PHASE_TIMER, allowNoPreamble=False, streamingThreshold=STREAMING_THRESHOLD,
+      undoLog=None):
+    '''First stage of modifyDicomFile: read what the edits need (just the header if possible) from the
+    input file.  Returns a FileWork to pass on to editDicomFileStage.
+    '''
+    fileWork = FileWork(inputFilePath, outputFilePath, timer)
+    fileWork.undoLog = undoLog
+    fileWork.overwrite = self._isSameFile(inputFilePath, outputFilePath)
+    # Patching a hard linked file (e.g. by linkUnchanged) would change the other links as well
+    patchInPlace = fileWork.overwrite and inPlacePatch and not _isHardLinked(inputFilePath)
+    fileSize = os.path.getsize(inputFilePath)
+    if timer.enabled:
+      timer.bytesIn += fileSize
+    # Large files are streamed as if headerOnly was given, so they are never read into memory whole
+    fileWork.headerOnly = headerOnly or (streamingThreshold is not None and fileSize >= streamingThreshold)
+    if (skipUnchanged or fileWork.headerOnly or patchInPlace) and self.canModifyHeaderOnly(editPlan):
+      # Everything needed to decide what to do is in the header, which is much cheaper to read
+      with timer.phase('read'):
+        fileWork.header = _readDicomHeader(inputFilePath, allowNoPreamble, self._mayAffectTrailingElements(editPlan))
+      if fileWork.header.hasTrailingElements:
+        # Profile rules may apply to the elements after the pixel data, which are not in the header
+        with timer.phase('read'):
+          fileWork.header = None
+          fileWork.ds = pydicom.dcmread(inputFilePath, force=allowNoPreamble)
+      elif patchInPlace:
+        # Must be found before the values are compared, because that converts the raw elements
+        with timer.phase('edit'):
+          fileWork.patches = self._findInPlacePatches(fileWork.header, editPlan)
+          if fileWork.patches is not None and undoLog is not None:
+            fileWork.undoRecord = _patchUndoRecord(outputFilePath, fileWork.header, editPlan)
+    else:
+      with timer.phase('read'):
+        fileWork.ds = pydicom.dcmread(inputFilePath, force=allowNoPreamble)
+    return fileWork
+
+  def editDicomFileStage(self, fileWork, editPlan, headerOnly=False, skipUnchanged=True):
+    '''Second stage of modifyDicomFile: decide how the file will be written (fileWork.action), and
+    apply the edits to the dataset read by readDicomFileStage.  Does no I/O.
+    '''
+    with fileWork.timer.phase('edit'):
+      header = fileWork.header
+      if header is not None:
+        if skipUnchanged and not editPlan.wouldChange(header.ds):
+          fileWork.action = 'unchanged'
+        elif fileWork.patches is not None:
+          fileWork.action = 'patch'
+        elif (headerOnly or fileWork.headerOnly) and not header.isDeflated:
+          self._applyEditPlan(fileWork, header.ds, editPlan)
+          fileWork.action = 'writeHeader'
+        else:
+          # Some edit doesn't fit in place, or the file can't be handled header only, the whole file
+          # is read, edited and written by the write stage
+          fileWork.action = 'rewrite'
+      elif skipUnchanged and not editPlan.wouldChange(fileWork.ds):
+        fileWork.action = 'unchanged'
+      else:
+        self._applyEditPlan(fileWork, fileWork.ds, editPlan)
+        fileWork.action = 'write'
+    return fileWork
+
+  def writeDicomFileStage(self, fileWork, editPlan, linkUnchanged=False, allowNoPreamble=False, fsyncPolicy='none'):
+    '''Last stage of modifyDicomFile: write the output file as decided by editDicomFileStage, with
+    the fsync policy ('file' or 'none', see SafeWrite).  Returns 'modified', or 'unchanged' if nothing
+    needed to be written.
+    '''
+    inputFilePath, outputFilePath, timer = fileWork.inputFilePath, fileWork.outputFilePath, fileWork.timer
+    if fileWork.action == 'unchanged':
+      if not fileWork.overwrite:
+        self._copyUnchangedFile(inputFilePath, outputFilePath, linkUnchanged, timer, fsyncPolicy)
+      return 'unchanged'
+    if fileWork.action == 'patch':
+      with timer.phase('write'):
+        if fileWork.undoLog is not None:
+          fileWork.undoLog.record(fileWork.undoRecord)
+        self._applyInPlacePatches(inputFilePath, fileWork.header, fileWork.patches, fsyncPolicy)
+      if timer.enabled:
+        timer.bytesOut += sum(len(valueBytes) for offset, valueBytes in fileWork.patches)
+      return 'modified'
+    if fileWork.action == 'rewrite':
+      with timer.phase('read'):
+        fileWork.ds = pydicom.dcmread(inputFilePath, force=allowNoPreamble)
+      with timer.phase('edit'):
+        self._applyEditPlan(fileWork, fileWork.ds, editPlan)
+    if fileWork.undoLog is not None:
+      # Written ahead, so the original values are in the log whenever the file has been changed
+      with timer.phase('write'):
+        fileWork.undoLog.record(fileWork.undoRecord)
+    # Ensure the folder to contain the output file exists (save_as will not create it!)
+    with timer.phase('mkdir'):
+      self._makeOutputDirectory(outputFilePath)
+    with timer.phase('write'):
+      if fileWork.action == 'writeHeader':
+        self._writeHeaderAndTail(fileWork.header, inputFilePath, outputFilePath, fsyncPolicy)
+      else:
+        # Save the output file
+        with atomicOutputFile(outputFilePath, fsyncPolicy) as outputFile:
+          fileWork.ds.save_as(outputFile)
+    if timer.enabled:
+      timer.bytesOut += os.path.getsize(outputFilePath)
+    return 'modified'
+
+  def _applyEditPlan(self, fileWork, ds, editPlan):
+    '''Apply the edit plan to the dataset of a file, and if an undo log is kept, make the undo record of
+    the elements it changed
+    '''
+    if fileWork.undoLog is None:
+      editPlan.apply(ds)
+      return
+    originalElements = _snapshotElements(ds)
+    editPlan.apply(ds)
+    fileWork.undoRecord = _undoRecord(fileWork.outputFilePath, originalElements, ds)
+
+  def canModifyHeaderOnly(self, editPlan):
+    '''Header only modification is possible if none of the tags to modify are at or after
+    the pixel data (those are copied from the input unchanged)
+    '''
+    if editPlan.profile is not None and editPlan.profile.affectsPixelData:
+      return False
+    return all(edit.tag < _FIRST_PIXEL_DATA_TAG for edit in editPlan.edits)
+
+  def _mayAffectTrailingElements(self, editPlan):
+    '''True if the profile of the edit plan may change elements after the pixel data (e.g. private
+    elements or Data Set Trailing Padding), so files having such elements can't be modified header only
+    '''
+    return editPlan.profile is not None and editPlan.profile.affectsTagsFrom(_FIRST_PIXEL_DATA_TAG)
+
+  def _findInPlacePatches(self, header, editPlan):
+    '''Find where to write the edited values directly over the old ones in the file, which is
+    possible if every edit replaces the value of an existing top level element and its encoding
+    fits in the existing value length.  Returns a list of (file offset, value bytes), or None if
+    any edit doesn't qualify.
+    '''
+    if header.isDeflated or editPlan.uidMap is not None or editPlan.profile is not None:
+      return None # new UIDs are generally longer than the old ones, and profiles remove elements
+    ds = header.ds
+    patches = []
+    for edit in editPlan.edits:
+      if edit.element is None or edit.tag.group == 0x0002:
+        return None # VR depends on the existing element, or file meta element (group length would change)
+      # Not yet accessed elements are still raw, and know where their value is in the file
+      rawElement = ds.get_item(edit.tag)
+      if not isinstance(rawElement, pydicom.dataelem.RawDataElement) or rawElement.length == 0xFFFFFFFF:
+        return None
+      if (rawElement.VR or edit.VR) != edit.VR or edit.VR == 'SQ':
+        return None
+      valueBytes = editPlan.encodedValue(edit, rawElement.is_little_endian, rawElement.is_implicit_VR, ds._character_set)
+      valueBytes = padValueBytes(valueBytes, rawElement.length, edit.VR)
+      if valueBytes is None:
+        return None
+      patches.append((rawElement.value_tell, valueBytes))
+    return patches
+
+  def _applyInPlacePatches(self, filePath, header, patches, fsyncPolicy='none'):
+    '''Overwrite just the bytes of the edited element values. Only the header region of the
+    file is memory mapped and touched, the length of the file never changes.
+    '''
+    if not patches:
+      return
+    with open(filePath, 'r+b') as outputFile:
+      with mmap.mmap(outputFile.fileno(), header.headerLength) as headerMap:
+        for offset, valueBytes in patches:
+          headerMap[offset:offset + len(valueBytes)] = valueBytes
+        if fsyncPolicy == 'file':
+          headerMap.flush()
+
+  def _isSameFile(self, inputFilePath, outputFilePath):
+    return os.path.exists(outputFilePath) and os.path.samefile(inputFilePath, outputFilePath)
+
+  def _writeHeaderAndTail(self, header, inputFilePath, outputFilePath, fsyncPolicy='none'):
+    '''Write the (modified) header dataset, and then stream the remaining bytes of the input file
+    (pixel data and anything after it) to the output.  The input file is still read while the
+    output is written next to it, so this also works when overwriting.
+    '''
+    with open(inputFilePath, 'rb') as inputFile, atomicOutputFile(outputFilePath, fsyncPolicy) as outputFile:
+      header.ds.save_as(outputFile)
+      _copyFileTail(inputFile, outputFile, header.headerLength)
+
+  def _copyUnchangedFile(self, inputFilePath, outputFilePath, linkUnchanged, timer=NULL_PHASE_TIMER, fsyncPolicy='none'):
+    '''Put an unchanged copy of the input file at the output path, as cheaply as possible'''
+    with timer.phase('mkdir'):
+      self._makeOutputDirectory(outputFilePath)
+    with timer.phase('write'):
+      if linkUnchanged:
+        try:
+          atomicLink(inputFilePath, outputFilePath, fsyncPolicy)
+          return
+        except OSError:
+          pass # e.g. different file systems, copy instead
+      with open(inputFilePath, 'rb') as inputFile, atomicOutputFile(outputFilePath, fsyncPolicy) as outputFile:
+        _copyFileTail(inputFile, outputFile, 0)
+    if timer.enabled:
+      timer.bytesOut += os.path.getsize(outputFilePath)
+
+  def _makeOutputDirectory(self, outputFilePath):
+    '''Create the folder to contain the output file and any needed parents (no error if it already exists)'''
+    dirPath, fileName = os.path.split(outputFilePath)
+    os.makedirs(dirPath, exist_ok=True)
+
+  def modifyDicomFiles(self, filePathPairs, tagNameDict={}, tagNumDict={}, **batchOptions):
+    '''Modify many DICOM files, spreading the work across a pool of worker processes.
+    filePathPairs is an iterable of (inputFilePath, outputFilePath) tuples.  Returns a list of
+    ModifyResult tuples, one per input pair, in input order.  See iterModifyDicomFiles for the
+    options.
+    '''
+    return list(self.iterModifyDicomFiles(filePathPairs, tagNameDict, tagNumDict, **batchOptions))
+
+  def iterModifyDicomFiles(self, filePathPairs, tagNameDict={}, tagNumDict={}, numWorkers=None, chunkSize=32,
+      headerOnly=False, inPlacePatch=True, skipInvalidFiles=True, allowNoPreamble=False, editPlan=None,
+      skipUnchanged=True, linkUnchanged=False, progressCallback=None, cancelEvent=None, journalPath=None, resume=False,
+      report=None, pipelined=False, readThreads=4, writeThreads=4, streamingThreshold=STREAMING_THRESHOLD,
+      fsyncPolicy='none', undoLogPath=None, manifest=None, dryRun=False, diffReportPath=None):
+    '''Generator version of modifyDicomFiles, yields a ModifyResult per file pair in input order
+    as soon as it is available.  filePathPairs is consumed lazily, in chunks of chunkSize pairs,
+    so it may be a generator, and only a bounded number of chunks is in flight at any time, so
+    memory use does not grow with the number of files.
+    numWorkers defaults to the number of CPUs; numWorkers=1 runs everything in this process.  Worker
+    processes are started as set by workerStartMethod and workerExecutable.
+    With pipelined=True, files are instead modified in this process by a pipeline of stages (see
+    _iterPipelinedResults): readThreads threads read files ahead, edits are applied as reads complete,
+    and writeThreads threads write the results, so that waiting for reads and writes (e.g. on a network
+    file system) overlaps with the edits; numWorkers and chunkSize are not used then.
+    headerOnly, inPlacePatch, skipUnchanged, linkUnchanged and streamingThreshold are passed on to modifyDicomFile.
+    Files are written atomically (see SafeWrite), with fsyncPolicy 'file', 'directory' (the files of
+    each chunk are synced by the worker which wrote them, by directory, before their results are
+    returned; when pipelined, as the results move on to another output directory) or 'none'.
+    If skipInvalidFiles is True, files which fail the isValidDICOMFile probe (with allowNoPreamble) are skipped without being
+    parsed.  The tag edits are compiled into an EditPlan (unless one is given) before any file is
+    touched, so invalid edits raise ValueError right away.
+    progressCallback, if given, is called with a BatchProgress every progressInterval seconds and
+    at the end, from the thread iterating over the results.  If cancelEvent (a threading.Event) is
+    set, no more files are dispatched; files already dispatched are finished and yielded.
+    If journalPath is given, the outcome of every file is appended to that BatchJournal by the process
+    which modified it, as soon as it is done (synced to disk unless fsyncPolicy is 'none', and flushed for
+    every file if the editPlan is not idempotent), so an interrupted batch is never done twice.  With
+    resume=True, files which the journal records as completed with the same edits, and which haven't
+    changed since, are not processed again; their result has the status 'alreadyDone'.
+    If a BatchReport is given as report, the phases of modifying every file are timed (the timings are
+    also in the metrics of each result), and the report is filled in as results are yielded.
+    If undoLogPath is given, the original values of the elements changed in every modified file are
+    appended to that UndoLog before the file is written, so the batch can be undone with iterRollback
+    without keeping a copy of the files.  Only with fsyncPolicy 'file' is every record on disk before
+    its file is written.
+    If a ShardManifest is given as manifest, the outcome and phase timings of every file are written to
+    it, e.g. for one shard of a batch split with iterShardFilePathPairs.
+    With dryRun=True nothing is written: every file is previewed as with previewDicomFile (in parallel
+    as usual), the result status is 'wouldModify' instead of 'modified', and the changes are in the
+    results, and written to the DiffReport at diffReportPath if given.  New UIDs are not recorded in
+    the UID map, and a journal or undo log can't be kept.
+    '''
+    if editPlan is None:
+      editPlan = EditPlan(tagNameDict, tagNumDict)
+    checkFsyncPolicy(fsyncPolicy)
+    if dryRun and (journalPath or undoLogPath):
+      raise ValueError('A dry run can not keep a journal or an undo log')
+    if diffReportPath and not dryRun:
+      raise ValueError('A diff report is only written by a dry run')
+    undoLog = UndoLog(undoLogPath, fsyncPolicy) if undoLogPath else None
+    # Files modified in place by edits which can't be applied twice must never be done again on resume
+    journal = BatchJournal(journalPath, editPlan.fingerprint, resume, flushInterval=100 if editPlan.isIdempotent else 1,
+      fsyncPolicy=fsyncPolicy) if journalPath else None
+    batchOptions = {'editPlan': editPlan, 'headerOnly': headerOnly, 'inPlacePatch': inPlacePatch,
+      'skipInvalidFiles': skipInvalidFiles, 'allowNoPreamble': allowNoPreamble, 'skipUnchanged': skipUnchanged,
+      'linkUnchanged': linkUnchanged, 'streamingThreshold': streamingThreshold,
+      'fsyncPolicy': 'none' if fsyncPolicy == 'directory' else fsyncPolicy, 'undoLog': undoLog, 'dryRun': dryRun,
+      'collectMetrics': report is not None or manifest is not None, 'journal': journal}
+    discoveredFilePathPairs = _CountingIterator(filePathPairs, timed=report is not None)
+    batchItems = discoveredFilePathPairs
+    if journal is not None and resume:
+      batchItems = _iterNotYetDone(batchItems, journal)
+    if pipelined:
+      results = self._iterPipelinedResults(batchItems, batchOptions, readThreads, writeThreads, cancelEvent)
+    else:
+      results = self._iterBatchResults(batchItems, batchOptions, numWorkers, chunkSize, cancelEvent,
+        syncOutputs=fsyncPolicy == 'directory' and not dryRun)
+    if editPlan.uidMap is not None and not dryRun:
+      results = _iterWithUIDMap(results, editPlan.uidMap)
+    if undoLog is not None:
+      results = _iterWithUndoLog(results, undoLog)
+    if fsyncPolicy == 'directory' and pipelined and not dryRun:
+      results = _iterWithDeferredSync(results) # written by threads of this process
+    if diffReportPath:
+      results = _iterWithDiffReport(results, diffReportPath)
+    if journal is not None:
+      results = _iterWithJournal(results, journal)
+    if manifest is not None:
+      results = _iterWithManifest(results, manifest, editPlan.fingerprint, cancelEvent)
+    if report is not None:
+      results = _iterWithReport(results, discoveredFilePathPairs, report)
+    if progressCallback is not None:
+      results = _iterWithProgress(results, discoveredFilePathPairs, progressCallback, self.progressInterval)
+    return results
+
+  def _iterBatchResults(self, batchItems, batchOptions, numWorkers, chunkSize, cancelEvent, syncOutputs=False):
+    '''Dispatch the files in chunks (to worker processes if numWorkers > 1), yield results in order.
+    batchItems are (inputFilePath, outputFilePath) pairs, or ModifyResults for files which need no
+    processing, which are passed through in order.  If syncOutputs, the files of each chunk are synced
+    by the worker which wrote them before it returns their results (see _modifyBatchChunk).
+    '''
+    if numWorkers is None:
+      numWorkers = os.cpu_count() or 1
+    chunks = _iterChunks(batchItems, chunkSize)
+    if numWorkers <= 1:
+      # No pool, just run the chunks here
+      for chunk in chunks:
+        chunkResults = iter(self._modifyBatchChunk([item for item in chunk if not isinstance(item, ModifyResult)],
+          batchOptions, syncOutputs))
+        for item in chunk:
+          yield item if isinstance(item, ModifyResult) else next(chunkResults)
+        if cancelEvent is not None and cancelEvent.is_set():
+          return
+      return
+    maxPendingChunks = 2 * numWorkers # enough to keep every worker busy while results are collected
+    with concurrent.futures.ProcessPoolExecutor(max_workers=numWorkers, mp_context=self._workerContext(),
+        initializer=_initBatchWorker, initargs=(batchOptions,)) as executor:
+      pending = collections.deque()
+      for chunk in chunks:
+        filePathPairs = [item for item in chunk if not isinstance(item, ModifyResult)]
+        future = executor.submit(_modifyDicomFileChunk, filePathPairs, syncOutputs) if filePathPairs else None
+        pending.append((chunk, future))
+        if len(pending) >= maxPendingChunks:
+          yield from _collectChunkResults(*pending.popleft())
+        if cancelEvent is not None and cancelEvent.is_set():
+          break
+      while pending:
+        yield from _collectChunkResults(*pending.popleft())
+
+  def _workerContext(self):
+    '''multiprocessing context of the batch worker processes, see workerStartMethod'''
+    context = multiprocessing.get_context(self.workerStartMethod)
+    if self.workerExecutable is not None and self.workerStartMethod != 'fork':
+      context.set_executable(self.workerExecutable)
+    return context
+
+  def _iterPipelinedResults(self, batchItems, batchOptions, readThreads, writeThreads, cancelEvent):
+    '''Modify the files with the read, edit and write stages of modifyDicomFile overlapping, and yield
+    results in order.  Reads (readDicomFileStage) run in a pool of readThreads threads, edits
+    (editDicomFileStage) in this thread as reads complete, and writes (writeDicomFileStage) in a pool
+    of writeThreads threads.  At most twice as many files as threads are waiting in each of the read
+    and write queues, so reading ahead stops when edits or writes fall behind, and memory use stays
+    bounded (one header, or one whole dataset if the file needs a full rewrite, per queued file).
+    batchItems are as for _iterBatchResults.
+    '''
+    maxPendingReads = 2 * max(readThreads, 1)
+    maxPendingWrites = 2 * max(writeThreads, 1)
+    pendingReads = collections.deque() # ModifyResults and futures of _readPipelinedFile
+    pendingWrites = collections.deque() # ModifyResults and futures of _writePipelinedFile
+    with concurrent.futures.ThreadPoolExecutor(max(readThreads, 1), thread_name_prefix='DICOM_ModifyRead') as readExecutor, \
+        concurrent.futures.ThreadPoolExecutor(max(writeThreads, 1), thread_name_prefix='DICOM_ModifyWrite') as writeExecutor:
+      def editReadFiles(waitForAll):
+        # Edit the files whose reads are done (or wait for the oldest read if the read queue is full),
+        # keeping the order of the files
+        while pendingReads and (waitForAll or len(pendingReads) >= maxPendingReads or _isReady(pendingReads[0])):
+          readItem = _getReadyItem(pendingReads.popleft())
+          if isinstance(readItem, ModifyResult):
+            pendingWrites.append(readItem)
+          else:
+            editResult = self._editPipelinedFile(readItem, batchOptions)
+            pendingWrites.append(editResult if editResult is not None else
+              writeExecutor.submit(self._writePipelinedFile, readItem, batchOptions))
+          while len(pendingWrites) >= maxPendingWrites or (pendingWrites and _isReady(pendingWrites[0])):
+            yield _getReadyItem(pendingWrites.popleft())
+
+      for item in batchItems:
+        pendingReads.append(item if isinstance(item, ModifyResult) else
+          readExecutor.submit(self._readPipelinedFile, item[0], item[1], batchOptions))
+        yield from editReadFiles(waitForAll=False)
+        if cancelEvent is not None and cancelEvent.is_set():
+          break
+      yield from editReadFiles(waitForAll=True)
+      while pendingWrites:
+        yield _getReadyItem(pendingWrites.popleft())
+
+  def _readPipelinedFile(self, inputFilePath, outputFilePath, batchOptions):
+    '''Read stage of a pipelined batch, returns a FileWork, or a ModifyResult if the file was skipped or failed'''
+    if batchOptions['dryRun']:
+      return self._modifyBatchFile(inputFilePath, outputFilePath, **batchOptions) # all done while reading
+    timer = PhaseTimer() if batchOptions['collectMetrics'] else NULL_PHASE_TIMER
+    metrics = timer if batchOptions['collectMetrics'] else None
+    if batchOptions['skipInvalidFiles']:
+      with timer.phase('probe'):
+        isValid = self.isValidDICOMFile(inputFilePath, batchOptions['allowNoPreamble'])
+      if not isValid:
+        err = pydicom.errors.InvalidDicomError('Not a DICOM file: %s' % inputFilePath)
+        return _journaled(ModifyResult(inputFilePath, outputFilePath, False, err, 'skipped', metrics),
+          batchOptions['journal'])
+    try:
+      return self.readDicomFileStage(inputFilePath, outputFilePath, batchOptions['editPlan'], batchOptions['headerOnly'],
+        batchOptions['inPlacePatch'], batchOptions['skipUnchanged'], timer, batchOptions['allowNoPreamble'],
+        batchOptions['streamingThreshold'], batchOptions['undoLog'])
+    except Exception as err:
+      return _journaled(ModifyResult(inputFilePath, outputFilePath, False, err, 'failed', metrics), batchOptions['journal'])
+
+  def _editPipelinedFile(self, fileWork, batchOptions):
+    '''Edit stage of a pipelined batch, returns a ModifyResult if the file failed, None otherwise'''
+    try:
+      self.editDicomFileStage(fileWork, batchOptions['editPlan'], batchOptions['headerOnly'], batchOptions['skipUnchanged'])
+    except Exception as err:
+      return _journaled(ModifyResult(fileWork.inputFilePath, fileWork.outputFilePath, False, err, 'failed',
+        _getMetrics(fileWork)), batchOptions['journal'])
+    return None
+
+  def _writePipelinedFile(self, fileWork, batchOptions):
+    '''Write stage of a pipelined batch, returns the ModifyResult of the file'''
+    try:
+      status = self.writeDicomFileStage(fileWork, batchOptions['editPlan'], batchOptions['linkUnchanged'],
+        batchOptions['allowNoPreamble'], batchOptions['fsyncPolicy'])
+    except Exception as err:
+      return _journaled(ModifyResult(fileWork.inputFilePath, fileWork.outputFilePath, False, err, 'failed',
+        _getMetrics(fileWork)), batchOptions['journal'])
+    return _journaled(ModifyResult(fileWork.inputFilePath, fileWork.outputFilePath, True, None, status,
+      _getMetrics(fileWork), _takeUIDMappings(batchOptions['editPlan'])), batchOptions['journal'])
+
+  def _modifyBatchChunk(self, filePathPairs, batchOptions, syncOutputs=False):
+    '''Modify a chunk of files of a batch and return their ModifyResults.  If syncOutputs, the files
+    written are synced first, by directory (the 'directory' fsync policy, see DeferredSync).
+    '''
+    results = [self._modifyBatchFile(inputFilePath, outputFilePath, **batchOptions)
+      for inputFilePath, outputFilePath in filePathPairs]
+    if batchOptions['journal'] is not None:
+      batchOptions['journal'].flush()
+    if syncOutputs:
+      deferredSync = DeferredSync()
+      for result in results:
+        if _isWritten(result):
+          deferredSync.add(result.outputFilePath)
+      deferredSync.sync()
+    return results
+
+  def _modifyBatchFile(self, inputFilePath, outputFilePath, editPlan, headerOnly, inPlacePatch,
+      skipInvalidFiles, allowNoPreamble, skipUnchanged, linkUnchanged, streamingThreshold, fsyncPolicy, undoLog,
+      dryRun, collectMetrics, journal=None):
+    '''Modify (or with dryRun, preview) one file of a batch and return its ModifyResult, recorded in the
+    journal (if one is kept) by this process as soon as the file is done
+    '''
+    timer = PhaseTimer() if collectMetrics else NULL_PHASE_TIMER
+    metrics = timer if collectMetrics else None
+    if skipInvalidFiles:
+      with timer.phase('probe'):
+        isValid = self.isValidDICOMFile(inputFilePath, allowNoPreamble)
+      if not isValid:
+        err = pydicom.errors.InvalidDicomError('Not a DICOM file: %s' % inputFilePath)
+        return _journaled(ModifyResult(inputFilePath, outputFilePath, False, err, 'skipped', metrics), journal)
+    if dryRun:
+      try:
+        changes = self._previewDicomFile(inputFilePath, editPlan, timer, allowNoPreamble)
+      except Exception as err:
+        return ModifyResult(inputFilePath, outputFilePath, False, err, 'failed', metrics)
+      return ModifyResult(inputFilePath, outputFilePath, True, None, 'wouldModify' if changes else 'unchanged', metrics,
+        changes=changes)
+    try:
+      status = self._modifyDicomFile(inputFilePath, outputFilePath, editPlan, headerOnly, inPlacePatch,
+        skipUnchanged, linkUnchanged, timer, allowNoPreamble, streamingThreshold, fsyncPolicy, undoLog)
+    except Exception as err:
+      return _journaled(ModifyResult(inputFilePath, outputFilePath, False, err, 'failed', metrics), journal)
+    return _journaled(ModifyResult(inputFilePath, outputFilePath, True, None, status, metrics, _takeUIDMappings(editPlan)),
+      journal)
+
+  def iterRollback(self, undoLogPath, allowNoPreamble=False, progressCallback=None, fsyncPolicy='none'):
+    '''Undo the modifications recorded in an UndoLog (see iterModifyDicomFiles), newest first, by
+    writing back the original values of the changed elements (and removing the elements which were
+    added).  Values which fit where the current ones are (e.g. after edits which were patched in
+    place) are patched in place, otherwise the header is rewritten and the pixel data copied, so
+    rolling back costs about as much as the modification did.  Rolling back again does no harm.
+    Yields a ModifyResult per record, with status 'modified' or 'failed'.
+    '''
+    checkFsyncPolicy(fsyncPolicy)
+    records = _CountingIterator(UndoLog(undoLogPath).iterRecords())
+    results = (self._rollbackRecord(record, allowNoPreamble, 'none' if fsyncPolicy == 'directory' else fsyncPolicy)
+      for record in records)
+    if fsyncPolicy == 'directory':
+      results = _iterWithDeferredSync(results)
+    if progressCallback is not None:
+      results = _iterWithProgress(results, records, progressCallback, self.progressInterval)
+    return results
+
+  def _rollbackRecord(self, record, allowNoPreamble, fsyncPolicy):
+    '''Roll back one UndoRecord and return its ModifyResult'''
+    filePath = record.filePath
+    try:
+      if all(entry.tag < _FIRST_PIXEL_DATA_TAG for entry in record.entries):
+        header = _readDicomHeader(filePath, allowNoPreamble)
+        if not header.isDeflated:
+          patches = _rollbackPatches(header, record)
+          if patches is not None and not _isHardLinked(filePath):
+            self._applyInPlacePatches(filePath, header, patches, fsyncPolicy)
+          else:
+            _restoreElements(header.ds, record)
+            self._writeHeaderAndTail(header, filePath, filePath, fsyncPolicy)
+          return ModifyResult(filePath, filePath, True, None, 'modified')
+      ds = pydicom.dcmread(filePath, force=allowNoPreamble)
+      _restoreElements(ds, record)
+      with atomicOutputFile(filePath, fsyncPolicy) as outputFile:
+        ds.save_as(outputFile)
+    except Exception as err:
+      return ModifyResult(filePath, filePath, False, err, 'failed')
+    return ModifyResult(filePath, filePath, True, None, 'modified')
+
+  def iterModifyArchive(self, inputArchivePath, outputArchivePath, tagNameDict={}, tagNumDict={}, editPlan=None,
+      skipUnchanged=True, allowNoPreamble=False, progressCallback=None, cancelEvent=None, report=None,
+      fsyncPolicy='none'):
+    '''Modify the DICOM files in a ZIP or TAR archive (possibly compressed), writing an archive with
+    the same members (at the same relative paths) to outputArchivePath, whose extension gives its
+    format (e.g. .zip, .tar.gz).  Nothing is extracted to disk: members are read from the input one
+    at a time, the header of DICOM files is parsed and edited, and the edited header followed by the
+    rest of the member is streamed into the output archive.  Only if an edit is at or after the pixel
+    data, or the file is deflated, a member is read into memory whole.
+    Yields a ModifyResult per file member, with the archive path joined with the member name as file
+    paths.  Non-DICOM members, and members whose modification failed, are stored unchanged.  The
+    output archive is written atomically (see SafeWrite), so it may be the input archive; it is only
+    written if all results are consumed.  If cancelEvent is set, the remaining members are stored
+    unchanged.  See iterModifyDicomFiles for the other options.
+    '''
+    if editPlan is None:
+      editPlan = EditPlan(tagNameDict, tagNumDict)
+    checkFsyncPolicy(fsyncPolicy)
+    reader = ArchiveReader(inputArchivePath)
+    discoveredMembers = _CountingIterator(reader, timed=report is not None)
+    results = self._iterArchiveResults(reader, discoveredMembers, outputArchivePath, editPlan, skipUnchanged,
+      allowNoPreamble, report is not None, cancelEvent, 'file' if fsyncPolicy == 'directory' else fsyncPolicy)
+    if editPlan.uidMap is not None:
+      results = _iterWithUIDMap(results, editPlan.uidMap)
+    if report is not None:
+      results = _iterWithReport(results, discoveredMembers, report)
+    if progressCallback is not None:
+      results = _iterWithProgress(results, discoveredMembers, progressCallback, self.progressInterval)
+    return results
+
+  def _iterArchiveResults(self, reader, members, outputArchivePath, editPlan, skipUnchanged, allowNoPreamble,
+      collectMetrics, cancelEvent, fsyncPolicy):
+    with reader, atomicOutputFile(outputArchivePath, fsyncPolicy) as outputFile, \
+        ArchiveWriter(outputFile, outputArchivePath) as writer:
+      for member in members:
+        if member.kind != 'file':
+          writer.addMember(member)
+        elif cancelEvent is not None and cancelEvent.is_set():
+          writer.addFile(member, member.size, reader.openMember(member).tail())
+        else:
+          yield self._modifyArchiveMember(reader, writer, member, editPlan, skipUnchanged, allowNoPreamble,
+            collectMetrics)
+
+  def _modifyArchiveMember(self, reader, writer, member, editPlan, skipUnchanged, allowNoPreamble, collectMetrics):
+    '''Modify one file member of an archive into the output archive, and return its ModifyResult'''
+    timer = PhaseTimer() if collectMetrics else NULL_PHASE_TIMER
+    metrics = timer if collectMetrics else None
+    inputFilePath = os.path.join(reader.archivePath, member.name)
+    outputFilePath = os.path.join(writer.archivePath, member.name)
+    if timer.enabled:
+      timer.bytesIn += member.size
+    stream = reader.openMember(member)
+    with timer.phase('probe'):
+      isValid = _isDicomPrefix(stream.read(132), member.size, allowNoPreamble)
+      stream.seek(0)
+    try:
+      if not isValid:
+        err = pydicom.errors.InvalidDicomError('Not a DICOM file: %s' % inputFilePath)
+        status = 'skipped'
+      else:
+        with timer.phase('read'):
+          header = _readDicomHeaderFromFile(stream, allowNoPreamble)
+        # Members can't be searched for elements after the pixel data without reading them through, so
+        # if the profile may change those, members are read whole unless they are large
+        headerOnly = self.canModifyHeaderOnly(editPlan) and not header.isDeflated and (
+          not self._mayAffectTrailingElements(editPlan) or member.size >= STREAMING_THRESHOLD)
+        with timer.phase('edit'):
+          if headerOnly and skipUnchanged and not editPlan.wouldChange(header.ds):
+            status = 'unchanged'
+          elif headerOnly:
+            editPlan.apply(header.ds)
+            headerBytes = _encodeDataset(header.ds)
+            status = 'modified'
+          else:
+            status = 'rewrite'
+        if status == 'rewrite':
+          with timer.phase('read'):
+            stream.seek(0)
+            ds = pydicom.dcmread(stream, force=allowNoPreamble)
+          with timer.phase('edit'):
+            if skipUnchanged and not editPlan.wouldChange(ds):
+              status = 'unchanged'
+            else:
+              editPlan.apply(ds)
+              fileBytes = _encodeDataset(ds)
+    except Exception as err:
+      # The member goes into the output archive unchanged
+      status = 'failed'
+      failure = err
+    with timer.phase('write'):
+      if status == 'modified':
+        stream.seek(header.headerLength)
+        outputSize = len(headerBytes) + member.size - header.headerLength
+        writer.addFile(member, outputSize, ConcatenatedStream([io.BytesIO(headerBytes), stream.tail()]))
+      elif status == 'rewrite':
+        outputSize = len(fileBytes)
+        writer.addFile(member, outputSize, io.BytesIO(fileBytes))
+        status = 'modified'
+      else:
+        outputSize = member.size
+        stream.seek(0)
+        writer.addFile(member, outputSize, stream.tail())
+    if timer.enabled:
+      timer.bytesOut += outputSize
+    if status == 'skipped':
+      return ModifyResult(inputFilePath, outputFilePath, False, err, 'skipped', metrics)
+    if status == 'failed':
+      return ModifyResult(inputFilePath, outputFilePath, False, failure, 'failed', metrics)
+    return ModifyResult(inputFilePath, outputFilePath, True, None, status, metrics, _takeUIDMappings(editPlan))
+
+  def iterFilePaths(self, dirName, recursive=False, filterNonDicom=True):
+    '''Lazily yield the paths of all files in a directory, and in its subdirectories if recursive
+    is True. If filterNonDicom is True, files which are obviously not DICOM files (by name, e.g.
+    DICOMDIR, text files, thumbnails) are skipped without being opened.
+    '''
+    for filePath, _ in self._iterFilePathsWithRelativeDir(dirName, recursive, filterNonDicom):
+      yield filePath
+
+  def iterFilePathPairs(self, inputDirectory, outputDirectory, recursive=False, filterNonDicom=True):
+    '''Lazily yield (inputFilePath, outputFilePath) for the files found by iterFilePaths, where
+    the output path has the same path relative to outputDirectory as the input path has relative
+    to inputDirectory.
+    '''
+    for filePath, relativeDir in self._iterFilePathsWithRelativeDir(inputDirectory, recursive, filterNonDicom):
+      yield filePath, os.path.join(outputDirectory, relativeDir, os.path.basename(filePath))
+
+  def iterFilteredFilePathPairs(self, inputDirectory, outputDirectory, filterExpression, recursive=False,
+      filterNonDicom=True, indexPath=None, allowNoPreamble=False):
+    '''Like iterFilePathPairs, but only for the DICOM files whose header tags match the filter
+    expression (see TagIndex.parseFilterExpression).  The headers are looked up in the TagIndex at
+    indexPath (a temporary one if None), which is refreshed first, so only new and changed files are
+    read.  The expression is checked right away (ValueError if invalid); the index is only opened
+    and refreshed once iteration starts, in the iterating thread.
+    '''
+    filterKeywords = parseFilterExpression(filterExpression)[0]
+    def iterMatchingPairs():
+      tagIndex = TagIndex(indexPath or ':memory:', DEFAULT_INDEX_KEYWORDS + tuple(filterKeywords))
+      try:
+        tagIndex.refresh(inputDirectory, self.iterFilePaths(inputDirectory, recursive, filterNonDicom), recursive,
+          allowNoPreamble, isDicomFile=lambda filePath: self.isValidDICOMFile(filePath, allowNoPreamble))
+        for filePath in tagIndex.query(filterExpression, inputDirectory, recursive):
+          relativeDir = os.path.relpath(os.path.dirname(filePath), os.path.abspath(inputDirectory))
+          yield filePath, os.path.normpath(os.path.join(outputDirectory, relativeDir, os.path.basename(filePath)))
+      finally:
+        tagIndex.close()
+    return iterMatchingPairs()
+
+  def iterShardFilePathPairs(self, filePathPairs, inputDirectory, shardIndex, shardCount, strategy='hash', planPath=None):
+    '''Yield the (input path, output path) pairs (e.g. from iterFilePathPairs of inputDirectory) of shard
+    shardIndex out of shardCount, so that several machines can each modify a part of a tree, with no
+    coordination: strategy 'hash' selects files by a hash of their relative path as they are listed,
+    'size' balances the total size of the shards, sharing the plan through the planPath file if given.
+    See Sharding.
+    '''
+    return selectShard(filePathPairs, inputDirectory, shardIndex, shardCount, strategy, planPath)
+
+  def _iterFilePathsWithRelativeDir(self, dirName, recursive, filterNonDicom):
+    '''Walk the directory tree with os.scandir, depth first, without building any list of the
+    whole tree. Yields (filePath, directory path relative to dirName).  Like os.walk, directories
+    which can't be listed (e.g. no permission, or removed meanwhile) are skipped, with a warning.
+    '''
+    pendingDirs = [(dirName, '')]
+    while pendingDirs:
+      currentDir, relativeDir = pendingDirs.pop()
+      subDirs = []
+      try:
+        with os.scandir(currentDir) as entries:
+          for entry in entries:
+            try:
+              isDir = entry.is_dir()
+            except OSError:
+              isDir = False # like os.walk
+            if isDir:
+              # Like os.walk, don't follow symbolic links to directories
+              if recursive and not entry.is_symlink():
+                subDirs.append((entry.path, os.path.join(relativeDir, entry.name)))
+            elif not filterNonDicom or _isCandidateDicomFileName(entry.name):
+              yield entry.path, relativeDir
+      except OSError as err:
+        logging.warning('Skipped directory %s: %s' % (currentDir, str(err)))
+      # Reversed so that subdirectories are visited in the order they were listed
+      pendingDirs.extend(reversed(subDirs))
+
+  def getListOfFiles(self, dirName, recursive=False):
+    ''' Get a list of all files in a directory. Include files in subdirectories
+    if recursive flag is set to True (default is False)
+    '''
+    return list(self.iterFilePaths(dirName, recursive, filterNonDicom=False))
+
+
+#
+# Batch helpers (module level so that they can be used in worker processes)
+#
+
+# status is one of 'modified', 'unchanged' (all edited elements already had their new values), 'skipped' (not a
+# DICOM file), 'failed', 'alreadyDone' (done by an earlier run, see BatchJournal), or in a dry run 'wouldModify'
+class FileWork:
+  """State of one file passed between the stages of modifyDicomFile: the header (a _DicomHeader) or
+  the whole dataset (ds) read from the input file, in place patches if they apply, and the action
+  decided by the edit stage: 'unchanged', 'patch', 'writeHeader', 'write' or 'rewrite'.  headerOnly is
+  True if the file is modified header only, because it was asked for or because the file is large.
+  If an UndoLog is kept, undoRecord is the UndoRecord written to it before the output file.
+  """
+  __slots__ = ('inputFilePath', 'outputFilePath', 'timer', 'overwrite', 'headerOnly', 'header', 'ds', 'patches', 'action',
+    'undoLog', 'undoRecord')
+
+  def __init__(self, inputFilePath, outputFilePath, timer=NULL_PHASE_TIMER):
+    self.inputFilePath = inputFilePath
+    self.outputFilePath = outputFilePath
+    self.timer = timer
+    self.overwrite = False
+    self.headerOnly = False
+    self.header = None
+    self.ds = None
+    self.patches = None
+    self.action = None
+    self.undoLog = None
+    self.undoRecord = None
+
+# metrics is the PhaseTimer of the file if the batch collected metrics (see BatchReport), None otherwise.
+# uidMappings are the (old UID, new UID) entries generated while modifying the file if UIDs are remapped
+# (see UIDMap), so that the batch can record them in the map of the main process.
+# changes are the DiffReport.TagChanges of the file in a dry run.
+ModifyResult = collections.namedtuple('ModifyResult', ['inputFilePath', 'outputFilePath', 'success', 'error', 'status',
+  'metrics', 'uidMappings', 'changes'], defaults=[None, None, None])
+
+class BatchProgress(collections.namedtuple('BatchProgress',
+    ['filesDone', 'filesFailed', 'filesDiscovered', 'discoveryComplete', 'elapsedSeconds'])):
+  """Progress of a batch, passed to the progressCallback of iterModifyDicomFiles.  Files are
+  discovered while the batch runs, so the total is only known once discoveryComplete is True.
+  """
+
+  @property
+  def filesPerSecond(self):
+    return self.filesDone / self.elapsedSeconds if self.elapsedSeconds > 0 else 0.0
+
+  @property
+  def etaSeconds(self):
+    '''Estimated time until the batch is done, or None if it can't be estimated yet'''
+    if not self.discoveryComplete or self.filesPerSecond <= 0:
+      return None
+    return (self.filesDiscovered - self.filesDone) / self.filesPerSecond
+
+_batchWorkerState = {}
+
+def _isCandidateDicomFileName(fileName):
+  '''Cheap check, on the file name alone, that a file could be a DICOM file'''
+  if fileName.startswith('.'):
+    return False # hidden files (including ._* macOS resource forks)
+  lowerFileName = fileName.lower()
+  if lowerFileName in _NON_DICOM_FILE_NAMES:
+    return False
+  return os.path.splitext(lowerFileName)[1] not in _NON_DICOM_FILE_EXTENSIONS
+
+@functools.lru_cache(maxsize=65536)
+def _probeDicomFile(filePath, fileSize, fileModifiedTime, allowNoPreamble):
+  '''Implementation of isValidDICOMFile; the size and modification time are only part of the cache key'''
+  try:
+    with open(filePath, 'rb') as fileHandle:
+      header = fileHandle.read(132)
+  except OSError:
+    return False
+  return _isDicomPrefix(header, fileSize, allowNoPreamble)
+
+def _isDicomPrefix(header, fileSize, allowNoPreamble):
+  '''Check of the first 132 bytes of a file (or fewer, if it is shorter), see isValidDICOMFile'''
+  if header[128:132] == b'DICM':
+    return True
+  if not allowNoPreamble or len(header) < 8:
+    return False
+  # No preamble: the file should start with a little endian element from the first few groups
+  group, = struct.unpack('<H', header[0:2])
+  if group not in (0x0000, 0x0002, 0x0008):
+    return False
+  VR = header[4:6]
+  if VR.isalpha() and VR.isupper():
+    return VR.decode('ascii') in _KNOWN_VRS # explicit VR
+  length, = struct.unpack('<I', header[4:8])
+  return length < fileSize # implicit VR, the value length must at least fit in the file
+
+# Header of a DICOM file read up to the pixel data; headerLength is the file offset where the header
+# ends (the pixel data element starts), which doesn't apply to deflated files.  hasTrailingElements is
+# True if the file was checked for, and has, elements after the pixel data.
+_DicomHeader = collections.namedtuple('_DicomHeader', ['ds', 'headerLength', 'isDeflated', 'hasTrailingElements'],
+  defaults=[False])
+
+def _readDicomHeader(filePath, allowNoPreamble=False, checkTrailingElements=False):
+  '''Parse a DICOM file up to the pixel data, and if checkTrailingElements, look for elements after it'''
+  with open(filePath, 'rb') as inputFile:
+    header = _readDicomHeaderFromFile(inputFile, allowNoPreamble)
+    if checkTrailingElements and not header.isDeflated:
+      header = header._replace(hasTrailingElements=_hasElementsAfterPixelData(inputFile, header))
+    return header
+
+def _readDicomHeaderFromFile(inputFile, allowNoPreamble=False):
+  ds = pydicom.dcmread(inputFile, stop_before_pixels=True, force=allowNoPreamble)
+  # pydicom leaves the file positioned at the start of the pixel data element (or at the end of
+  # the file if there is no pixel data)
+  headerLength = inputFile.tell()
+  transferSyntaxUID = getattr(getattr(ds, 'file_meta', None), 'TransferSyntaxUID', None)
+  # Deflated files are read from a decompressed copy, file offsets don't apply
+  isDeflated = transferSyntaxUID == pydicom.uid.DeflatedExplicitVRLittleEndian
+  return _DicomHeader(ds, headerLength, isDeflated)
+
+def _readEncoding(ds):
+  '''(isImplicitVR, isLittleEndian) of the file a dataset was read from'''
+  if hasattr(ds, 'original_encoding'):
+    return ds.original_encoding
+  return ds.read_implicit_vr, ds.read_little_endian # pydicom 2
+
+def _hasElementsAfterPixelData(inputFile, header):
+  '''True if there is anything but pixel data elements after the header of a (not deflated) file.
+  Only the element headers (and the item headers of encapsulated pixel data) are read, the values
+  are skipped.
+  '''
+  isImplicitVR, isLittleEndian = _readEncoding(header.ds)
+  endian = '<' if isLittleEndian else '>'
+  fileSize = os.fstat(inputFile.fileno()).st_size
+  position = header.headerLength
+  while position + 8 <= fileSize:
+    inputFile.seek(position)
+    elementHeader = inputFile.read(12)
+    group, element = struct.unpack(endian + 'HH', elementHeader[:4])
+    if group != 0x7FE0:
+      return True
+    if isImplicitVR:
+      length, = struct.unpack(endian + 'I', elementHeader[4:8])
+      position += 8
+    elif elementHeader[4:6].decode('ascii', 'replace') in _EXPLICIT_LONG_LENGTH_VRS:
+      length, = struct.unpack(endian + 'I', elementHeader[8:12])
+      position += 12
+    else:
+      length, = struct.unpack(endian + 'H', elementHeader[6:8])
+      position += 8
+    if length != 0xFFFFFFFF:
+      position += length
+      continue
+    # Encapsulated pixel data: skip the items, up to the sequence delimiter
+    while position + 8 <= fileSize:
+      inputFile.seek(position)
+      itemGroup, itemElement, itemLength = struct.unpack(endian + 'HHI', inputFile.read(8))
+      position += 8
+      if (itemGroup, itemElement) == (0xFFFE, 0xE0DD): # sequence delimiter
+        break
+      position += itemLength
+  return False
+
+def _snapshotElements(ds):
+  '''The top level and file meta elements of a dataset, to compare with after editing it (see _undoRecord).
+  Raw elements are kept as they are (edits replace them, never change them), converted ones are
+  encoded now as an UndoEntry, since edits may change them in place.
+  '''
+  isImplicitVR, isLittleEndian = _readEncoding(ds)
+  originalElements = {}
+  for tag in ds.keys():
+    element = ds.get_item(tag)
+    originalElements[tag] = element if isinstance(element, pydicom.dataelem.RawDataElement) else \
+      _undoEntry(element, isImplicitVR, isLittleEndian, ds._character_set)
+  fileMeta = getattr(ds, 'file_meta', None)
+  for element in (fileMeta if fileMeta is not None else ()):
+    originalElements[element.tag] = _undoEntry(element, False, True, None) # always explicit VR little endian
+  return originalElements
+
+def _undoEntry(element, isImplicitVR, isLittleEndian, encodings):
+  '''UndoEntry of the current value of an element'''
+  if isinstance(element, pydicom.dataelem.RawDataElement):
+    return UndoEntry(element.tag, element.VR, element.length, bytes(element.value or b''))
+  valueBytes = encodeElementValue(element, isLittleEndian, isImplicitVR, encodings)
+  if element.is_undefined_length:
+    # Without the sequence delimiter, like the value of a raw element
+    return UndoEntry(element.tag, element.VR, 0xFFFFFFFF, valueBytes[:-8])
+  return UndoEntry(element.tag, element.VR, len(valueBytes), valueBytes)
+
+def _undoRecord(filePath, originalElements, ds):
+  '''UndoRecord of the elements which differ between a _snapshotElements snapshot and the edited dataset'''
+  isImplicitVR, isLittleEndian = _readEncoding(ds)
+  fileMeta = getattr(ds, 'file_meta', None)
+  tags = set(originalElements).union(ds.keys(), fileMeta.keys() if fileMeta is not None else ())
+  entries = []
+  for tag in sorted(tags):
+    original = originalElements.get(tag)
+    isFileMeta = tag.group == 0x0002 and fileMeta is not None
+    container = fileMeta if isFileMeta else ds
+    current = container.get_item(tag) if tag in container else None
+    if original is None:
+      entries.append(UndoEntry(tag, None, None, None)) # added
+      continue
+    if current is original:
+      continue # raw element, not touched
+    originalEntry = original if isinstance(original, UndoEntry) else _undoEntry(original, isImplicitVR, isLittleEndian, None)
+    if current is not None:
+      if isFileMeta:
+        currentEntry = _undoEntry(current, False, True, None)
+      else:
+        currentEntry = _undoEntry(current, isImplicitVR, isLittleEndian, ds._character_set)
+      if currentEntry.value == originalEntry.value:
+        continue
+    entries.append(originalEntry)
+  return UndoRecord(filePath, isImplicitVR, isLittleEndian, entries)
+
+def _patchUndoRecord(filePath, header, editPlan):
+  '''UndoRecord of in place patches: the raw values of the patched elements'''
+  isImplicitVR, isLittleEndian = _readEncoding(header.ds)
+  return UndoRecord(filePath, isImplicitVR, isLittleEndian, [_undoEntry(header.ds.get_item(edit.tag), isImplicitVR,
+    isLittleEndian, None) for edit in editPlan.edits])
+
+def _rollbackPatches(header, record):
+  '''In place patches writing back the original values of an UndoRecord, if they all fit exactly where
+  the current values are, else None
+  '''
+  if (record.isImplicitVR, record.isLittleEndian) != tuple(_readEncoding(header.ds)):
+    return None
+  patches = []
+  for entry in record.entries:
+    if entry.value is None or entry.tag >> 16 == 0x0002 or entry.tag not in header.ds:
+      return None
+    rawElement = header.ds.get_item(entry.tag)
+    if not isinstance(rawElement, pydicom.dataelem.RawDataElement) or rawElement.length in (0xFFFFFFFF, None):
+      return None
+    if rawElement.length != len(entry.value) or entry.length != len(entry.value) or rawElement.VR != entry.VR:
+      return None
+    patches.append((rawElement.value_tell, entry.value))
+  return patches
+
+def _restoreElements(ds, record):
+  '''Put the original elements of an UndoRecord back into a dataset'''
+  for entry in record.entries:
+    tag = pydicom.tag.Tag(entry.tag)
+    isFileMeta = tag.group == 0x0002
+    container = ds.file_meta if isFileMeta else ds
+    if entry.value is None:
+      if tag in container:
+        del container[tag]
+      continue
+    isImplicitVR, isLittleEndian = (False, True) if isFileMeta else (record.isImplicitVR, record.isLittleEndian)
+    container[tag] = pydicom.dataelem.RawDataElement(tag, entry.VR, entry.length, entry.value, 0, isImplicitVR,
+      isLittleEndian)
+
+def _diffElements(filePath, originalElements, ds):
+  '''TagChanges of the elements which differ between a _snapshotElements snapshot and the edited dataset'''
+  record = _undoRecord(filePath, originalElements, ds)
+  fileMeta = getattr(ds, 'file_meta', None)
+  changes = []
+  for entry in record.entries:
+    tag = pydicom.tag.Tag(entry.tag)
+    isFileMeta = tag.group == 0x0002 and fileMeta is not None
+    container = fileMeta if isFileMeta else ds
+    oldElement = None
+    if entry.value is not None:
+      # Decoded from the original encoding, with the character set of the dataset
+      isImplicitVR, isLittleEndian = (False, True) if isFileMeta else (record.isImplicitVR, record.isLittleEndian)
+      decoder = pydicom.Dataset()
+      if not isFileMeta and 'SpecificCharacterSet' in ds:
+        decoder.SpecificCharacterSet = ds.SpecificCharacterSet
+      decoder[tag] = pydicom.dataelem.RawDataElement(tag, entry.VR, entry.length, entry.value, 0, isImplicitVR,
+        isLittleEndian)
+      oldElement = decoder[tag]
+    newElement = container[tag] if tag in container else None
+    changes.append(TagChange('%04X,%04X' % (tag.group, tag.element), pydicom.datadict.keyword_for_tag(tag) or None,
+      formatElementValue(oldElement), formatElementValue(newElement)))
+  return changes
+
+def _encodeDataset(ds):
+  '''The bytes of a dataset as save_as writes it to a file'''
+  buffer = io.BytesIO()
+  ds.save_as(buffer)
+  return buffer.getvalue()
+
+def _copyFileRange(inputFd, outputFd, offset, length):
+  return os.copy_file_range(inputFd, outputFd, length, offset)
+
+def _sendFile(inputFd, outputFd, offset, length):
+  return os.sendfile(outputFd, inputFd, offset, length)
+
+# Ways to copy between files in the OS, in order of preference
+_KERNEL_COPY_FUNCTIONS = [copyFunction for name, copyFunction in [('copy_file_range', _copyFileRange),
+  ('sendfile', _sendFile)] if hasattr(os, name)]
+
+def _copyFileTail(inputFile, outputFile, offset):
+  '''Append the bytes of inputFile from offset to its end to outputFile, in fixed size chunks.  Where
+  possible the OS copies them (copy_file_range, or sendfile), without them passing through Python.
+  '''
+  outputFile.seek(0, os.SEEK_END) # flushes, so the file descriptor is positioned after the written bytes
+  inputFd, outputFd = inputFile.fileno(), outputFile.fileno()
+  endOffset = os.fstat(inputFd).st_size
+  for copyFunction in _KERNEL_COPY_FUNCTIONS:
+    try:
+      while offset < endOffset:
+        copiedLength = copyFunction(inputFd, outputFd, offset, min(endOffset - offset, _KERNEL_COPY_CHUNK_SIZE))
+        if copiedLength == 0:
+          break # not supported for these files, e.g. some virtual file systems
+        offset += copiedLength
+    except OSError:
+      pass # e.g. not supported across file systems, or by the output file type, continue another way
+    if offset >= endOffset:
+      break
+  # The copies above moved the output position behind the back of the file object
+  outputFile.seek(0, os.SEEK_END)
+  if offset < endOffset:
+    inputFile.seek(offset)
+    shutil.copyfileobj(inputFile, outputFile, _COPY_CHUNK_SIZE)
+
+class _CountingIterator:
+  '''Wraps an iterator, counting the items taken from it and noting when it is exhausted.  If timed,
+  the time spent getting items is added up in seconds.
+  '''
+
+  def __init__(self, iterable, timed=False):
+    self._iterator = iter(iterable)
+    self.count = 0
+    self.exhausted = False
+    self.timed = timed
+    self.seconds = 0.0
+
+  def __iter__(self):
+    return self
+
+  def __next__(self):
+    startTime = time.perf_counter() if self.timed else None
+    try:
+      item = next(self._iterator)
+    except StopIteration:
+      self.exhausted = True
+      raise
+    finally:
+      if self.timed:
+        self.seconds += time.perf_counter() - startTime
+    self.count += 1
+    return item
+
+def _iterNotYetDone(filePathPairs, journal):
+  '''Replace the file pairs which the journal records as complete by 'alreadyDone' results'''
+  for inputFilePath, outputFilePath in filePathPairs:
+    if journal.isComplete(inputFilePath, outputFilePath):
+      yield ModifyResult(inputFilePath, outputFilePath, True, None, 'alreadyDone')
+    else:
+      yield inputFilePath, outputFilePath
+
+def _journaled(result, journal):
+  '''The result, after recording it in the journal if one is kept'''
+  if journal is not None:
+    journal.record(result)
+  return result
+
+def _iterWithJournal(results, journal):
+  '''Pass results through (the files are recorded in the journal as they are done), and close the journal at the end'''
+  try:
+    yield from results
+  finally:
+    journal.close()
+
+def _takeUIDMappings(editPlan):
+  return editPlan.uidMap.takeNewEntries() if editPlan.uidMap is not None else None
+
+def _iterWithUIDMap(results, uidMap):
+  '''Pass results through, recording the UID mappings generated by the files in the UIDMap'''
+  try:
+    for result in results:
+      if result.uidMappings:
+        uidMap.record(result.uidMappings)
+      yield result
+  finally:
+    uidMap.flush()
+
+def _isHardLinked(filePath):
+  return os.stat(filePath).st_nlink > 1
+
+def _isWritten(result):
+  '''True if the output file of a result was written (or linked)'''
+  return result.status == 'modified' or (result.status == 'unchanged' and result.inputFilePath != result.outputFilePath)
+
+def _iterWithDeferredSync(results):
+  '''Pass results through, syncing the files written to each output directory before moving on'''
+  deferredSync = DeferredSync()
+  try:
+    for result in results:
+      if _isWritten(result):
+        deferredSync.add(result.outputFilePath)
+      yield result
+  finally:
+    deferredSync.sync()
+
+def _iterWithManifest(results, manifest, planFingerprint, cancelEvent):
+  '''Pass results through, writing them to the ShardManifest, which is marked complete if all files were done'''
+  manifest.begin(planFingerprint)
+  complete = False
+  try:
+    for result in results:
+      manifest.record(result)
+      yield result
+    complete = cancelEvent is None or not cancelEvent.is_set()
+  finally:
+    manifest.end(complete)
+
+def _iterWithDiffReport(results, diffReportPath):
+  '''Pass results through, writing their changes to a DiffReport, which is only created once iterating starts'''
+  diffReport = DiffReport(diffReportPath)
+  try:
+    for result in results:
+      diffReport.record(result)
+      yield result
+  finally:
+    diffReport.close()
+
+def _iterWithReport(results, discoveredFilePathPairs, report):
+  '''Pass results through, adding them to the BatchReport'''
+  report.begin()
+  try:
+    for result in results:
+      report.add(result)
+      yield result
+  finally:
+    report.end(discoveredFilePathPairs.seconds)
+
+def _iterWithProgress(results, discoveredFilePathPairs, progressCallback, progressInterval):
+  '''Pass results through, calling progressCallback with a BatchProgress now and then'''
+  startTime = time.monotonic()
+  lastCallbackTime = startTime
+  filesDone, filesFailed = 0, 0
+  def makeProgress(now):
+    return BatchProgress(filesDone, filesFailed, discoveredFilePathPairs.count,
+      discoveredFilePathPairs.exhausted, now - startTime)
+  progressCallback(makeProgress(startTime))
+  for result in results:
+    filesDone += 1
+    if result.status == 'failed':
+      filesFailed += 1
+    now = time.monotonic()
+    if now - lastCallbackTime >= progressInterval:
+      lastCallbackTime = now
+      progressCallback(makeProgress(now))
+    yield result
+  progressCallback(makeProgress(time.monotonic()))
+
+def _iterWithUndoLog(results, undoLog):
+  '''Pass results through (the stages record in the undo log themselves), and close the log at the end'''
+  try:
+    yield from results
+  finally:
+    undoLog.close()
+
+def _isReady(pendingItem):
+  return not isinstance(pendingItem, concurrent.futures.Future) or pendingItem.done()
+
+def _getReadyItem(pendingItem):
+  '''The item, or the result of the future (waiting for it if needed)'''
+  return pendingItem.result() if isinstance(pendingItem, concurrent.futures.Future) else pendingItem
+
+def _getMetrics(fileWork):
+  return fileWork.timer if fileWork.timer.enabled else None
+
+def _iterChunks(iterable, chunkSize):
+  '''Yield successive lists of up to chunkSize items from iterable'''
+  iterator = iter(iterable)
+  while True:
+    chunk = list(itertools.islice(iterator, chunkSize))
+    if not chunk:
+      return
+    yield chunk
+
+def _initBatchWorker(batchOptions):
+  '''Runs once in each worker process, so that the edit plan and options are only sent once per worker'''
+  _batchWorkerState['logic'] = ModifyLogic()
+  _batchWorkerState['batchOptions'] = batchOptions
+
+def _modifyDicomFileChunk(filePathPairs, syncOutputs=False):
+  '''Modify one chunk of files in a worker process'''
+  return _batchWorkerState['logic']._modifyBatchChunk(filePathPairs, _batchWorkerState['batchOptions'], syncOutputs)
+
+def _collectChunkResults(chunk, future):
+  '''Return the results for a submitted chunk, merging in the items which were already results.
+  If the chunk could not be run at all (e.g. a worker process died), every file in it is reported
+  as failed rather than silently lost.
+  '''
+  workerResults, chunkError = iter(()), None
+  if future is not None:
+    try:
+      workerResults = iter(future.result())
+    except Exception as err:
+      chunkError = err
+  results = []
+  for item in chunk:
+    if isinstance(item, ModifyResult):
+      results.append(item)
+    elif chunkError is not None:
+      results.append(ModifyResult(item[0], item[1], False, chunkError, 'failed'))
+    else:
+      results.append(next(workerResults))
+  return results
@@ -0,0 +1,272 @@
+"""Rule based de-identification profiles, applied in a single walk over a dataset.
+
+A profile is a set of rules, each selecting data elements and giving the action to take on them,
+with the action codes of DICOM PS3.15 Annex E:
+  X  remove the element
+  Z  replace the value with an empty one
+  D  replace the value with a dummy value of the same VR
+  K  keep the element (e.g. to exempt it from a broader rule)
+  U  replace the UID(s) with new ones, consistently across files (see UIDMap)
+Rules select elements by
+  keyword or tag      PatientName, (0010,0010) or 0010,0010
+  tag mask            (50xx,xxxx), x matching any hex digit
+  value representation  VR=PN
+  private elements    private
+If several rules select an element, the most specific one applies: tag, then mask, then private, then
+VR.  The rules are compiled into lookup tables, and the action for each tag (and VR) is resolved once
+and then remembered, so applying hundreds of rules costs about one dictionary lookup per element.
+
+Rules can be written one per line as "SELECTOR ACTION" (see Profile.fromText), e.g.
+  VR=PN     Z
+  private   X
+  (0008,103E)  K
+"""
+
+import hashlib
+import re
+
+import pydicom
+
+PROFILE_ACTIONS = {'X': 'remove', 'Z': 'empty', 'D': 'dummy value', 'K': 'keep', 'U': 'new UID'}
+
+# Dummy values of action D, by VR; elements of other VRs are emptied instead
+_DUMMY_VALUES = {'AE': 'ANONYMOUS', 'AS': '000Y', 'CS': 'ANONYMOUS', 'DA': '19000101', 'DS': '0',
+  'DT': '19000101000000', 'IS': '0', 'LO': 'ANONYMOUS', 'LT': 'ANONYMOUS', 'PN': 'ANONYMOUS', 'SH': 'ANONYMOUS',
+  'ST': 'ANONYMOUS', 'TM': '000000', 'UC': 'ANONYMOUS', 'UT': 'ANONYMOUS', 'FD': 0.0, 'FL': 0.0, 'SL': 0, 'SS': 0,
+  'SV': 0, 'UL': 0, 'US': 0, 'UV': 0}
+_TAG_SELECTOR_PATTERN = re.compile(r'^\(?([0-9A-Fa-fXx]{4}),([0-9A-Fa-fXx]{4})\)?$')
+_PIXEL_DATA_TAGS = (0x7FE00008, 0x7FE00009, 0x7FE00010) # Float, Double Float and Pixel Data
+_UNRESOLVED = object()
+
+# A subset of the Basic Application Level Confidentiality Profile (PS3.15 Table E.1-1), with the
+# simplest of the allowed actions for each attribute
+BASIC_PROFILE_RULES = [(keyword, 'Z') for keyword in ['PatientName', 'PatientID', 'PatientBirthDate', 'PatientSex',
+  'StudyDate', 'StudyTime', 'AccessionNumber', 'ReferringPhysicianName', 'StudyID', 'ContentDate', 'ContentTime',
+  'ContentCreatorName', 'VerifyingObserverName', 'PersonName']] + \
+  [(keyword, 'D') for keyword in ['VerifyingObserverIdentificationCodeSequence']] + \
+  [(keyword, 'U') for keyword in ['StudyInstanceUID', 'SeriesInstanceUID', 'SOPInstanceUID', 'FrameOfReferenceUID',
+  'ReferencedSOPInstanceUID', 'SynchronizationFrameOfReferenceUID', 'StorageMediaFileSetUID',
+  'ReferencedFrameOfReferenceUID', 'RelatedFrameOfReferenceUID', 'IrradiationEventUID', 'ConcatenationUID',
+  'DimensionOrganizationUID', 'TransactionUID', 'FiducialUID', 'UID', 'TemplateExtensionCreatorUID',
+  'TemplateExtensionOrganizationUID']] + \
+  [(keyword, 'X') for keyword in ['InstanceCreatorUID', 'PatientAddress', 'PatientTelephoneNumbers',
+  'PatientTelecomInformation', 'OtherPatientIDs', 'OtherPatientNames', 'OtherPatientIDsSequence', 'PatientBirthName',
+  'PatientMotherBirthName', 'PatientBirthTime', 'IssuerOfPatientID', 'MilitaryRank', 'BranchOfService',
+  'MedicalRecordLocator', 'EthnicGroup', 'Occupation', 'AdditionalPatientHistory', 'PatientComments', 'PatientAge',
+  'PatientSize', 'PatientWeight', 'PatientInsurancePlanCodeSequence', 'PatientReligiousPreference', 'ResponsiblePerson',
+  'ResponsibleOrganization', 'CountryOfResidence', 'RegionOfResidence', 'PatientState', 'CurrentPatientLocation',
+  'PatientTransportArrangements', 'SpecialNeeds', 'PregnancyStatus', 'LastMenstrualDate', 'SmokingStatus',
+  'MedicalAlerts', 'Allergies', 'ReferencedPatientSequence', 'InstitutionName', 'InstitutionAddress',
+  'InstitutionalDepartmentName', 'InstitutionCodeSequence', 'StationName', 'StationAETitle', 'PhysiciansOfRecord',
+  'PhysiciansOfRecordIdentificationSequence', 'PerformingPhysicianName', 'PerformingPhysicianIdentificationSequence',
+  'NameOfPhysiciansReadingStudy', 'PhysiciansReadingStudyIdentificationSequence', 'OperatorsName',
+  'OperatorIdentificationSequence', 'ReferringPhysicianAddress', 'ReferringPhysicianTelephoneNumbers',
+  'ReferringPhysicianIdentificationSequence', 'RequestingPhysician', 'RequestingService', 'ReviewerName',
+  'ScheduledPerformingPhysicianName', 'InterpretationRecorder', 'InterpretationTranscriber', 'InterpretationAuthor',
+  'InterpretationApproverSequence', 'AdmittingDiagnosesDescription', 'DeviceSerialNumber', 'DetectorID', 'GantryID',
+  'PlateID', 'CassetteID', 'ProtocolName', 'StudyDescription', 'SeriesDescription', 'RequestAttributesSequence',
+  'ImageComments', 'FrameComments', 'DerivationDescription', 'AcquisitionComments', 'AcquisitionDeviceProcessingDescription',
+  'TextComments', 'TextString', 'AcquisitionDate', 'AcquisitionTime', 'AcquisitionDateTime', 'SeriesDate', 'SeriesTime',
+  'OverlayDate', 'CurveDate', 'PerformedProcedureStepDescription', 'PerformedProcedureStepID',
+  'PerformedProcedureStepStartDate', 'PerformedProcedureStepStartTime', 'PerformedStationName', 'PerformedLocation',
+  'RequestedProcedureDescription', 'RequestedProcedureLocation', 'RequestedProcedureComments',
+  'ReasonForTheRequestedProcedure', 'RequestedContrastAgent', 'ReasonForStudy', 'ImagingServiceRequestComments',
+  'ScheduledProcedureStepDescription', 'ScheduledProcedureStepLocation', 'ScheduledStationName', 'ResultsComments',
+  'InterpretationText', 'Impressions', 'InterpretationDiagnosisDescription', 'ModifiedAttributesSequence',
+  'OriginalAttributesSequence', 'DigitalSignaturesSequence', 'DataSetTrailingPadding']] + \
+  [('(50xx,xxxx)', 'X'), ('(60xx,3000)', 'X'), ('(60xx,4000)', 'X'), ('private', 'X')]
+
+# Built in profiles: (rules, elements added to every file)
+PROFILES = {
+  'basic': (BASIC_PROFILE_RULES, {'PatientIdentityRemoved': 'YES',
+    'DeidentificationMethod': 'DICOM_Modify basic profile (subset of PS3.15 E.1-1)'}),
+}
+
+
+class Profile:
+  """Compiled profile rules; rules is a list of (selector, action) pairs (see the module documentation).
+  additions are keyword: value pairs to set in every file after the rules are applied (e.g.
+  PatientIdentityRemoved), see EditPlan.  Raises ValueError for invalid rules.
+  """
+
+  def __init__(self, rules, additions=None, name=None):
+    self.name = name
+    self.rules = [(selector.strip(), action.strip().upper()) for selector, action in rules]
+    self.additions = dict(additions or {})
+    self._tagActions = {}
+    self._maskActions = [] # (mask, value, action), matching tags with tag & mask == value
+    self._privateAction = None
+    self._VRActions = {}
+    self._resolvedActions = {} # (tag, VR) -> action or None, filled in as tags are met
+    for selector, action in self.rules:
+      self._addRule(selector, action)
+
+  @classmethod
+  def fromText(cls, text, name=None):
+    '''Profile from rules written one per line as "SELECTOR ACTION"; # starts a comment'''
+    rules = []
+    for lineNumber, line in enumerate(text.splitlines(), 1):
+      line = line.split('#', 1)[0].strip()
+      if not line:
+        continue
+      parts = line.rsplit(None, 1)
+      if len(parts) != 2:
+        raise ValueError('Line %i of profile rules: expected "SELECTOR ACTION", got "%s"' % (lineNumber, line))
+      rules.append(tuple(parts))
+    return cls(rules, name=name)
+
+  @classmethod
+  def fromName(cls, nameOrPath):
+    '''A built in profile (a key of PROFILES), or the rules in a text file'''
+    if nameOrPath in PROFILES:
+      rules, additions = PROFILES[nameOrPath]
+      return cls(rules, additions, nameOrPath)
+    with open(nameOrPath, 'r', encoding='utf-8') as rulesFile:
+      return cls.fromText(rulesFile.read(), nameOrPath)
+
+  def _addRule(self, selector, action):
+    if action not in PROFILE_ACTIONS:
+      raise ValueError('Unknown profile action "%s" for %s, expected one of %s' % (action, selector, ', '.join(PROFILE_ACTIONS)))
+    tagMatch = _TAG_SELECTOR_PATTERN.match(selector)
+    if selector.lower() == 'private':
+      self._privateAction = action
+    elif selector.upper().startswith('VR='):
+      self._VRActions[selector[3:].strip().upper()] = action
+    elif tagMatch and 'x' in selector.lower():
+      digits = (tagMatch.group(1) + tagMatch.group(2)).lower()
+      mask = int(''.join('0' if digit == 'x' else 'f' for digit in digits), 16)
+      self._maskActions.append((mask, int(digits.replace('x', '0'), 16), action))
+    elif tagMatch:
+      self._tagActions[int(tagMatch.group(1) + tagMatch.group(2), 16)] = action
+    else:
+      tag = pydicom.datadict.tag_for_keyword(selector)
+      if tag is None:
+        raise ValueError('Invalid profile rule selector "%s"' % selector)
+      self._tagActions[tag] = action
+
+  @property
+  def fingerprint(self):
+    '''Short hash identifying the rules and additions'''
+    description = repr((sorted(self.rules), sorted(self.additions.items())))
+    return hashlib.sha256(description.encode('utf-8')).hexdigest()[:16]
+
+  @property
+  def usesUIDMap(self):
+    '''True if rules may replace UIDs (action U, or D on elements which may be UIDs), which needs a UIDMap'''
+    if 'U' in {action for selector, action in self.rules} or 'D' in (self._privateAction, self._VRActions.get('UI')):
+      return True
+    if any(action == 'D' and _mayBeUID(tag) for tag, action in self._tagActions.items()):
+      return True
+    return any(action == 'D' and _maskMayMatchUID(mask, value) for mask, value, action in self._maskActions)
+
+  def affectsTagsFrom(self, firstTag):
+    '''True if rules may change elements with tags from firstTag on (e.g. after the pixel data)'''
+    if any(action != 'K' for action in [self._privateAction] + list(self._VRActions.values()) if action is not None):
+      return True # private and VR rules can match anywhere
+    if any(tag >= firstTag and action != 'K' for tag, action in self._tagActions.items()):
+      return True
+    return any((value | ~mask & 0xFFFFFFFF) >= firstTag and action != 'K' for mask, value, action in self._maskActions)
+
+  @property
+  def affectsPixelData(self):
+    '''True if rules may change the pixel data elements themselves'''
+    return any(self.actionFor(tag, VR) not in (None, 'K') for tag in _PIXEL_DATA_TAGS for VR in ('OB', 'OW', 'OF', 'OD'))
+
+  def actionFor(self, tag, VR):
+    '''The action for elements with this tag and VR, or None if no rule applies'''
+    action = self._resolvedActions.get((tag, VR), _UNRESOLVED)
+    if action is _UNRESOLVED:
+      action = self._tagActions.get(tag)
+      if action is None:
+        action = next((maskAction for mask, value, maskAction in self._maskActions if tag & mask == value), None)
+      if action is None and tag >> 16 & 1:
+        action = self._privateAction
+      if action is None:
+        action = self._VRActions.get(VR)
+      self._resolvedActions[(tag, VR)] = action
+    return action
+
+  def apply(self, ds, uidMap=None, keepTags=()):
+    '''Apply the rules to a dataset, including all nested sequence items.  keepTags are top level
+    tags left alone (e.g. because they are set by explicit edits).  uidMap (a UIDMap) is required
+    for rules which replace UIDs.
+    '''
+    self._walk(ds, uidMap, set(keepTags), dryRun=False)
+    fileMeta = getattr(ds, 'file_meta', None)
+    if fileMeta is not None and 'MediaStorageSOPInstanceUID' in fileMeta and self.actionFor(
+        pydicom.tag.Tag(0x00080018), 'UI') in ('U', 'D'):
+      fileMeta.MediaStorageSOPInstanceUID = uidMap.newUID(fileMeta.MediaStorageSOPInstanceUID)
+
+  def wouldChange(self, ds, keepTags=()):
+    '''True if applying the rules would change the dataset'''
+    return self._walk(ds, None, set(keepTags), dryRun=True)
+
+  def _walk(self, ds, uidMap, keepTags, dryRun):
+    '''Apply the rules to the elements of ds and of its sequence items.  Returns True if anything
+    changed; with dryRun, nothing is changed and it returns as soon as anything would.
+    '''
+    changed = False
+    for tag in list(ds.keys()):
+      if tag in keepTags:
+        continue
+      element = ds.get_item(tag) # not converted yet, unless the rules act on it
+      VR = element.VR or _dictionaryVR(tag)
+      action = self.actionFor(tag, VR)
+      if action == 'D' and VR == 'UI':
+        action = 'U'
+      elif action == 'D' and VR not in _DUMMY_VALUES:
+        action = 'Z'
+      if action is None or action == 'K':
+        if VR == 'SQ':
+          for item in ds[tag].value:
+            if self._walk(item, uidMap, (), dryRun):
+              changed = True
+              if dryRun:
+                return True
+        continue
+      if action == 'X':
+        if not dryRun:
+          del ds[tag]
+        elementChanged = True
+      else:
+        element = ds[tag]
+        if action == 'Z':
+          elementChanged = not element.is_empty
+          if elementChanged and not dryRun:
+            element.value = [] if VR == 'SQ' else None
+        elif action == 'D':
+          elementChanged = element.value != _DUMMY_VALUES[VR]
+          if elementChanged and not dryRun:
+            element.value = _DUMMY_VALUES[VR]
+        else:
+          elementChanged = not element.is_empty
+          if elementChanged and not dryRun:
+            if element.VM > 1:
+              element.value = [uidMap.newUID(value) for value in element.value]
+            else:
+              element.value = uidMap.newUID(element.value)
+      if elementChanged:
+        changed = True
+        if dryRun:
+          return True
+    return changed
+
+
+def _mayBeUID(tag):
+  '''True if elements with this tag may have the VR UI (private and unknown elements can have any VR)'''
+  return _dictionaryVR(tag) in ('UI', 'UN')
+
+
+def _maskMayMatchUID(mask, value):
+  '''True if a tag mask may match elements with the VR UI: UIDs of the dictionary, or private elements'''
+  if value >> 16 & 1 or not mask >> 16 & 1:
+    return True # matches groups with an odd number
+  return any(tag & mask == value and _mayBeUID(tag) for tag in pydicom.datadict.DicomDictionary)
+
+
+def _dictionaryVR(tag):
+  '''VR of an element of an implicit VR file, from the DICOM dictionary'''
+  try:
+    return pydicom.datadict.dictionary_VR(tag)
+  except KeyError:
+    return 'UN' # private or unknown
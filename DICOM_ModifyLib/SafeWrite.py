@@ -0,0 +1,159 @@
+"""Crash safe writing of output files.
+
+Output files are written to a temporary file next to them, which is then renamed over the output
+path, so that a process killed halfway never leaves a truncated file behind: the output path has
+either the old or the new content.  How much is done to also survive a power failure or OS crash
+is set by the fsync policy:
+  'file'       every file (and the directory entry of its rename) is synced before moving on
+  'directory'  files are not synced as they are written, but in groups by the batch worker which
+               wrote them: the files written to one directory, then that directory once (see
+               DeferredSync), before the worker hands in their results
+  'none'       nothing is synced, the OS writes the files back in its own time
+
+Logs which the worker processes of a batch append to (the journal and the undo log) are split in
+segments, one per process (see appendPath), since appends to one file from several processes may
+interleave or overwrite each other on network file systems.
+"""
+
+import contextlib
+import os
+import secrets
+
+FSYNC_POLICIES = ('file', 'directory', 'none')
+
+
+def checkFsyncPolicy(fsyncPolicy):
+  if fsyncPolicy not in FSYNC_POLICIES:
+    raise ValueError('Unknown fsync policy "%s", expected one of %s' % (fsyncPolicy, ', '.join(FSYNC_POLICIES)))
+
+
+@contextlib.contextmanager
+def atomicOutputFile(filePath, fsyncPolicy='none'):
+  '''Context manager giving a binary file to write the new content of filePath to, which replaces
+  filePath when the block completes.  If the block raises, filePath is left as it was.
+  '''
+  dirPath, fileName = os.path.split(os.path.abspath(filePath))
+  fileHandle, tempFilePath = _createTempFile(dirPath, fileName)
+  try:
+    with os.fdopen(fileHandle, 'wb') as outputFile:
+      yield outputFile
+      outputFile.flush()
+      if fsyncPolicy == 'file':
+        os.fsync(outputFile.fileno())
+    _copyPermissions(filePath, tempFilePath)
+    os.replace(tempFilePath, filePath)
+  except BaseException:
+    if os.path.exists(tempFilePath):
+      os.remove(tempFilePath)
+    raise
+  if fsyncPolicy == 'file':
+    syncDirectory(dirPath)
+
+
+def atomicLink(sourceFilePath, filePath, fsyncPolicy='none'):
+  '''Hard link sourceFilePath as filePath, replacing filePath atomically if it exists.  Raises
+  OSError if hard links are not possible (e.g. across file systems).
+  '''
+  dirPath, fileName = os.path.split(os.path.abspath(filePath))
+  tempFilePath = os.path.join(dirPath, '.%s.%i.link.tmp' % (fileName, os.getpid()))
+  if os.path.lexists(tempFilePath):
+    os.remove(tempFilePath)
+  os.link(sourceFilePath, tempFilePath)
+  try:
+    os.replace(tempFilePath, filePath)
+  except BaseException:
+    os.remove(tempFilePath)
+    raise
+  if fsyncPolicy == 'file':
+    syncDirectory(dirPath)
+
+
+def syncFile(filePath):
+  '''Flush the content of a file which was written and closed to disk'''
+  fileHandle = os.open(filePath, os.O_RDWR | getattr(os, 'O_BINARY', 0))
+  try:
+    os.fsync(fileHandle)
+  finally:
+    os.close(fileHandle)
+
+
+def syncDirectory(dirPath):
+  '''Flush the entries of a directory (e.g. a rename into it) to disk, where the OS supports it'''
+  try:
+    fileHandle = os.open(dirPath, os.O_RDONLY)
+  except OSError:
+    return # directories can't be opened on Windows, where renames don't need this
+  try:
+    os.fsync(fileHandle)
+  except OSError:
+    pass # not supported by some file systems
+  finally:
+    os.close(fileHandle)
+
+
+def appendPath(logPath, ownerPid):
+  '''Path of the segment of the log at logPath which this process appends to: logPath itself in the
+  process which owns the log (ownerPid), logPath followed by '.' and the process ID in the others
+  '''
+  pid = os.getpid()
+  return logPath if pid == ownerPid else '%s.%i' % (logPath, pid)
+
+
+def logSegmentPaths(logPath):
+  '''Paths of the existing segments of the log at logPath (see appendPath), logPath first'''
+  dirPath, fileName = os.path.split(os.path.abspath(logPath))
+  try:
+    dirFileNames = os.listdir(dirPath or '.')
+  except OSError:
+    dirFileNames = []
+  segmentPaths = [os.path.join(dirPath, dirFileName) for dirFileName in sorted(dirFileNames)
+    if dirFileName.startswith(fileName + '.') and dirFileName[len(fileName) + 1:].isdigit()]
+  return ([logPath] if os.path.exists(logPath) else []) + segmentPaths
+
+
+def _createTempFile(dirPath, fileName):
+  '''Create a temporary file next to fileName and return (file handle, path).  Unlike tempfile.mkstemp,
+  which makes it readable by the owner only, it gets the permissions open() gives new files.
+  '''
+  while True:
+    tempFilePath = os.path.join(dirPath, '.%s.%s.tmp' % (fileName, secrets.token_hex(4)))
+    try:
+      return os.open(tempFilePath, os.O_WRONLY | os.O_CREAT | os.O_EXCL | getattr(os, 'O_BINARY', 0), 0o666), tempFilePath
+    except FileExistsError:
+      continue
+
+
+def _copyPermissions(filePath, tempFilePath):
+  '''Give the file which replaces filePath the permissions of filePath, if it exists'''
+  try:
+    mode = os.stat(filePath).st_mode & 0o7777
+  except OSError:
+    return # new file, which keeps the permissions it was created with
+  os.chmod(tempFilePath, mode)
+
+
+class DeferredSync:
+  """Syncs files written with the 'directory' fsync policy in groups: files are added as they are
+  written, and when a file in another directory is added, or by sync(), the files of the group are
+  synced one by one and then their directory once.  Only those files are flushed, not the whole
+  system (as os.sync() would, which is disruptive on shared hosts).
+  """
+
+  def __init__(self):
+    self._filePaths = []
+    self._dirPath = None
+
+  def add(self, filePath):
+    dirPath = os.path.dirname(os.path.abspath(filePath))
+    if dirPath != self._dirPath:
+      self.sync()
+      self._dirPath = dirPath
+    self._filePaths.append(filePath)
+
+  def sync(self):
+    if not self._filePaths:
+      return
+    for filePath in self._filePaths:
+      syncFile(filePath)
+    syncDirectory(self._dirPath)
+    self._filePaths = []
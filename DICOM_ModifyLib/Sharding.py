@@ -0,0 +1,278 @@
+"""Splitting a batch into shards, to be run by separate processes or machines with no coordinator.
+
+Every worker lists the same tree and keeps only the files of its own shard (see selectShard), so
+the shards are disjoint and together cover every file, as long as the workers see the same files:
+  'hash'  each file goes to the shard given by a hash of its path relative to the input directory.
+          Files are selected as they are listed, but shards are balanced by file count only.
+  'size'  the files are assigned largest first to the least loaded shard, counting their size plus
+          a fixed cost per file, so shards get about the same work.  This needs the whole listing
+          first.  With a plan file on shared storage, the first worker to finish planning saves the
+          assignment and all the others use it, so they agree even if the tree changes meanwhile.
+Each worker can write a ShardManifest of its results; mergeShardManifests combines them into one
+BatchReport, and checks that every shard completed and no file was done twice.
+"""
+
+import hashlib
+import heapq
+import json
+import logging
+import os
+import socket
+import tempfile
+import time
+
+from .BatchReport import BatchReport
+
+SHARD_STRATEGIES = ('hash', 'size')
+# Cost of a file in the size balancing, in bytes, in addition to its size (opening, parsing the header...)
+FILE_COST_BYTES = 64 * 1024
+# How long to wait for a shard plan which another worker is still writing
+PLAN_WAIT_SECONDS = 60
+
+
+def parseShard(shardText):
+  '''(shardIndex, shardCount) from "INDEX/COUNT", with INDEX from 0 to COUNT - 1'''
+  try:
+    shardIndex, shardCount = (int(part) for part in shardText.split('/'))
+  except ValueError:
+    raise ValueError('Expected INDEX/COUNT, e.g. 0/4, got "%s"' % shardText)
+  checkShard(shardIndex, shardCount)
+  return shardIndex, shardCount
+
+
+def checkShard(shardIndex, shardCount):
+  if shardCount < 1 or not 0 <= shardIndex < shardCount:
+    raise ValueError('Invalid shard %i of %i, the index must be from 0 to %i' % (shardIndex, shardCount, shardCount - 1))
+
+
+def hashShard(relativePath, shardCount):
+  '''Shard of a file by a hash of its relative path, the same on every machine and platform'''
+  digest = hashlib.sha1(relativePath.replace(os.sep, '/').encode('utf-8')).digest()
+  return int.from_bytes(digest[:8], 'big') % shardCount
+
+
+def balanceShards(fileSizes, shardCount):
+  '''Assign files to shards, largest first to the least loaded shard (ties broken by path and shard
+  index, so the result only depends on the files).  fileSizes are (relative path, size) pairs.
+  Returns a dictionary of relative path -> shard index.
+  '''
+  shardLoads = [(0, shardIndex) for shardIndex in range(shardCount)]
+  assignment = {}
+  for relativePath, size in sorted(fileSizes, key=lambda fileSize: (-fileSize[1], fileSize[0])):
+    load, shardIndex = heapq.heappop(shardLoads)
+    assignment[relativePath] = shardIndex
+    heapq.heappush(shardLoads, (load + size + FILE_COST_BYTES, shardIndex))
+  return assignment
+
+
+def selectShard(filePathPairs, inputDirectory, shardIndex, shardCount, strategy='hash', planPath=None):
+  '''Yield the (input path, output path) pairs of one shard, see the module documentation.  With the
+  'size' strategy, planPath is the shard plan file to use if it exists, or to save the plan to.
+  '''
+  checkShard(shardIndex, shardCount)
+  if strategy not in SHARD_STRATEGIES:
+    raise ValueError('Unknown shard strategy "%s", expected one of %s' % (strategy, ', '.join(SHARD_STRATEGIES)))
+  inputDirectory = os.path.abspath(inputDirectory)
+  relativePath = lambda filePath: os.path.relpath(os.path.abspath(filePath), inputDirectory).replace(os.sep, '/')
+  if strategy == 'hash':
+    for inputFilePath, outputFilePath in filePathPairs:
+      if hashShard(relativePath(inputFilePath), shardCount) == shardIndex:
+        yield inputFilePath, outputFilePath
+    return
+  filePathPairs = list(filePathPairs)
+  if planPath and os.path.exists(planPath):
+    assignment = _loadShardPlan(planPath, shardCount)
+  else:
+    fileSizes = [(relativePath(inputFilePath), _fileSize(inputFilePath)) for inputFilePath, outputFilePath in filePathPairs]
+    assignment = balanceShards(fileSizes, shardCount)
+    if planPath and not _saveShardPlan(planPath, assignment, shardCount):
+      assignment = _loadShardPlan(planPath, shardCount) # another worker saved its plan first
+  for inputFilePath, outputFilePath in filePathPairs:
+    path = relativePath(inputFilePath)
+    assignedShardIndex = assignment.get(path)
+    if assignedShardIndex is None:
+      assignedShardIndex = hashShard(path, shardCount) # new since the plan was made
+    if assignedShardIndex == shardIndex:
+      yield inputFilePath, outputFilePath
+
+
+def _fileSize(filePath):
+  try:
+    return os.path.getsize(filePath)
+  except OSError:
+    return 0
+
+
+def _saveShardPlan(planPath, assignment, shardCount):
+  '''Save the plan unless a plan was saved first, atomically: it is written to a temporary file which
+  is then hard linked as the plan file, which fails if that exists already.  On file systems without
+  hard links (e.g. SMB), the plan file is created exclusively and written in place instead, and
+  readers wait until it is complete (see _loadShardPlan).  Returns True if saved.
+  '''
+  planLines = [json.dumps({'shardCount': shardCount, 'files': len(assignment)}) + '\n'] + \
+    [json.dumps([relativePath, shardIndex]) + '\n' for relativePath, shardIndex in sorted(assignment.items())]
+  dirPath, fileName = os.path.split(os.path.abspath(planPath))
+  fileHandle, tempFilePath = tempfile.mkstemp(dir=dirPath, prefix='.%s.' % fileName, suffix='.tmp')
+  try:
+    with os.fdopen(fileHandle, 'w', encoding='utf-8') as planFile:
+      planFile.writelines(planLines)
+    try:
+      os.link(tempFilePath, planPath)
+    except FileExistsError:
+      logging.info('Using the shard plan saved first in %s' % planPath)
+      return False
+    except OSError:
+      return _createShardPlan(planPath, planLines) # no hard links on this file system
+  finally:
+    os.remove(tempFilePath)
+  return True
+
+
+def _createShardPlan(planPath, planLines):
+  '''Write the lines of a plan to a new plan file, unless it exists already.  Returns True if written.'''
+  try:
+    fileHandle = os.open(planPath, os.O_WRONLY | os.O_CREAT | os.O_EXCL | getattr(os, 'O_BINARY', 0), 0o666)
+  except FileExistsError:
+    logging.info('Using the shard plan saved first in %s' % planPath)
+    return False
+  with os.fdopen(fileHandle, 'w', encoding='utf-8') as planFile:
+    planFile.writelines(planLines)
+  return True
+
+
+def _loadShardPlan(planPath, shardCount, timeout=PLAN_WAIT_SECONDS):
+  '''The assignment of relative paths to shards saved in a plan file, waiting up to timeout seconds
+  for a plan which is still being written
+  '''
+  deadline = time.monotonic() + timeout
+  assignment = _readShardPlan(planPath, shardCount)
+  while assignment is None:
+    if time.monotonic() >= deadline:
+      raise ValueError('Shard plan %s is incomplete' % planPath)
+    time.sleep(0.1)
+    assignment = _readShardPlan(planPath, shardCount)
+  return assignment
+
+
+def _readShardPlan(planPath, shardCount):
+  '''The assignment saved in a plan file, or None if the plan is not completely written (yet)'''
+  assignment = {}
+  with open(planPath, 'r', encoding='utf-8') as planFile:
+    try:
+      header = json.loads(planFile.readline())
+    except ValueError:
+      return None
+    if header['shardCount'] != shardCount:
+      raise ValueError('Shard plan %s is for %i shards, not %i' % (planPath, header['shardCount'], shardCount))
+    for line in planFile:
+      try:
+        relativePath, assignedShardIndex = json.loads(line)
+      except ValueError:
+        return None # partially written line
+      assignment[relativePath] = assignedShardIndex
+  return assignment if len(assignment) == header['files'] else None
+
+
+class ShardManifest:
+  """Result manifest of one shard of a batch, written as the results come in: one JSON line with the
+  shard and the edit plan fingerprint, then one per file (its outcome and phase timings), and a last
+  line when the shard is complete.  Pass one to ModifyLogic.iterModifyDicomFiles (manifest=...).
+  An existing manifest (e.g. of an earlier run of the shard) is only replaced if overwrite is True,
+  otherwise FileExistsError is raised.
+  """
+
+  def __init__(self, manifestPath, shardIndex=0, shardCount=1, overwrite=False):
+    checkShard(shardIndex, shardCount)
+    if not overwrite and os.path.exists(manifestPath):
+      raise FileExistsError('Shard manifest %s exists already' % manifestPath)
+    self.manifestPath = manifestPath
+    self.shardIndex = shardIndex
+    self.shardCount = shardCount
+    self.overwrite = overwrite
+    self._manifestFile = None
+    self._startTime = None
+    self._statusCounts = {}
+
+  def begin(self, planFingerprint):
+    self._manifestFile = open(self.manifestPath, 'w' if self.overwrite else 'x', encoding='utf-8')
+    self._startTime = time.monotonic()
+    self._write({'shardIndex': self.shardIndex, 'shardCount': self.shardCount, 'plan': planFingerprint,
+      'host': socket.gethostname(), 'started': time.time()})
+
+  def record(self, result):
+    '''Add the outcome of one file (a ModifyResult)'''
+    entry = {'input': result.inputFilePath, 'output': result.outputFilePath, 'status': result.status}
+    if result.error is not None:
+      entry['errorType'] = type(result.error).__name__
+      entry['error'] = str(result.error)
+    if result.metrics is not None:
+      entry.update(timings=result.metrics.timings, bytesIn=result.metrics.bytesIn, bytesOut=result.metrics.bytesOut)
+    self._statusCounts[result.status] = self._statusCounts.get(result.status, 0) + 1
+    self._write(entry)
+
+  def end(self, complete=True):
+    '''Close the manifest, marking the shard complete unless the batch was cut short'''
+    if complete:
+      self._write({'complete': True, 'files': self._statusCounts, 'elapsedSeconds': time.monotonic() - self._startTime})
+    self._manifestFile.close()
+
+  def _write(self, entry):
+    self._manifestFile.write(json.dumps(entry) + '\n')
+
+
+def mergeShardManifests(manifestPaths):
+  '''Combine the ShardManifests of the shards of a batch into one BatchReport (its elapsed time is that
+  of the slowest shard).  Returns (report, problems), problems being a list of messages about missing
+  or incomplete shards, shards of different batches, and files done by more than one shard.
+  '''
+  report = BatchReport()
+  report.elapsedSeconds = 0.0
+  problems = []
+  shardCounts, planFingerprints, seenShards = set(), set(), {}
+  fileShards = {}
+  for manifestPath in manifestPaths:
+    with open(manifestPath, 'r', encoding='utf-8') as manifestFile:
+      lines = iter(manifestFile)
+      header = json.loads(next(lines))
+      shardIndex = header['shardIndex']
+      shardCounts.add(header['shardCount'])
+      planFingerprints.add(header['plan'])
+      if shardIndex in seenShards:
+        problems.append('Shard %i is in both %s and %s' % (shardIndex, seenShards[shardIndex], manifestPath))
+      seenShards[shardIndex] = manifestPath
+      complete = False
+      for line in lines:
+        try:
+          entry = json.loads(line)
+        except ValueError:
+          continue # partially written line of a shard which was interrupted
+        if entry.get('complete'):
+          complete = True
+          report.elapsedSeconds = max(report.elapsedSeconds, entry['elapsedSeconds'])
+          continue
+        _addManifestEntry(report, entry)
+        if entry['status'] != 'alreadyDone':
+          if entry['input'] in fileShards and fileShards[entry['input']] != shardIndex:
+            problems.append('%s was done by shards %i and %i' % (entry['input'], fileShards[entry['input']], shardIndex))
+          fileShards[entry['input']] = shardIndex
+      if not complete:
+        problems.append('Shard %i (%s) did not complete' % (shardIndex, manifestPath))
+  if len(shardCounts) > 1 or len(planFingerprints) > 1:
+    problems.append('The manifests are from different batches (shard counts %s, edit plans %s)' % (
+      ', '.join(str(shardCount) for shardCount in sorted(shardCounts)), ', '.join(sorted(planFingerprints))))
+  for shardCount in shardCounts:
+    missingShards = sorted(set(range(shardCount)) - set(seenShards))
+    if missingShards:
+      problems.append('No manifest of shard(s) %s of %i' % (', '.join(str(index) for index in missingShards), shardCount))
+  return report, problems
+
+
+def _addManifestEntry(report, entry):
+  report.statusCounts[entry['status']] += 1
+  if 'timings' in entry:
+    for phase, seconds in entry['timings'].items():
+      report.phaseDurations[phase].append(seconds)
+    report.bytesIn += entry['bytesIn']
+    report.bytesOut += entry['bytesOut']
+  if entry['status'] == 'failed':
+    report.addFailure(entry.get('errorType', 'Exception'), entry['input'], entry.get('error', ''))
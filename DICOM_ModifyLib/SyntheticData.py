@@ -0,0 +1,191 @@
+"""Generation of synthetic DICOM file trees, for testing and benchmarking DICOM_Modify.
+
+Files are written with pydicom only (no numpy), and pixel data is streamed to the file after the
+header, so even very large multi-frame files are generated without holding them in memory.
+Everything is derived from the seed, so the same arguments always generate the same files.
+
+Example:
+  from DICOM_ModifyLib import generateCorpus
+  corpus = generateCorpus('/tmp/corpus', 'smallSlices', scale=0.1)
+"""
+
+import collections
+import os
+import random
+import struct
+
+from pydicom.dataset import Dataset, FileMetaDataset
+from pydicom.uid import CTImageStorage, ExplicitVRLittleEndian, generate_uid
+
+_PIXEL_DATA_CHUNK_SIZE = 1024 * 1024
+
+# Shapes of generated trees; fileCount (frameCount for largeMultiFrame) is multiplied by the scale
+CORPUS_SHAPES = {
+  # Many single frame CT slices, spread over a few series folders
+  'smallSlices': {'fileCount': 1000, 'seriesCount': 4, 'rows': 256, 'columns': 256},
+  # A few huge multi-frame files
+  'largeMultiFrame': {'fileCount': 3, 'frameCount': 200, 'rows': 512, 'columns': 512},
+  # Small files at the leaves of a deep folder tree (fanout ** depth leaf folders)
+  'deepNesting': {'depth': 6, 'fanout': 3, 'fileCount': 1458, 'rows': 64, 'columns': 64},
+  # DICOM files mixed with junk: other file types, empty and corrupt files, and DICOM files without preamble
+  'mixedJunk': {'fileCount': 500, 'junkCount': 500, 'seriesCount': 2, 'rows': 128, 'columns': 128},
+}
+
+# Summary of a generated tree; dicomFileCount excludes junk and files without preamble
+Corpus = collections.namedtuple('Corpus', ['rootDir', 'shape', 'filePaths', 'dicomFileCount', 'totalBytes'])
+
+
+def generateCorpus(rootDir, shape, scale=1.0, seed=0):
+  '''Write a synthetic tree of files of the given shape (a key of CORPUS_SHAPES) under rootDir,
+  and return its Corpus
+  '''
+  if shape not in CORPUS_SHAPES:
+    raise ValueError('Unknown corpus shape "%s", expected one of %s' % (shape, ', '.join(sorted(CORPUS_SHAPES))))
+  parameters = dict(CORPUS_SHAPES[shape])
+  scaledKey = 'frameCount' if shape == 'largeMultiFrame' else 'fileCount'
+  parameters[scaledKey] = max(1, int(round(parameters[scaledKey] * scale)))
+  randomGenerator = random.Random('%s-%s' % (shape, seed))
+  filePaths = []
+  if shape == 'deepNesting':
+    leafDirs = _nestedDirs(rootDir, parameters['depth'], parameters['fanout'])
+    for fileIndex in range(parameters['fileCount']):
+      filePath = os.path.join(leafDirs[fileIndex % len(leafDirs)], 'IM%06i.dcm' % fileIndex)
+      writeSyntheticDicomFile(filePath, parameters['rows'], parameters['columns'], seriesIndex=fileIndex % len(leafDirs),
+        instanceNumber=fileIndex + 1, seed=seed)
+      filePaths.append(filePath)
+    dicomFileCount = len(filePaths)
+  else:
+    seriesCount = parameters.get('seriesCount', parameters['fileCount'])
+    for fileIndex in range(parameters['fileCount']):
+      seriesIndex = fileIndex % seriesCount
+      filePath = os.path.join(rootDir, 'series%03i' % seriesIndex, 'IM%06i.dcm' % fileIndex)
+      writeSyntheticDicomFile(filePath, parameters['rows'], parameters['columns'], parameters.get('frameCount', 1),
+        seriesIndex=seriesIndex, instanceNumber=fileIndex + 1, seed=seed)
+      filePaths.append(filePath)
+    dicomFileCount = len(filePaths)
+    for junkIndex in range(int(round(parameters.get('junkCount', 0) * scale))):
+      filePaths.append(_writeJunkFile(rootDir, junkIndex, randomGenerator, parameters, seed))
+  totalBytes = sum(os.path.getsize(filePath) for filePath in filePaths)
+  return Corpus(rootDir, shape, filePaths, dicomFileCount, totalBytes)
+
+
+def writeSyntheticDicomFile(filePath, rows, columns, frameCount=1, seriesIndex=0, instanceNumber=1, seed=0,
+    preamble=True):
+  '''Write a CT image file with 16 bit pixels. Without preamble, the file has no preamble or file meta
+  information, as written by some older devices.
+  '''
+  ds = _createSyntheticDataset(rows, columns, frameCount, seriesIndex, instanceNumber, seed)
+  os.makedirs(os.path.dirname(filePath), exist_ok=True)
+  with open(filePath, 'wb') as outputFile:
+    if not preamble:
+      del ds.file_meta
+    _saveDataset(ds, outputFile, preamble)
+    _writePixelData(outputFile, rows * columns * frameCount * 2, instanceNumber)
+
+
+def _createSyntheticDataset(rows, columns, frameCount, seriesIndex, instanceNumber, seed):
+  studyUID = generate_uid(entropy_srcs=['study', str(seed)])
+  seriesUID = generate_uid(entropy_srcs=['series', str(seed), str(seriesIndex)])
+  instanceUID = generate_uid(entropy_srcs=['instance', str(seed), str(seriesIndex), str(instanceNumber)])
+  fileMeta = FileMetaDataset()
+  fileMeta.MediaStorageSOPClassUID = CTImageStorage
+  fileMeta.MediaStorageSOPInstanceUID = instanceUID
+  fileMeta.TransferSyntaxUID = ExplicitVRLittleEndian
+  ds = Dataset()
+  ds.file_meta = fileMeta
+  ds.SOPClassUID = CTImageStorage
+  ds.SOPInstanceUID = instanceUID
+  ds.StudyInstanceUID = studyUID
+  ds.SeriesInstanceUID = seriesUID
+  ds.Modality = 'CT'
+  ds.PatientName = 'Synthetic^Patient'
+  ds.PatientID = 'SYNTH%04i' % (seed % 10000)
+  ds.StudyDate = '20200101'
+  ds.SeriesDescription = 'Synthetic series %i' % seriesIndex
+  ds.SeriesNumber = seriesIndex + 1
+  ds.InstanceNumber = instanceNumber
+  ds.ImagePositionPatient = [0, 0, instanceNumber]
+  ds.ImageOrientationPatient = [1, 0, 0, 0, 1, 0]
+  ds.PixelSpacing = [0.5, 0.5]
+  ds.SliceThickness = 1
+  ds.SamplesPerPixel = 1
+  ds.PhotometricInterpretation = 'MONOCHROME2'
+  if frameCount > 1:
+    ds.NumberOfFrames = frameCount
+  ds.Rows = rows
+  ds.Columns = columns
+  ds.BitsAllocated = 16
+  ds.BitsStored = 16
+  ds.HighBit = 15
+  ds.PixelRepresentation = 0
+  ds.RescaleIntercept = -1024
+  ds.RescaleSlope = 1
+  return ds
+
+
+def _saveDataset(ds, outputFile, preamble=True):
+  try:
+    if preamble:
+      ds.save_as(outputFile, enforce_file_format=True)
+    else:
+      ds.save_as(outputFile, implicit_vr=False, little_endian=True)
+  except TypeError:
+    # pydicom < 3
+    ds.is_little_endian = True
+    ds.is_implicit_VR = False
+    if preamble:
+      ds.preamble = b'\x00' * 128
+      ds.save_as(outputFile, write_like_original=False)
+    else:
+      ds.save_as(outputFile)
+
+
+def _writePixelData(outputFile, length, instanceNumber):
+  '''Append an explicit VR little endian Pixel Data element of the given (even) length'''
+  outputFile.write(struct.pack('<HH2sHI', 0x7FE0, 0x0010, b'OW', 0, length))
+  # A ramp, different for each instance, so files don't all compress or deduplicate the same
+  pattern = bytes((value + instanceNumber) % 256 for value in range(4096))
+  chunk = pattern * (_PIXEL_DATA_CHUNK_SIZE // len(pattern))
+  while length > 0:
+    outputFile.write(chunk[:length])
+    length -= min(length, len(chunk))
+
+
+def _nestedDirs(rootDir, depth, fanout):
+  dirs = [rootDir]
+  for level in range(depth):
+    dirs = [os.path.join(parentDir, 'level%i_%i' % (level, branch)) for parentDir in dirs for branch in range(fanout)]
+  return dirs
+
+
+def _writeJunkFile(rootDir, junkIndex, randomGenerator, parameters, seed):
+  '''Write one of the kinds of non-DICOM (or not quite DICOM) files found in real DICOM folders.
+  Returns the file path.
+  '''
+  junkDir = os.path.join(rootDir, 'series%03i' % (junkIndex % parameters['seriesCount']))
+  os.makedirs(junkDir, exist_ok=True)
+  junkKind = junkIndex % 6
+  if junkKind == 0:
+    filePath = os.path.join(junkDir, 'notes%06i.txt' % junkIndex)
+    content = b'Scan notes\n' * randomGenerator.randint(1, 100)
+  elif junkKind == 1:
+    filePath = os.path.join(junkDir, 'README%06i' % junkIndex)
+    content = b'Not a DICOM file, and no extension to tell\n'
+  elif junkKind == 2:
+    # Corrupt file with a DICOM extension
+    filePath = os.path.join(junkDir, 'corrupt%06i.dcm' % junkIndex)
+    content = bytes(randomGenerator.getrandbits(8) for index in range(randomGenerator.randint(1, 4096)))
+  elif junkKind == 3:
+    filePath = os.path.join(junkDir, 'empty%06i.dcm' % junkIndex)
+    content = b''
+  elif junkKind == 4:
+    filePath = os.path.join(junkDir, 'DICOMDIR' if junkIndex < 6 else 'thumbs%06i.db' % junkIndex)
+    content = b'\x00' * 256
+  else:
+    filePath = os.path.join(junkDir, 'nopreamble%06i' % junkIndex)
+    writeSyntheticDicomFile(filePath, parameters['rows'], parameters['columns'], seriesIndex=junkIndex,
+      instanceNumber=junkIndex + 1, seed=seed, preamble=False)
+    return filePath
+  with open(filePath, 'wb') as junkFile:
+    junkFile.write(content)
+  return filePath
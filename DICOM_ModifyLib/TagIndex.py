@@ -0,0 +1,268 @@
+"""Persistent SQLite index of selected header tags of the files in DICOM trees.
+
+The index stores, per file, its size and modification time and the values of the indexed tags,
+read from the header only.  Refreshing it only re-reads files which are new or have changed, so
+files can be selected with a filter expression (see parseFilterExpression) without parsing the
+whole tree again on every query.
+
+Example:
+  index = TagIndex('/data/study.index.sqlite')
+  index.refresh('/data/study', logic.iterFilePaths('/data/study', recursive=True))
+  ctFilePaths = list(index.query('Modality == CT and SeriesNumber >= 3', '/data/study'))
+"""
+
+import os
+import re
+import sqlite3
+
+import pydicom
+
+# Tags indexed by default, in addition to those used in filter expressions
+DEFAULT_INDEX_KEYWORDS = ('PatientID', 'PatientName', 'StudyInstanceUID', 'StudyDate', 'StudyDescription',
+  'AccessionNumber', 'SeriesInstanceUID', 'SeriesNumber', 'SeriesDescription', 'Modality', 'SOPClassUID',
+  'SOPInstanceUID', 'InstanceNumber', 'Manufacturer')
+# Values of these VRs are indexed as numbers (if single valued), so that filters compare them as numbers
+_NUMERIC_VRS = {'IS', 'DS', 'US', 'SS', 'UL', 'SL', 'UV', 'SV', 'FL', 'FD'}
+# Number of files re-read between commits while refreshing
+_COMMIT_INTERVAL = 1000
+
+_FILTER_TOKEN_PATTERN = re.compile(r'''\s*(?:(?P<string>"[^"]*"|'[^']*')|(?P<operator>==|!=|<=|>=|<|>|~|\(|\)|,)|(?P<word>[^\s"'=!<>~(),]+))''')
+_COMPARISON_OPERATORS = {'==': '=', '!=': '!=', '<': '<', '<=': '<=', '>': '>', '>=': '>=', '~': 'GLOB'}
+
+
+class TagIndex:
+  """Index of header tag values of DICOM files, stored in an SQLite database (indexPath, or
+  ':memory:' for an index which is not kept).  keywords are the DICOM keywords of the indexed tags;
+  keywords used in filter expressions are added as needed.  Use from one thread only.
+  """
+
+  def __init__(self, indexPath=':memory:', keywords=DEFAULT_INDEX_KEYWORDS):
+    self.indexPath = indexPath
+    self._connection = sqlite3.connect(indexPath)
+    self._connection.execute('CREATE TABLE IF NOT EXISTS files (path TEXT PRIMARY KEY, size INTEGER, mtime INTEGER, isDicom INTEGER)')
+    self.keywords = [row[1] for row in self._connection.execute('PRAGMA table_info(files)')][4:]
+    self.addKeywords(keywords)
+
+  def addKeywords(self, keywords):
+    '''Index more tags. Files indexed before are re-read on the next refresh.'''
+    newKeywords = [keyword for keyword in dict.fromkeys(keywords) if keyword not in self.keywords]
+    if not newKeywords:
+      return
+    for keyword in newKeywords:
+      _checkKeyword(keyword)
+      # Column names are checked DICOM keywords, so they are safe to quote
+      self._connection.execute('ALTER TABLE files ADD COLUMN "%s"' % keyword)
+      self._connection.execute('CREATE INDEX IF NOT EXISTS "index_%s" ON files ("%s")' % (keyword, keyword))
+    self._connection.execute('UPDATE files SET mtime = NULL')
+    self._connection.commit()
+    self.keywords.extend(newKeywords)
+
+  def refresh(self, rootDir, filePaths, recursive=True, allowNoPreamble=False, isDicomFile=None):
+    '''Bring the index up to date with the files under rootDir: read the headers of the given file
+    paths (e.g. from ModifyLogic.iterFilePaths) which are new or changed since they were indexed,
+    and forget indexed files under rootDir (directly in it if not recursive) which are no longer
+    listed.  isDicomFile (e.g. ModifyLogic.isValidDICOMFile) is a quick check of a file path, files
+    failing it are not read.  Returns the number of files read.
+    '''
+    rootDir = os.path.abspath(rootDir)
+    seenPaths = set()
+    readCount = 0
+    for filePath in filePaths:
+      filePath = os.path.abspath(filePath)
+      seenPaths.add(filePath)
+      try:
+        fileStat = os.stat(filePath)
+      except OSError:
+        continue
+      row = self._connection.execute('SELECT size, mtime, isDicom FROM files WHERE path = ?', (filePath,)).fetchone()
+      # Files found not to be DICOM files may be readable if files without preamble are allowed now
+      if row is not None and row[:2] == (fileStat.st_size, fileStat.st_mtime_ns) and (row[2] or not allowNoPreamble):
+        continue
+      values = self._readTagValues(filePath, allowNoPreamble) if isDicomFile is None or isDicomFile(filePath) else None
+      self._connection.execute('INSERT OR REPLACE INTO files (path, size, mtime, isDicom%s) VALUES (?, ?, ?, ?%s)' % (
+        ''.join(', "%s"' % keyword for keyword in self.keywords), ', ?' * len(self.keywords)),
+        [filePath, fileStat.st_size, fileStat.st_mtime_ns, values is not None] + (values or [None] * len(self.keywords)))
+      readCount += 1
+      if readCount % _COMMIT_INTERVAL == 0:
+        self._connection.commit()
+    lowerBound, upperBound = _pathRange(rootDir)
+    removedPaths = [(path,) for path, in self._connection.execute('SELECT path FROM files WHERE path > ? AND path < ?',
+      (lowerBound, upperBound)) if path not in seenPaths and (recursive or os.path.dirname(path) == rootDir)]
+    self._connection.executemany('DELETE FROM files WHERE path = ?', removedPaths)
+    self._connection.commit()
+    return readCount
+
+  def _readTagValues(self, filePath, allowNoPreamble):
+    '''Values of the indexed tags of a file, or None if it isn't a DICOM file'''
+    try:
+      ds = pydicom.dcmread(filePath, stop_before_pixels=True, specific_tags=self.keywords, force=allowNoPreamble)
+    except Exception:
+      return None
+    return [_indexValue(ds[keyword]) if keyword in ds else None for keyword in self.keywords]
+
+  def query(self, filterExpression=None, rootDir=None, recursive=True):
+    '''Yield the paths of indexed DICOM files matching the filter expression (all if None), under
+    rootDir (directly in it if not recursive) if given, in path order.  Raises ValueError if the
+    expression uses keywords which are not indexed (see addKeywords).
+    '''
+    where, parameters = ['isDicom'], []
+    if filterExpression:
+      keywords, filterWhere, filterParameters = parseFilterExpression(filterExpression)
+      missingKeywords = [keyword for keyword in keywords if keyword not in self.keywords]
+      if missingKeywords:
+        raise ValueError('Not indexed: %s' % ', '.join(missingKeywords))
+      where.append(filterWhere)
+      parameters.extend(filterParameters)
+    if rootDir is not None:
+      rootDir = os.path.abspath(rootDir)
+      where.append('path > ? AND path < ?')
+      parameters.extend(_pathRange(rootDir))
+    for path, in self._connection.execute('SELECT path FROM files WHERE %s ORDER BY path' % ' AND '.join(
+        '(%s)' % clause for clause in where), parameters):
+      if rootDir is None or recursive or os.path.dirname(path) == rootDir:
+        yield path
+
+  def close(self):
+    self._connection.close()
+
+
+def parseFilterExpression(filterExpression):
+  '''Translate a filter expression into an SQL condition on the files table.  Expressions compare
+  DICOM keywords with values, and combine comparisons with and, or, not and parentheses, e.g.
+    Modality == CT and (SeriesNumber > 2 or SeriesDescription ~ "*AXIAL*")
+  Operators are ==, !=, <, <=, >, >=, ~ (glob pattern match, with * and ?), and "in" a list of
+  values, e.g. Modality in (CT, MR).  Values, quoted or not, are converted by the VR of the keyword:
+  they are compared as numbers for numeric VRs (e.g. SeriesNumber), as text otherwise, even if they
+  look like numbers (e.g. StudyDate 20200101, PatientID 12345).  Returns (keywords, sqlCondition,
+  parameters); raises ValueError if the expression is invalid.
+  '''
+  tokens = _tokenizeFilterExpression(filterExpression)
+  parser = _FilterParser(tokens)
+  sqlCondition = parser.parseOr()
+  if parser.position != len(tokens):
+    raise ValueError('Unexpected "%s" in filter expression' % tokens[parser.position][1])
+  return sorted(parser.keywords), sqlCondition, parser.parameters
+
+
+def _tokenizeFilterExpression(filterExpression):
+  '''List of (kind, text) tokens, kind is string, operator or word'''
+  tokens = []
+  position = 0
+  filterExpression = filterExpression.rstrip()
+  while position < len(filterExpression):
+    match = _FILTER_TOKEN_PATTERN.match(filterExpression, position)
+    if match is None or match.end() == position:
+      raise ValueError('Invalid filter expression at "%s"' % filterExpression[position:])
+    tokens.append((match.lastgroup, match.group(match.lastgroup)))
+    position = match.end()
+  return tokens
+
+
+class _FilterParser:
+  """Recursive descent parser of filter expressions, building the SQL condition"""
+
+  def __init__(self, tokens):
+    self.tokens = tokens
+    self.position = 0
+    self.keywords = set()
+    self.parameters = []
+
+  def peek(self):
+    return self.tokens[self.position] if self.position < len(self.tokens) else (None, None)
+
+  def take(self, expectedText=None):
+    kind, text = self.peek()
+    if kind is None:
+      raise ValueError('Unexpected end of filter expression')
+    if expectedText is not None and text.lower() != expectedText:
+      raise ValueError('Expected "%s" but found "%s" in filter expression' % (expectedText, text))
+    self.position += 1
+    return kind, text
+
+  def parseOr(self):
+    clauses = [self.parseAnd()]
+    while self.peek()[1] is not None and self.peek()[1].lower() == 'or' and self.peek()[0] == 'word':
+      self.take()
+      clauses.append(self.parseAnd())
+    return ' OR '.join(clauses)
+
+  def parseAnd(self):
+    clauses = [self.parseNot()]
+    while self.peek()[1] is not None and self.peek()[1].lower() == 'and' and self.peek()[0] == 'word':
+      self.take()
+      clauses.append(self.parseNot())
+    return ' AND '.join(clauses)
+
+  def parseNot(self):
+    kind, text = self.peek()
+    if kind == 'word' and text.lower() == 'not':
+      self.take()
+      return 'NOT (%s)' % self.parseNot()
+    if kind == 'operator' and text == '(':
+      self.take()
+      clause = self.parseOr()
+      self.take(')')
+      return '(%s)' % clause
+    return self.parseComparison()
+
+  def parseComparison(self):
+    kind, keyword = self.take()
+    if kind != 'word':
+      raise ValueError('Expected a DICOM keyword but found "%s" in filter expression' % keyword)
+    _checkKeyword(keyword)
+    self.keywords.add(keyword)
+    kind, operator = self.take()
+    if kind == 'word' and operator.lower() == 'in':
+      self.take('(')
+      values = [self.parseValue(keyword)]
+      while self.peek()[1] == ',':
+        self.take()
+        values.append(self.parseValue(keyword))
+      self.take(')')
+      self.parameters.extend(values)
+      return '"%s" IN (%s)' % (keyword, ', '.join('?' * len(values)))
+    if kind != 'operator' or operator not in _COMPARISON_OPERATORS:
+      raise ValueError('Expected a comparison operator after %s but found "%s" in filter expression' % (keyword, operator))
+    self.parameters.append(self.parseValue(keyword))
+    return '"%s" %s ?' % (keyword, _COMPARISON_OPERATORS[operator])
+
+  def parseValue(self, keyword):
+    '''A value compared with the keyword, converted as it is stored in the index (see _indexValue):
+    numbers for numeric VRs, text otherwise, even if it looks like a number (e.g. StudyDate 20200101)
+    '''
+    kind, text = self.take()
+    if kind == 'string':
+      text = text[1:-1]
+    elif kind != 'word':
+      raise ValueError('Expected a value but found "%s" in filter expression' % text)
+    VR = pydicom.datadict.dictionary_VR(pydicom.datadict.tag_for_keyword(keyword))
+    if VR not in _NUMERIC_VRS:
+      return text
+    for numberType in (float,) if VR in ('DS', 'FL', 'FD') else (int, float):
+      try:
+        return numberType(text)
+      except ValueError:
+        pass
+    return text
+
+
+def _checkKeyword(keyword):
+  if pydicom.datadict.tag_for_keyword(keyword) is None:
+    raise ValueError('Unknown DICOM keyword "%s"' % keyword)
+
+
+def _indexValue(element):
+  '''Value of a data element as stored in the index'''
+  if element.value is None or element.VM == 0:
+    return None
+  if element.VR in _NUMERIC_VRS and element.VM == 1:
+    return float(element.value) if element.VR in ('DS', 'FL', 'FD') else int(element.value)
+  if element.VM > 1:
+    return '\\'.join(str(value) for value in element.value)
+  return str(element.value)
+
+
+def _pathRange(rootDir):
+  '''Bounds of the paths of files under rootDir, for range queries on the path index'''
+  rootPrefix = os.path.join(rootDir, '')
+  return rootPrefix, rootPrefix[:-1] + chr(ord(rootPrefix[-1]) + 1)
@@ -0,0 +1,162 @@
+"""Consistent remapping of DICOM UIDs (old UID -> new UID) across the files of a batch.
+
+New UIDs are generated deterministically from a salt and the old UID, so every worker process
+generates the same new UID for the same old UID without having to share state: all files of a
+series get the same new SeriesInstanceUID, and every instance gets its own new SOPInstanceUID.
+The mapping can be kept in a file (one JSON line per UID, after a first line with the salt), so
+that a large tree can be remapped in several runs, or an interrupted run resumed, with the same
+new UIDs.
+"""
+
+import json
+import os
+import secrets
+import threading
+
+import pydicom
+
+# Instance UIDs remapped by default
+DEFAULT_REMAP_KEYWORDS = ('StudyInstanceUID', 'SeriesInstanceUID', 'SOPInstanceUID', 'FrameOfReferenceUID')
+# Keywords of elements which refer to the UID of the keyword they are listed under, and are remapped
+# along with it.  (Studies and series are referred to with StudyInstanceUID and SeriesInstanceUID in
+# sequence items, which are remapped anyway, since remapping applies at any depth.)
+_REFERENCING_KEYWORDS = {
+  'SOPInstanceUID': ('ReferencedSOPInstanceUID', 'ReferencedSOPInstanceUIDInFile', 'AffectedSOPInstanceUID',
+    'RequestedSOPInstanceUID'),
+  'FrameOfReferenceUID': ('ReferencedFrameOfReferenceUID', 'RelatedFrameOfReferenceUID'),
+}
+
+
+class UIDMap:
+  """Mapping of old UIDs to new UIDs, generated as needed.  If mapPath is given, the mapping is
+  loaded from it (including its salt) if it exists, and new entries are appended to it by record.
+  salt defaults to a random one, so different maps give different new UIDs; prefix is the UID root
+  of the new UIDs (pydicom's by default).
+  """
+
+  def __init__(self, mapPath=None, salt=None, prefix=None):
+    self.mapPath = mapPath
+    self.salt = salt
+    self.prefix = prefix or pydicom.uid.PYDICOM_ROOT_UID
+    self._mapping = {}
+    self._newEntries = [] # generated but not yet passed to record
+    self._savedUIDs = set() # old UIDs which are in the map file
+    self._lock = threading.Lock()
+    self._mapFile = None
+    if mapPath and os.path.exists(mapPath):
+      self._load()
+    if self.salt is None:
+      self.salt = secrets.token_hex(16)
+
+  def _load(self):
+    with open(self.mapPath, 'r', encoding='utf-8') as mapFile:
+      for lineNumber, line in enumerate(mapFile):
+        try:
+          entry = json.loads(line)
+        except ValueError:
+          continue # partially written line from an interrupted run
+        if lineNumber == 0:
+          if self.salt is not None and entry.get('salt') != self.salt:
+            raise ValueError('UID map %s was made with a different salt' % self.mapPath)
+          self.salt = entry.get('salt')
+          self.prefix = entry.get('prefix', self.prefix)
+        else:
+          self._mapping[entry['old']] = entry['new']
+    self._savedUIDs.update(self._mapping)
+
+  def __getstate__(self):
+    # Sent to worker processes without the open file and the lock
+    state = self.__dict__.copy()
+    state.update(_lock=None, _mapFile=None, _newEntries=[])
+    return state
+
+  def __setstate__(self, state):
+    self.__dict__.update(state)
+    self._lock = threading.Lock()
+
+  def __len__(self):
+    return len(self._mapping)
+
+  def newUID(self, oldUID):
+    '''The new UID for an old UID, the same for every call with the same salt'''
+    oldUID = str(oldUID)
+    newUID = self._mapping.get(oldUID)
+    if newUID is None:
+      newUID = pydicom.uid.generate_uid(self.prefix, entropy_srcs=[self.salt, oldUID])
+      with self._lock:
+        self._mapping[oldUID] = newUID
+        self._newEntries.append((oldUID, newUID))
+    return newUID
+
+  def takeNewEntries(self):
+    '''Return the (old UID, new UID) entries generated since the last call, to pass to record
+    (possibly in another process)
+    '''
+    with self._lock:
+      newEntries, self._newEntries = self._newEntries, []
+    return newEntries
+
+  def discardNewEntries(self):
+    '''Forget the entries generated since the last takeNewEntries (e.g. by a dry run), so that they are
+    generated again, and recorded, when they are used
+    '''
+    with self._lock:
+      for oldUID, newUID in self._newEntries:
+        self._mapping.pop(oldUID, None)
+      self._newEntries = []
+
+  def record(self, entries):
+    '''Add (old UID, new UID) entries to the mapping, and append those not yet saved to the map file'''
+    with self._lock:
+      for oldUID, newUID in entries:
+        self._mapping.setdefault(oldUID, newUID)
+        if self.mapPath and oldUID not in self._savedUIDs:
+          if self._mapFile is None:
+            self._openMapFile()
+          self._mapFile.write(json.dumps({'old': oldUID, 'new': newUID}) + '\n')
+          self._savedUIDs.add(oldUID)
+
+  def _openMapFile(self):
+    isNewFile = not os.path.exists(self.mapPath) or os.path.getsize(self.mapPath) == 0
+    self._mapFile = open(self.mapPath, 'a', encoding='utf-8')
+    if isNewFile:
+      self._mapFile.write(json.dumps({'salt': self.salt, 'prefix': self.prefix}) + '\n')
+      # Without the salt, the same new UIDs can't be generated again, so make sure it is saved
+      self._mapFile.flush()
+
+  def flush(self):
+    '''Record entries generated in this process, and flush the map file'''
+    self.record(self.takeNewEntries())
+    if self._mapFile is not None:
+      self._mapFile.flush()
+
+  def close(self):
+    self.flush()
+    if self._mapFile is not None:
+      self._mapFile.close()
+      self._mapFile = None
+
+  def remapDataset(self, ds, keywords=DEFAULT_REMAP_KEYWORDS):
+    '''Replace the UIDs of the given keywords, and of the elements referring to them, everywhere in
+    the dataset (including nested sequences), and keep the file meta MediaStorageSOPInstanceUID in
+    sync with the SOPInstanceUID
+    '''
+    remappedKeywords = set(keywords)
+    for keyword in keywords:
+      remappedKeywords.update(_REFERENCING_KEYWORDS.get(keyword, ()))
+    remappedTags = {pydicom.datadict.tag_for_keyword(keyword) for keyword in remappedKeywords}
+    self._remapElements(ds, remappedTags)
+    fileMeta = getattr(ds, 'file_meta', None)
+    if 'SOPInstanceUID' in keywords and fileMeta is not None and 'MediaStorageSOPInstanceUID' in fileMeta:
+      fileMeta.MediaStorageSOPInstanceUID = self.newUID(fileMeta.MediaStorageSOPInstanceUID)
+
+  def _remapElements(self, ds, remappedTags):
+    for element in ds:
+      if element.VR == 'SQ':
+        for item in element.value:
+          self._remapElements(item, remappedTags)
+      elif element.tag in remappedTags and element.value:
+        if element.VM > 1:
+          element.value = [self.newUID(value) for value in element.value]
+        else:
+          element.value = self.newUID(element.value)
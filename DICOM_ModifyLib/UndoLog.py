@@ -0,0 +1,117 @@
+"""Undo log of DICOM_Modify batches: the original values of the elements each file had changed.
+
+Instead of a full copy of the files, only the original encoded values of the top level elements
+which a modification changes (or None for elements it added) are kept, typically well under a
+kilobyte per file.  Records are appended before the file is written, so every file modified has
+its record even if the batch is interrupted; rolling back a record of a file which was then not
+written just writes the values it already has.  See ModifyLogic.iterRollback.
+
+The log has one JSON line per modified file:
+  {"path": ..., "encoding": [isImplicitVR, isLittleEndian], "elements": [[tag, VR, length, base64 value], ...],
+   "time": ...}
+The worker processes of a batch each write their records to their own segment of the log (the log
+path followed by '.' and the process ID, see SafeWrite.appendPath), since appends from several
+processes to one file are not atomic on network file systems; the segments are read back together,
+ordered by the time of the records.
+"""
+
+import base64
+import collections
+import json
+import os
+import threading
+import time
+
+from .SafeWrite import appendPath, logSegmentPaths
+
+# Original value of one element of a file: value is the encoded value bytes (in the encoding of the
+# record, explicit VR little endian for file meta elements), None if the element was added
+UndoEntry = collections.namedtuple('UndoEntry', ['tag', 'VR', 'length', 'value'])
+# Undo record of one file
+UndoRecord = collections.namedtuple('UndoRecord', ['filePath', 'isImplicitVR', 'isLittleEndian', 'entries'])
+
+
+class UndoLog:
+  """Append-only undo log file.  Records are written with a single write each, by the process which
+  creates the log to the log file, and by the worker processes of a batch (which get a copy of the log,
+  see __getstate__) to a segment of their own, each opened when first recording.  Since the record of
+  a file is written by the process which then writes the file, it is always written first.  With
+  fsyncPolicy 'file', every record is synced before the file it describes is written.
+  """
+
+  def __init__(self, logPath, fsyncPolicy='none'):
+    self.logPath = os.path.abspath(logPath)
+    self.fsyncPolicy = fsyncPolicy
+    self._ownerPid = os.getpid()
+    self._fileHandle = None
+    self._lock = threading.Lock()
+
+  def __getstate__(self):
+    # Sent to worker processes without the open file and the lock
+    state = self.__dict__.copy()
+    state.update(_fileHandle=None, _lock=None)
+    return state
+
+  def __setstate__(self, state):
+    self.__dict__.update(state)
+    self._lock = threading.Lock()
+
+  def record(self, undoRecord):
+    '''Append the UndoRecord of a file to the log'''
+    line = json.dumps({'path': os.path.abspath(undoRecord.filePath),
+      'encoding': [undoRecord.isImplicitVR, undoRecord.isLittleEndian],
+      'elements': [[int(entry.tag), entry.VR, entry.length,
+        None if entry.value is None else base64.b64encode(entry.value).decode('ascii')] for entry in undoRecord.entries],
+      'time': time.time()})
+    with self._lock:
+      if self._fileHandle is None:
+        self._fileHandle = os.open(appendPath(self.logPath, self._ownerPid),
+          os.O_WRONLY | os.O_APPEND | os.O_CREAT | getattr(os, 'O_BINARY', 0), 0o644)
+      os.write(self._fileHandle, (line + '\n').encode('utf-8'))
+      if self.fsyncPolicy == 'file':
+        os.fsync(self._fileHandle)
+
+  def close(self):
+    with self._lock:
+      if self._fileHandle is not None:
+        os.close(self._fileHandle)
+        self._fileHandle = None
+
+  def iterRecords(self, newestFirst=True):
+    '''Yield the UndoRecords in the log and its segments by time, by default newest first (the order to
+    roll them back in).  Only the times and file offsets of the records are kept in memory while sorting.
+    '''
+    logFiles = [open(segmentPath, 'rb') for segmentPath in logSegmentPaths(self.logPath) or [self.logPath]]
+    try:
+      recordOffsets = [] # (time, log file index, offset), in the order of the records within each file
+      for fileIndex, logFile in enumerate(logFiles):
+        offset = 0
+        for line in logFile:
+          recordOffsets.append((_recordTime(line), fileIndex, offset))
+          offset += len(line)
+      recordOffsets.sort(reverse=newestFirst)
+      for recordTime, fileIndex, offset in recordOffsets:
+        logFiles[fileIndex].seek(offset)
+        record = _parseRecord(logFiles[fileIndex].readline())
+        if record is not None:
+          yield record
+    finally:
+      for logFile in logFiles:
+        logFile.close()
+
+
+def _recordTime(line):
+  try:
+    return json.loads(line).get('time', 0) # records of older logs have no time, and stay in file order
+  except ValueError:
+    return 0
+
+
+def _parseRecord(line):
+  try:
+    entry = json.loads(line)
+  except ValueError:
+    return None # partially written line from an interrupted run
+  isImplicitVR, isLittleEndian = entry['encoding']
+  return UndoRecord(entry['path'], isImplicitVR, isLittleEndian, [UndoEntry(tag, VR, length,
+    None if value is None else base64.b64decode(value)) for tag, VR, length, value in entry['elements']])
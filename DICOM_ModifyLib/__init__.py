@@ -0,0 +1,17 @@
+"""Slicer independent implementation of the DICOM_Modify module.
+
+Everything in this package depends only on pydicom, so it can be imported in plain Python and
+run from the command line: python -m DICOM_ModifyLib --help
+"""
+
+from .BatchJournal import BatchJournal
+from .BatchReport import BatchReport, PhaseTimer
+from .DiffReport import DiffReport, TagChange, formatChanges
+from .EditPlan import EditPlan, TagEdit
+from .ModifyLogic import BatchProgress, ModifyLogic, ModifyResult
+from .Profile import PROFILES, Profile
+from .Sharding import ShardManifest, mergeShardManifests
+from .SyntheticData import Corpus, generateCorpus
+from .TagIndex import TagIndex, parseFilterExpression
+from .UIDMap import UIDMap
+from .UndoLog import UndoLog
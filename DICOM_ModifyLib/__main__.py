@@ -0,0 +1,285 @@
+"""Command line interface of DICOM_Modify, which does not need Slicer.
+
+Examples:
+  python -m DICOM_ModifyLib /data/study --recursive --output-dir /data/retagged --tag PatientID=ANON01
+  python -m DICOM_ModifyLib /data/study --recursive --overwrite --tag-num 0010,0010=Anonymous --workers 16
+  python -m DICOM_ModifyLib /data/study.zip --output-dir /data/retagged.tar.gz --tag PatientID=ANON01
+  python -m DICOM_ModifyLib /data/study --recursive --output-dir /data/deidentified --profile basic --uid-map uids.jsonl
+  python -m DICOM_ModifyLib /data/study --recursive --overwrite --tag PatientID=ANON01 --undo-log undo.jsonl
+  python -m DICOM_ModifyLib --rollback undo.jsonl
+  python -m DICOM_ModifyLib /data/study -r --overwrite --tag PatientID=ANON01 --shard 3/8 --manifest shard3.jsonl
+  python -m DICOM_ModifyLib --merge-manifests shard*.jsonl --report batch.json
+  python -m DICOM_ModifyLib /data/study -r --overwrite --profile basic --dry-run --diff-report diff.jsonl
+"""
+
+import argparse
+import collections
+import logging
+import os
+import sys
+
+from .Archive import ARCHIVE_FORMATS, isArchivePath
+from .BatchReport import BatchReport
+from .DiffReport import formatChanges
+from .ModifyLogic import STREAMING_THRESHOLD, ModifyLogic
+from .Profile import PROFILES
+from .SafeWrite import FSYNC_POLICIES
+from .Sharding import SHARD_STRATEGIES, ShardManifest, mergeShardManifests, parseShard
+from .TagIndex import parseFilterExpression
+from .UIDMap import DEFAULT_REMAP_KEYWORDS, UIDMap
+
+
+def parseTagArgument(tagArgument):
+  '''Split a "name=value" command line argument'''
+  name, separator, value = tagArgument.partition('=')
+  if not separator or not name:
+    raise argparse.ArgumentTypeError('expected TAG=VALUE, got "%s"' % tagArgument)
+  return name.strip(), value
+
+
+def parseTagNumArgument(tagArgument):
+  '''Split a "gggg,eeee=value" command line argument, with group and element in hex'''
+  tagNum, value = parseTagArgument(tagArgument)
+  try:
+    group, element = tagNum.strip('()').split(',')
+    return (int(group, 16), int(element, 16)), value
+  except ValueError:
+    raise argparse.ArgumentTypeError('expected GGGG,EEEE=VALUE (hex tag numbers), got "%s"' % tagArgument)
+
+
+def parseShardArgument(shardArgument):
+  try:
+    return parseShard(shardArgument)
+  except ValueError as err:
+    raise argparse.ArgumentTypeError(str(err))
+
+
+def createArgumentParser():
+  parser = argparse.ArgumentParser(prog='python -m DICOM_ModifyLib',
+    description='Modify tags in DICOM files (a single file, all files in a directory, or all files in an archive).')
+  parser.add_argument('input', nargs='?', help='input DICOM file, directory, or archive (%s)' % ', '.join(ARCHIVE_FORMATS))
+  outputGroup = parser.add_mutually_exclusive_group(required=True)
+  outputGroup.add_argument('--output-dir', help='write modified files here, keeping their paths relative to the input directory; '
+    'for an input archive, the output archive (its extension gives the format)')
+  outputGroup.add_argument('--overwrite', action='store_true', help='modify the input files (or archive) in place')
+  outputGroup.add_argument('--rollback', metavar='UNDO_LOG',
+    help='instead of modifying files, undo the modifications recorded in this undo log (see --undo-log), newest first')
+  outputGroup.add_argument('--merge-manifests', nargs='+', metavar='MANIFEST',
+    help='instead of modifying files, combine the result manifests of the shards of a batch (see --shard) into one '
+    'report (written to --report if given), and check that every shard completed')
+  parser.add_argument('--tag', action='append', default=[], type=parseTagArgument, metavar='KEYWORD=VALUE',
+    help='set the element with this DICOM keyword (added if missing), e.g. PatientID=ANON01; can be repeated')
+  parser.add_argument('--tag-num', action='append', default=[], type=parseTagNumArgument, metavar='GGGG,EEEE=VALUE',
+    help='set the existing element with this tag number, e.g. 0010,0020=ANON01; can be repeated')
+  parser.add_argument('--remap-uids', nargs='?', const=','.join(DEFAULT_REMAP_KEYWORDS), metavar='KEYWORDS',
+    help='replace these UIDs (comma separated keywords, default %s) with new ones, consistently across all files '
+    'and in references to them' % ','.join(DEFAULT_REMAP_KEYWORDS))
+  parser.add_argument('--profile', metavar='NAME_OR_PATH',
+    help='apply a de-identification profile to every element, including in sequences: a built in profile (%s) or a '
+    'file of rules, one "SELECTOR ACTION" per line, e.g. "VR=PN Z", "private X", "(50xx,xxxx) X"; actions are X (remove), '
+    'Z (empty), D (dummy value), K (keep) and U (new UID); --tag values override the profile' % ', '.join(PROFILES))
+  parser.add_argument('--uid-map', metavar='PATH',
+    help='keep the old to new UID mapping of --remap-uids (or of the profile) in this file, and reuse it, so runs on parts of a tree are consistent')
+  parser.add_argument('--uid-prefix', help='UID root for new UIDs (default: pydicom\'s)')
+  parser.add_argument('--filter', metavar='EXPRESSION',
+    help='only modify files whose tags match, e.g. "Modality == CT and SeriesNumber in (2, 3)"; operators are '
+    '==, !=, <, <=, >, >=, ~ (glob pattern) and in, combined with and, or, not and parentheses')
+  parser.add_argument('--index', metavar='PATH',
+    help='keep the header index used by --filter in this SQLite file, so later runs only re-read new and changed files')
+  parser.add_argument('--dry-run', action='store_true',
+    help='do not write anything, only show what would change in every file (the headers are read and edited '
+    'in memory, in parallel)')
+  parser.add_argument('--diff-report', metavar='PATH',
+    help='with --dry-run, write the changes of every file to this file (one JSON line per file) instead of '
+    'showing them')
+  parser.add_argument('--shard', type=parseShardArgument, metavar='INDEX/COUNT',
+    help='only modify shard INDEX (from 0) of COUNT shards of the input directory, e.g. 3/8, so that several machines '
+    'can each modify a part of a tree; every file is in exactly one shard')
+  parser.add_argument('--shard-strategy', choices=SHARD_STRATEGIES, default='hash',
+    help='hash: select the files of a shard by a hash of their path, as they are found; size: balance the total size '
+    'of the shards, after listing the whole tree (default: %(default)s)')
+  parser.add_argument('--shard-plan', metavar='PATH',
+    help='with --shard-strategy size, share the assignment of files to shards through this file: the first worker '
+    'saves it, the others use it')
+  parser.add_argument('--manifest', metavar='PATH',
+    help='write the outcome and timings of every file to this result manifest, to merge with --merge-manifests')
+  parser.add_argument('--overwrite-manifest', action='store_true', help='replace the result manifest if it exists already')
+  parser.add_argument('-r', '--recursive', action='store_true', help='include subdirectories of the input directory')
+  parser.add_argument('-j', '--workers', type=int, default=None, help='number of worker processes (default: number of CPUs)')
+  parser.add_argument('--chunk-size', type=int, default=32, help='number of files sent to a worker at a time')
+  parser.add_argument('--pipeline', action='store_true',
+    help='instead of worker processes, overlap reading, editing and writing with threads (for slow, e.g. network, file systems)')
+  parser.add_argument('--read-threads', type=int, default=4, help='number of threads reading files ahead with --pipeline')
+  parser.add_argument('--write-threads', type=int, default=4, help='number of threads writing files with --pipeline')
+  parser.add_argument('--header-only', action='store_true', help='only rewrite the header, copy pixel data unchanged')
+  parser.add_argument('--streaming-threshold', type=float, default=STREAMING_THRESHOLD / 1e6, metavar='MB',
+    help='files of at least this many megabytes are always modified header only, streaming the rest (default: %(default)g)')
+  parser.add_argument('--fsync', choices=FSYNC_POLICIES, default='none',
+    help='when to sync written files to disk: after each file, after each output directory, or never (files are always '
+    'written to a temporary file and renamed, so an interrupted run never leaves truncated files)')
+  parser.add_argument('--no-in-place-patch', dest='inPlacePatch', action='store_false',
+    help='always rewrite whole files, even when values could be patched in place')
+  parser.add_argument('--rewrite-unchanged', dest='skipUnchanged', action='store_false',
+    help='write files even if all the modified tags already have their new values')
+  parser.add_argument('--link-unchanged', action='store_true',
+    help='hard link (rather than copy) unchanged files into the output directory')
+  parser.add_argument('--allow-no-preamble', action='store_true', help='also accept DICOM files without the 128 byte preamble')
+  parser.add_argument('--journal', metavar='PATH', help='append the outcome of every file to this journal file')
+  parser.add_argument('--undo-log', metavar='PATH',
+    help='append the original values of the elements changed in every file to this undo log, so the run can be undone '
+    'with --rollback without a backup copy of the files')
+  parser.add_argument('--resume', action='store_true',
+    help='skip files which the journal records as done with the same tag modifications (requires --journal)')
+  parser.add_argument('--report', metavar='PATH',
+    help='time the phases of modifying every file, and write the batch report here (CSV if PATH ends with .csv, else JSON)')
+  parser.add_argument('-v', '--verbose', action='store_true', help='log every file')
+  return parser
+
+
+def main(argv=None):
+  parser = createArgumentParser()
+  args = parser.parse_args(argv)
+  logging.basicConfig(level=logging.DEBUG if args.verbose else logging.INFO, format='%(levelname)s: %(message)s')
+  logic = ModifyLogic()
+  if args.rollback:
+    return rollback(logic, args)
+  if args.merge_manifests:
+    return mergeManifests(args)
+  if args.input is None:
+    parser.error('the input is required, unless rolling back or merging manifests')
+  try:
+    remapUIDKeywords = [keyword.strip() for keyword in args.remap_uids.split(',')] if args.remap_uids else []
+    uidMap = UIDMap(args.uid_map, prefix=args.uid_prefix) if remapUIDKeywords or args.profile else None
+    editPlan = logic.compileEditPlan(dict(args.tag), dict(args.tag_num), remapUIDKeywords, uidMap, args.profile)
+  except ValueError as err:
+    logging.error('Invalid tag modification: %s' % str(err))
+    return 2
+  except OSError as err:
+    logging.error('Can\'t read profile: %s' % str(err))
+    return 2
+  if args.dry_run and (args.journal or args.undo_log):
+    logging.error('--journal and --undo-log can not be used with --dry-run')
+    return 2
+  if args.diff_report and not args.dry_run:
+    logging.error('--diff-report requires --dry-run')
+    return 2
+  if args.resume and not args.journal:
+    logging.error('--resume requires --journal')
+    return 2
+  if args.filter:
+    try:
+      parseFilterExpression(args.filter)
+    except ValueError as err:
+      logging.error('Invalid filter: %s' % str(err))
+      return 2
+  if not editPlan.edits and editPlan.uidMap is None and editPlan.profile is None:
+    logging.error('No tag modifications given (use --tag, --tag-num, --remap-uids and/or --profile)')
+    return 2
+
+  inputPath = os.path.abspath(args.input)
+  inputArchivePath = None
+  if os.path.isfile(inputPath) and isArchivePath(inputPath):
+    inputArchivePath = inputPath
+    outputArchivePath = inputPath if args.overwrite else args.output_dir
+    if not isArchivePath(outputArchivePath):
+      logging.error('The output of an input archive must be an archive (%s)' % ', '.join(ARCHIVE_FORMATS))
+      return 2
+    if args.filter or args.journal or args.undo_log or args.shard or args.manifest or args.dry_run:
+      logging.error('--filter, --journal, --undo-log, --shard, --manifest and --dry-run can not be used with an '
+        'input archive')
+      return 2
+  elif os.path.isdir(inputPath):
+    outputDirectory = inputPath if args.overwrite else args.output_dir
+    if args.filter:
+      filePathPairs = logic.iterFilteredFilePathPairs(inputPath, outputDirectory, args.filter, args.recursive,
+        indexPath=args.index, allowNoPreamble=args.allow_no_preamble)
+    else:
+      filePathPairs = logic.iterFilePathPairs(inputPath, outputDirectory, args.recursive)
+    if args.shard:
+      shardIndex, shardCount = args.shard
+      filePathPairs = logic.iterShardFilePathPairs(filePathPairs, inputPath, shardIndex, shardCount,
+        args.shard_strategy, args.shard_plan)
+  elif args.shard:
+    logging.error('--shard needs an input directory')
+    return 2
+  elif os.path.isfile(inputPath):
+    outputDirectory = os.path.dirname(inputPath) if args.overwrite else args.output_dir
+    filePathPairs = [(inputPath, os.path.join(outputDirectory, os.path.basename(inputPath)))]
+  else:
+    logging.error('Input %s does not exist' % args.input)
+    return 2
+
+  report = BatchReport() if args.report else None
+  try:
+    manifest = ShardManifest(args.manifest, *(args.shard or (0, 1)), overwrite=args.overwrite_manifest) \
+      if args.manifest else None
+  except FileExistsError as err:
+    logging.error('%s, use --overwrite-manifest to replace it' % str(err))
+    return 2
+  resultCounts = collections.Counter()
+  if inputArchivePath is not None:
+    results = logic.iterModifyArchive(inputArchivePath, outputArchivePath, editPlan=editPlan,
+      skipUnchanged=args.skipUnchanged, allowNoPreamble=args.allow_no_preamble, report=report, fsyncPolicy=args.fsync)
+  else:
+    results = logic.iterModifyDicomFiles(filePathPairs, numWorkers=args.workers, chunkSize=args.chunk_size,
+      headerOnly=args.header_only, inPlacePatch=args.inPlacePatch, allowNoPreamble=args.allow_no_preamble,
+      editPlan=editPlan, skipUnchanged=args.skipUnchanged, linkUnchanged=args.link_unchanged,
+      journalPath=args.journal, resume=args.resume, report=report, pipelined=args.pipeline,
+      readThreads=args.read_threads, writeThreads=args.write_threads, streamingThreshold=int(args.streaming_threshold * 1e6),
+      fsyncPolicy=args.fsync, undoLogPath=args.undo_log, manifest=manifest, dryRun=args.dry_run,
+      diffReportPath=args.diff_report)
+  for result in results:
+    resultCounts[result.status] += 1
+    if args.dry_run and not args.diff_report and result.status in ('wouldModify', 'failed'):
+      print('\n'.join(formatChanges(result)), flush=True)
+    elif result.status == 'failed':
+      logging.warning('DICOM file modification failed for %s: %s' % (result.inputFilePath, str(result.error)))
+    else:
+      logging.debug('%s: %s' % (result.status, result.inputFilePath))
+  logging.info('%s %i files, %i unchanged, skipped %i non-DICOM files, %i already done, %i failed.' % (
+    'Would modify' if args.dry_run else 'Modified', resultCounts['modified'] + resultCounts['wouldModify'], resultCounts['unchanged'], resultCounts['skipped'], resultCounts['alreadyDone'],
+    resultCounts['failed']))
+  if editPlan.uidMap is not None and not args.dry_run:
+    editPlan.uidMap.close()
+    logging.info('%i UIDs in the UID map%s' % (len(editPlan.uidMap), ', saved in %s' % args.uid_map if args.uid_map else ''))
+  if report is not None:
+    for line in report.formatSummary():
+      logging.info(line)
+    report.write(args.report)
+  return 1 if resultCounts['failed'] else 0
+
+
+def rollback(logic, args):
+  '''Undo the modifications recorded in the undo log given with --rollback'''
+  if not os.path.isfile(args.rollback):
+    logging.error('Undo log %s does not exist' % args.rollback)
+    return 2
+  resultCounts = collections.Counter()
+  for result in logic.iterRollback(args.rollback, allowNoPreamble=args.allow_no_preamble, fsyncPolicy=args.fsync):
+    resultCounts[result.status] += 1
+    if result.status == 'failed':
+      logging.warning('Rollback failed for %s: %s' % (result.inputFilePath, str(result.error)))
+    else:
+      logging.debug('rolled back: %s' % result.inputFilePath)
+  logging.info('Rolled back %i files, %i failed.' % (resultCounts['modified'], resultCounts['failed']))
+  return 1 if resultCounts['failed'] else 0
+
+
+def mergeManifests(args):
+  '''Combine the shard manifests given with --merge-manifests into one report'''
+  try:
+    report, problems = mergeShardManifests(args.merge_manifests)
+  except (OSError, ValueError, KeyError) as err:
+    logging.error('Can\'t read the manifests: %s' % str(err))
+    return 2
+  for problem in problems:
+    logging.warning(problem)
+  for line in report.formatSummary():
+    logging.info(line)
+  if args.report:
+    report.write(args.report)
+  return 1 if problems or report.statusCounts['failed'] else 0
+
+
+if __name__ == '__main__':
+  sys.exit(main())